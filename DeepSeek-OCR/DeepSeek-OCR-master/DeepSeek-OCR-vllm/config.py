@@ -1,9 +1,22 @@
+import os
+from dataclasses import dataclass, fields, asdict
+from functools import lru_cache
+
+from PIL import Image
+
 # TODO: change modes
 # Tiny: base_size = 512, image_size = 512, crop_mode = False
 # Small: base_size = 640, image_size = 640, crop_mode = False
 # Base: base_size = 1024, image_size = 1024, crop_mode = False
 # Large: base_size = 1280, image_size = 1280, crop_mode = False
 # Gundam: base_size = 1024, image_size = 640, crop_mode = True
+MODES = {
+    'tiny': dict(BASE_SIZE=512, IMAGE_SIZE=512, CROP_MODE=False),
+    'small': dict(BASE_SIZE=640, IMAGE_SIZE=640, CROP_MODE=False),
+    'base': dict(BASE_SIZE=1024, IMAGE_SIZE=1024, CROP_MODE=False),
+    'large': dict(BASE_SIZE=1280, IMAGE_SIZE=1280, CROP_MODE=False),
+    'gundam': dict(BASE_SIZE=1024, IMAGE_SIZE=640, CROP_MODE=True),
+}
 
 BASE_SIZE = 1024
 IMAGE_SIZE = 640
@@ -12,6 +25,13 @@ MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+OCR_CHUNK_SIZE = 256 # images per llm.generate call; progress is checkpointed to the manifest after each chunk
+PREFETCH_IMAGES = 128 # images decoded + pre-processed ahead of llm.generate; with OCR_CHUNK_SIZE this bounds RAM
+PREPROCESS_MODE = 'thread' # 'thread', or 'process' for NUM_WORKERS worker processes (process/preprocess_pool.py)
+UINT8_TILES = True # processor emits raw uint8 pixels, the model scales + normalizes them on the GPU (4x less host RAM / IPC)
+PREPROCESS_ENGINE = 'pil' # 'pil' (crop + convert tile by tile), or 'tensor': one uint8 array per image, tiles as views, batched normalize
+DECODE_DOWNSCALE = True # decode large JPEGs at the smallest 1/2, 1/4, 1/8 scale that still covers the tiles + global view (process/image_loader.py)
+MAX_IMAGE_PIXELS = 100_000_000 # Pillow warns above this and refuses files over twice this (decompression bomb guard); 0 = no limit
 PRINT_NUM_VIS_TOKENS = False
 SKIP_REPEAT = True
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
@@ -36,7 +56,124 @@ PROMPT = '<image>\nOCR the invoice.'
 # '先天下之忧而忧'
 # .......
 
+# OCR result cache (keyed on image bytes + the OCR settings above). '' disables it.
+OCR_CACHE_PATH = os.path.expanduser('~/.cache/deepseek_ocr/ocr_cache.sqlite')
+OCR_CACHE_MAX_MB = 2048
+
+# Pre-processed image tensors (keyed on image bytes + BASE_SIZE/IMAGE_SIZE/CROP_MODE/crops, not the prompt),
+# so re-runs and prompt experiments skip decoding and tiling. '' disables it.
+PREPROCESS_CACHE_PATH = os.path.expanduser('~/.cache/deepseek_ocr/preprocess')
+PREPROCESS_CACHE_MAX_MB = 8192
+
+
+# The constants above are only defaults. Code reads the live values from `settings`
+# (e.g. settings.IMAGE_SIZE) at call time, so each process can use its own input/output
+# folders and mode without editing this file:
+#   env: DEEPSEEK_OCR_INPUT_PATH=/data/in DEEPSEEK_OCR_MODE=base python run_dpsk_ocr_eval_batch.py
+#   CLI: python run_dpsk_ocr_eval_batch.py --input_path /data/in --ocr_mode base
+#   code: settings.update(INPUT_PATH='/data/in', CROP_MODE=True)
+ENV_PREFIX = 'DEEPSEEK_OCR_'
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'on'):
+        return True
+    if text in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f'not a boolean: {value!r}')
+
+
+@dataclass
+class OCRSettings:
+    BASE_SIZE: int = BASE_SIZE
+    IMAGE_SIZE: int = IMAGE_SIZE
+    CROP_MODE: bool = CROP_MODE
+    MIN_CROPS: int = MIN_CROPS
+    MAX_CROPS: int = MAX_CROPS
+    MAX_CONCURRENCY: int = MAX_CONCURRENCY
+    NUM_WORKERS: int = NUM_WORKERS
+    OCR_CHUNK_SIZE: int = OCR_CHUNK_SIZE
+    PREFETCH_IMAGES: int = PREFETCH_IMAGES
+    PREPROCESS_MODE: str = PREPROCESS_MODE
+    UINT8_TILES: bool = UINT8_TILES
+    PREPROCESS_ENGINE: str = PREPROCESS_ENGINE
+    DECODE_DOWNSCALE: bool = DECODE_DOWNSCALE
+    MAX_IMAGE_PIXELS: int = MAX_IMAGE_PIXELS
+    PRINT_NUM_VIS_TOKENS: bool = PRINT_NUM_VIS_TOKENS
+    SKIP_REPEAT: bool = SKIP_REPEAT
+    MODEL_PATH: str = MODEL_PATH
+    INPUT_PATH: str = INPUT_PATH
+    OUTPUT_PATH: str = OUTPUT_PATH
+    PROMPT: str = PROMPT
+    OCR_CACHE_PATH: str = OCR_CACHE_PATH
+    OCR_CACHE_MAX_MB: int = OCR_CACHE_MAX_MB
+    PREPROCESS_CACHE_PATH: str = PREPROCESS_CACHE_PATH
+    PREPROCESS_CACHE_MAX_MB: int = PREPROCESS_CACHE_MAX_MB
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == 'MAX_IMAGE_PIXELS':
+            # Pillow's limit is process-wide: set it whenever the setting changes, not on every decode
+            Image.MAX_IMAGE_PIXELS = value or None
+
+    def update(self, **overrides):
+        """Set settings by name (case-insensitive); None values are ignored."""
+        types = {f.name: f.type for f in fields(self)}
+        for name, value in overrides.items():
+            if value is None:
+                continue
+            key = name.upper()
+            if key not in types:
+                raise KeyError(f'unknown OCR setting: {name}')
+            setattr(self, key, _parse_bool(value) if types[key] is bool else types[key](value))
+        return self
+
+    def apply_mode(self, mode):
+        """Switch to one of the MODES presets (tiny/small/base/large/gundam)."""
+        if mode not in MODES:
+            raise KeyError(f'unknown OCR mode: {mode} (choose from {", ".join(MODES)})')
+        return self.update(**MODES[mode])
+
+    def update_from_env(self, environ=os.environ):
+        if environ.get(ENV_PREFIX + 'MODE'):
+            self.apply_mode(environ[ENV_PREFIX + 'MODE'])
+        return self.update(**{f.name: environ.get(ENV_PREFIX + f.name) for f in fields(self)})
+
+    @staticmethod
+    def add_cli_args(parser):
+        """Add --ocr_mode and one --<setting> flag per field to an argparse parser."""
+        group = parser.add_argument_group(f'OCR settings (override config.py and {ENV_PREFIX}* env vars)')
+        group.add_argument('--ocr_mode', choices=list(MODES), default=None)
+        for f in fields(OCRSettings):
+            group.add_argument('--' + f.name.lower(), type=_parse_bool if f.type is bool else f.type,
+                               default=None, metavar=f.type.__name__.upper())
+        return parser
+
+    def update_from_args(self, args):
+        if getattr(args, 'ocr_mode', None):
+            self.apply_mode(args.ocr_mode)
+        return self.update(**{f.name: getattr(args, f.name.lower(), None) for f in fields(self)})
+
+    def as_dict(self):
+        return asdict(self)
+
+
+settings = OCRSettings().update_from_env()
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_path=None):
+    """Tokenizer of settings.MODEL_PATH, loaded once per model path."""
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_path or settings.MODEL_PATH, trust_remote_code=True)
 
-from transformers import AutoTokenizer
 
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+def __getattr__(name):
+    # config.TOKENIZER used to be loaded at import time; keep it working, but lazily
+    if name == 'TOKENIZER':
+        return get_tokenizer(settings.MODEL_PATH)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,78 @@
+"""Image decoding for the OCR runners, with decode-time downscaling (DECODE_DOWNSCALE).
+
+tokenize_with_images never uses more than the tile grid (IMAGE_SIZE x tiles) and the
+BASE_SIZE global view, but a 12-48 MP phone photo is decoded at full resolution first.
+The JPEG decoder can scale by 1/2, 1/4 or 1/8 in the DCT (draft mode), so large photos are
+decoded at the smallest scale that still covers both. The crop ratio is picked from the
+full-size header and re-checked on the decoded size; if it would change, the image is
+decoded at full size instead. Pillow has no reduced decode for PNG / WebP, those are
+decoded as before.
+"""
+import math
+
+from PIL import Image, ImageOps
+
+from config import settings
+from process.image_process import count_tiles
+
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations that rotate by 90 / 270 degrees, i.e. swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def crop_ratio_for(width, height):
+    """(width tiles, height tiles) tokenize_with_images picks for an upright image of this size"""
+    if not settings.CROP_MODE or (width <= 640 and height <= 640):
+        return (1, 1)
+    return tuple(count_tiles(width, height, image_size=settings.IMAGE_SIZE))
+
+
+def required_size(width, height):
+    """smallest (width, height) the tiling and the global view can use without upsampling"""
+    # global view: ImageOps.pad fits the long side to BASE_SIZE
+    scale = settings.BASE_SIZE / max(width, height)
+    need_width, need_height = math.ceil(width * scale), math.ceil(height * scale)
+    num_width_tiles, num_height_tiles = crop_ratio_for(width, height)
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        need_width = max(need_width, settings.IMAGE_SIZE * num_width_tiles)
+        need_height = max(need_height, settings.IMAGE_SIZE * num_height_tiles)
+    elif settings.IMAGE_SIZE <= 640 and not settings.CROP_MODE:
+        # small modes squash the image to IMAGE_SIZE x IMAGE_SIZE first
+        need_width = max(need_width, settings.IMAGE_SIZE)
+        need_height = max(need_height, settings.IMAGE_SIZE)
+    return min(need_width, width), min(need_height, height)
+
+
+def _upright(size, orientation):
+    return size[::-1] if orientation in TRANSPOSED_ORIENTATIONS else size
+
+
+def _draft(image, orientation):
+    """set up a JPEG to decode at the smallest DCT scale that keeps both sides >= required_size"""
+    need = _upright(required_size(*_upright(image.size, orientation)), orientation)
+    image.draft('RGB', need)
+
+
+def load_image(image_path, downscale=None):
+    """Decode one image as upright RGB (EXIF orientation applied).
+
+    downscale (default settings.DECODE_DOWNSCALE) decodes large JPEG files at a reduced
+    scale, see the module docstring. Raises like Image.open on unreadable files,
+    including DecompressionBombError above settings.MAX_IMAGE_PIXELS (applied to Pillow by config).
+    """
+    downscale = settings.DECODE_DOWNSCALE if downscale is None else downscale
+    image = Image.open(image_path)
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    if downscale and image.format == 'JPEG':
+        full_size = image.size
+        _draft(image, orientation)
+        if crop_ratio_for(*_upright(image.size, orientation)) != crop_ratio_for(*_upright(full_size, orientation)):
+            # the rounded-up size tipped the aspect ratio to another grid
+            image.close()
+            image = Image.open(image_path)
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.load()
+    return image
@@ -1,40 +1,192 @@
-import torch
-from transformers import LogitsProcessor
-from transformers.generation.logits_process import _calc_banned_ngram_tokens
-from typing import List, Set
-
-
-class NoRepeatNGramLogitsProcessor(LogitsProcessor):
-
-    def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
-        if not isinstance(ngram_size, int) or ngram_size <= 0:
-            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
-        if not isinstance(window_size, int) or window_size <= 0:
-            raise ValueError(f"`window_size` has to be a strictly positive integer, but is {window_size}")
-        self.ngram_size = ngram_size
-        self.window_size = window_size
-        self.whitelist_token_ids = whitelist_token_ids or set()
-    
-    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
-        if len(input_ids) < self.ngram_size:
-            return scores
-        
-        current_prefix = tuple(input_ids[-(self.ngram_size - 1):])
-        
-        search_start = max(0, len(input_ids) - self.window_size)
-        search_end = len(input_ids) - self.ngram_size + 1
-        
-        banned_tokens = set()
-        for i in range(search_start, search_end):
-            ngram = tuple(input_ids[i:i + self.ngram_size])
-            if ngram[:-1] == current_prefix:
-                banned_tokens.add(ngram[-1])
-        
-        banned_tokens = banned_tokens - self.whitelist_token_ids
-        
-        if banned_tokens:
-            scores = scores.clone()
-            for token in banned_tokens:
-                scores[token] = -float("inf")
-        
-        return scores
\ No newline at end of file
+import collections
+
+import torch
+from transformers import LogitsProcessor
+from transformers.generation.logits_process import _calc_banned_ngram_tokens
+from typing import List, Set
+
+# rolling hash of the (ngram_size - 1)-token prefixes, mod a Mersenne prime
+_HASH_BASE = 1_000_003
+_HASH_MOD = (1 << 61) - 1
+
+
+class NoRepeatNGramLogitsProcessor(LogitsProcessor):
+
+    def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
+        if not isinstance(ngram_size, int) or ngram_size <= 0:
+            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
+        if not isinstance(window_size, int) or window_size <= 0:
+            raise ValueError(f"`window_size` has to be a strictly positive integer, but is {window_size}")
+        self.ngram_size = ngram_size
+        self.window_size = window_size
+        self.whitelist_token_ids = whitelist_token_ids or set()
+        self._index_buffers = {}           # device -> (host LongTensor, same on device) for index_fill_
+
+    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
+        """Sets the banned tokens of scores to -inf in place (vLLM writes the returned row back anyway)."""
+        return self._ban(scores, self.banned_tokens(input_ids))
+
+    def banned_tokens(self, input_ids: List[int]) -> Set[int]:
+        """next tokens that would repeat an n-gram of the window, minus the whitelist"""
+        if len(input_ids) < self.ngram_size:
+            return set()
+
+        search_start = max(0, len(input_ids) - self.window_size)
+        search_end = len(input_ids) - self.ngram_size + 1
+
+        # a match at i needs input_ids[i + ngram_size - 2] == the last token; one C-level scan
+        # rules that out for most steps before any tuple is built
+        if self.ngram_size > 1 and input_ids[-1] not in input_ids[search_start + self.ngram_size - 2:
+                                                                  search_end + self.ngram_size - 2]:
+            return set()
+
+        current_prefix = tuple(input_ids[-(self.ngram_size - 1):])
+
+        banned_tokens = set()
+        for i in range(search_start, search_end):
+            ngram = tuple(input_ids[i:i + self.ngram_size])
+            if ngram[:-1] == current_prefix:
+                banned_tokens.add(ngram[-1])
+
+        return banned_tokens - self.whitelist_token_ids
+
+    def _index_tensor(self, tokens: Set[int], device: torch.device) -> torch.LongTensor:
+        """tokens as a view of a LongTensor kept per device, so banning allocates nothing"""
+        host, on_device = self._index_buffers.get(device, (None, None))
+        if host is None or host.numel() < len(tokens):
+            capacity = max(self.window_size, len(tokens))
+            host = torch.empty(capacity, dtype=torch.long)
+            on_device = host if device.type == 'cpu' else torch.empty(capacity, dtype=torch.long, device=device)
+            self._index_buffers[device] = (host, on_device)
+        count = len(tokens)
+        host.numpy()[:count] = list(tokens)
+        if on_device is not host:
+            on_device[:count].copy_(host[:count])
+        return on_device[:count]
+
+    def _ban(self, scores: torch.FloatTensor, banned_tokens: Set[int]) -> torch.FloatTensor:
+        if banned_tokens:
+            scores.index_fill_(-1, self._index_tensor(banned_tokens, scores.device), -float("inf"))
+        return scores
+
+
+class IncrementalNoRepeatNGramLogitsProcessor(NoRepeatNGramLogitsProcessor):
+    """Same bans as NoRepeatNGramLogitsProcessor, without rescanning the window every step.
+
+    Keeps an index from the rolling hash of each (ngram_size - 1)-token prefix in the window
+    to the positions where it starts. Each decode step adds the n-gram that just completed
+    and evicts the one that left the window, O(1) per token; the current prefix is looked up
+    in the index and only hash hits are compared token by token.
+
+    The index belongs to one sequence. vLLM clones SamplingParams per request and calls
+    clone() on logits processors that have it, so every request gets a fresh instance. If the
+    token list does not continue the one seen last (another sequence, a recomputed prefix),
+    the index is rebuilt from the window.
+    """
+
+    def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
+        super().__init__(ngram_size, window_size, whitelist_token_ids)
+        self._prefix_len = ngram_size - 1
+        self._top_power = pow(_HASH_BASE, max(self._prefix_len - 1, 0), _HASH_MOD)
+        self._reset()
+
+    def clone(self):
+        """fresh instance with the same settings and an empty index (for SamplingParams.clone)"""
+        return type(self)(self.ngram_size, self.window_size, set(self.whitelist_token_ids))
+
+    def _reset(self):
+        self._index = {}                   # prefix hash -> deque of n-gram start positions
+        self._hashes = collections.deque() # prefix hash of every indexed position, oldest first
+        self._lo = self._hi = 0            # indexed n-gram starts: [_lo, _hi)
+        self._roll_pos = None              # position whose prefix hash is _roll_hash
+        self._roll_hash = 0
+        self._length = 0
+        self._last_token = None
+
+    def _prefix_hash(self, input_ids, pos):
+        """hash of input_ids[pos:pos + ngram_size - 1], rolled forward from the last one when possible"""
+        # rolling costs one step per position, hashing from scratch one per prefix token
+        if self._roll_pos is not None and self._roll_pos <= pos <= self._roll_pos + self._prefix_len:
+            h = self._roll_hash
+            for i in range(self._roll_pos, pos):
+                h = ((h - (input_ids[i] + 1) * self._top_power) * _HASH_BASE
+                     + input_ids[i + self._prefix_len] + 1) % _HASH_MOD
+        else:
+            h = 0
+            for token in input_ids[pos:pos + self._prefix_len]:
+                h = (h * _HASH_BASE + token + 1) % _HASH_MOD
+        self._roll_pos, self._roll_hash = pos, h
+        return h
+
+    def _update(self, input_ids):
+        length = len(input_ids)
+        if length < self._length or (self._length and input_ids[self._length - 1] != self._last_token):
+            self._reset()
+        lo = max(0, length - self.window_size)
+        hi = max(lo, length - self.ngram_size + 1)
+
+        # evict the n-grams that left the window ...
+        for _ in range(self._lo, min(lo, self._hi)):
+            h = self._hashes.popleft()
+            positions = self._index[h]
+            positions.popleft()
+            if not positions:
+                del self._index[h]
+        # ... and index the ones that completed since the last call
+        for i in range(max(self._hi, lo), hi):
+            h = self._prefix_hash(input_ids, i)
+            self._index.setdefault(h, collections.deque()).append(i)
+            self._hashes.append(h)
+        self._lo, self._hi = lo, hi
+        self._length, self._last_token = length, input_ids[-1] if length else None
+
+    def banned_tokens(self, input_ids: List[int]) -> Set[int]:
+        if self._prefix_len == 0:
+            # ngram_size=1 has no prefix to index; keep the base class behaviour exactly
+            return super().banned_tokens(input_ids)
+        self._update(input_ids)
+        if len(input_ids) < self.ngram_size:
+            return set()
+
+        current = len(input_ids) - self._prefix_len
+        positions = self._index.get(self._prefix_hash(input_ids, current))
+        if not positions:
+            return set()
+
+        current_prefix = input_ids[current:]
+        banned_tokens = set()
+        for i in positions:
+            # a hash hit is confirmed on the tokens themselves
+            if input_ids[i:i + self._prefix_len] == current_prefix:
+                banned_tokens.add(input_ids[i + self._prefix_len])
+
+        return banned_tokens - self.whitelist_token_ids
+
+
+def ban_ngrams_batch(processors, input_ids_batch: List[List[int]], scores: torch.FloatTensor) -> torch.FloatTensor:
+    """Apply no-repeat n-gram bans to a [num_seqs, vocab] logits matrix in place, one index_fill for the batch.
+
+    processors is one processor per row, or a single (stateless) NoRepeatNGramLogitsProcessor
+    shared by all rows. An IncrementalNoRepeatNGramLogitsProcessor indexes one sequence, so it
+    cannot be shared and needs one instance per row.
+    """
+    if isinstance(processors, IncrementalNoRepeatNGramLogitsProcessor):
+        raise TypeError("IncrementalNoRepeatNGramLogitsProcessor keeps per-sequence state; "
+                        "pass one processor per row (e.g. processor.clone() for each sequence)")
+    if isinstance(processors, NoRepeatNGramLogitsProcessor):
+        processors = [processors] * len(input_ids_batch)
+    if not len(processors) == len(input_ids_batch) == scores.size(0):
+        raise ValueError(f"got {len(processors)} processors and {len(input_ids_batch)} token lists "
+                         f"for {scores.size(0)} logits rows")
+    vocab_size = scores.size(-1)
+    flat_indices = set()
+    for row, (processor, input_ids) in enumerate(zip(processors, input_ids_batch)):
+        flat_indices.update(row * vocab_size + token for token in processor.banned_tokens(input_ids))
+    if not flat_indices:
+        return scores
+    index = processors[0]._index_tensor(flat_indices, scores.device)
+    if scores.is_contiguous():
+        scores.view(-1).index_fill_(0, index, -float("inf"))
+    else:
+        scores.index_put_((index // vocab_size, index % vocab_size), torch.tensor(-float("inf"), device=scores.device))
+    return scores
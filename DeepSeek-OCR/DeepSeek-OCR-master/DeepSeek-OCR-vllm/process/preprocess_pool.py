@@ -0,0 +1,128 @@
+"""Process-pool image pre-processing (PREPROCESS_MODE = 'process').
+
+tokenize_with_images is mostly PIL resize / crop and Python list building, so it holds
+the GIL and thread workers stop scaling after a few threads. PreprocessPool runs decode +
+tokenize_with_images in worker processes instead. The large float tensors (pixel_values,
+images_crop; uint8 with UINT8_TILES, else float32) come back through a memory-mapped file
+in /dev/shm rather than being pickled through the result pipe; only the small tensors and
+the file name are pickled.
+"""
+import glob
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from config import settings
+from process.image_loader import load_image
+from process.image_process import DeepseekOCRProcessor
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+SHM_PREFIX = 'dsocr_'
+
+
+def decode_and_tokenize(image_path):
+    """image path -> (size, image_input), image_input as returned by tokenize_with_images"""
+    image = load_image(image_path)
+    image_input = DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True,
+                                                              cropping=settings.CROP_MODE)
+    return image.size, image_input
+
+
+def _init_worker(overrides):
+    # spawned workers start from config.py defaults, forked ones already match the parent
+    settings.update(**overrides)
+    torch.set_num_threads(1)
+
+
+def _share(tensors, owner_pid):
+    """copy tensors of one dtype into one file in /dev/shm -> (path, shapes, dtype)"""
+    dtype = tensors[0].dtype
+    total = sum(t.numel() for t in tensors)
+    fd, path = tempfile.mkstemp(prefix=f'{SHM_PREFIX}{owner_pid}_', dir=SHM_DIR)
+    os.ftruncate(fd, total * tensors[0].element_size())
+    os.close(fd)
+    buffer = torch.from_file(path, shared=True, size=total, dtype=dtype)
+    offset = 0
+    for t in tensors:
+        buffer[offset:offset + t.numel()].copy_(t.reshape(-1))
+        offset += t.numel()
+    return path, [tuple(t.shape) for t in tensors], dtype
+
+
+def _attach(path, shapes, dtype):
+    """map a file written by _share -> tensors; the file is unlinked right away, the mapping
+    lives until the last tensor view is freed"""
+    sizes = [math.prod(shape) for shape in shapes]
+    try:
+        buffer = torch.from_file(path, shared=True, size=sum(sizes), dtype=dtype)
+    finally:
+        os.unlink(path)
+    return [part.view(shape) for part, shape in zip(torch.split(buffer, sizes), shapes)]
+
+
+def _preprocess_in_worker(image_path, owner_pid, share=True):
+    try:
+        size, image_input = decode_and_tokenize(image_path)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes = image_input[0]
+    if not share:
+        return (size, None, None, None, image_input), None
+    path, shapes, dtype = _share([pixel_values, images_crop], owner_pid)
+    small = [input_ids, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]
+    return (size, path, shapes, dtype, small), None
+
+
+def _noop():
+    return os.getpid()
+
+
+class PreprocessPool:
+    """decode + tokenize_with_images in num_workers processes.
+
+    preprocess() is blocking and thread-safe: the OCR runner calls it from its prefetch
+    threads, which just wait on the workers. Create the pool before the vLLM engine:
+    on Linux workers are forked (like torch DataLoader workers), and all of them are
+    started here, from a process that has no CUDA context yet.
+    share=False pickles the tensors instead (only for the benchmark).
+    """
+
+    def __init__(self, num_workers=None, start_method=None, share=True):
+        start_method = start_method or ('fork' if sys.platform.startswith('linux') else 'spawn')
+        self.num_workers = num_workers or settings.NUM_WORKERS
+        self.share = share
+        self.executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                            mp_context=multiprocessing.get_context(start_method),
+                                            initializer=_init_worker, initargs=(settings.as_dict(),))
+        # fork starts every worker on the first submit; spawn starts one per busy submit
+        for future in [self.executor.submit(_noop) for _ in range(self.num_workers)]:
+            future.result()
+
+    def preprocess(self, image_path):
+        """-> (size, image_input, None), or (None, None, error message) if the image could not be decoded"""
+        result, error = self.executor.submit(_preprocess_in_worker, image_path, os.getpid(), self.share).result()
+        if error is not None:
+            return None, None, error
+        size, path, shapes, dtype, small = result
+        if path is None:
+            return size, small, None
+        pixel_values, images_crop = _attach(path, shapes, dtype)
+        input_ids, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes = small
+        return size, [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop,
+                       num_image_tokens, image_shapes]], None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        # results that were never collected (e.g. an interrupted run) still own a file
+        for path in glob.glob(os.path.join(SHM_DIR or tempfile.gettempdir(), f'{SHM_PREFIX}{os.getpid()}_*')):
+            os.unlink(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -1,40 +1,77 @@
+import argparse
+import asyncio
+import collections
+import itertools
 import os
 import re
+import sys
+import time
+import uuid
 from tqdm import tqdm
 import torch
 if torch.version.cuda == '11.8':
     os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
 os.environ['VLLM_USE_V1'] = '0'
-os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+# default to GPU 0, but let parallel workers pin themselves with CUDA_VISIBLE_DEVICES=<n>
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", '0')
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
+from config import settings
 from concurrent.futures import ThreadPoolExecutor
-import glob
-from PIL import Image
-from deepseek_ocr import DeepseekOCRForCausalLM
+from deepseek_ocr import DeepseekOCRForCausalLM, image_token_layout
 
 from vllm.model_executor.models.registry import ModelRegistry
 
-from vllm import LLM, SamplingParams
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from vllm import LLM, AsyncLLMEngine, SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from process.ngram_norepeat import IncrementalNoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
+from process.image_loader import load_image
+from process.preprocess_pool import PreprocessPool
+# pipeline helpers (result_cache.py, ...) live at the repository root
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
+from result_cache import DiskLRUCache, TensorCache, make_cache_key, sha256_file
+from job_manifest import JobManifest, DISCOVERED, FAILED
+from sharding import discover_images, select_shard, add_shard_args, image_id as relative_image_id
+from tracing import tracer
+from token_ledger import ledger, retailer_of
+from memprofile import memory_profiler
+from sampling_profiler import add_profile_args, profiler_from_args, finish_profile
+from metrics import registry, IMAGES_PROCESSED, FAILURES, VISUAL_TOKENS, GENERATED_TOKENS, TOKENS_PER_SECOND
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs = MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-)
+def build_llm(gpu_memory_utilization=0.9):
+    """Load the OCR engine once; callers keep it around for every batch."""
+    return LLM(
+        model=settings.MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs = settings.MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=gpu_memory_utilization,
+    )
+
+def build_async_engine(gpu_memory_utilization=0.9):
+    """Async variant of build_llm (same engine args), used for streaming OCR."""
+    engine_args = AsyncEngineArgs(
+        model=settings.MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs = settings.MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=gpu_memory_utilization,
+    )
+    return AsyncLLMEngine.from_engine_args(engine_args)
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+logits_processors = [IncrementalNoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
 sampling_params = SamplingParams(
     temperature=0.0,
@@ -43,6 +80,54 @@ sampling_params = SamplingParams(
     skip_special_tokens=False,
 )
 
+
+def build_ocr_cache(path=None, max_mb=None):
+    path = settings.OCR_CACHE_PATH if path is None else path
+    max_mb = settings.OCR_CACHE_MAX_MB if max_mb is None else max_mb
+    if not path:
+        return None
+    return DiskLRUCache(path, max_bytes=int(max_mb * 1024 * 1024), name="ocr cache")
+
+
+def build_preprocess_cache(path=None, max_mb=None):
+    path = settings.PREPROCESS_CACHE_PATH if path is None else path
+    max_mb = settings.PREPROCESS_CACHE_MAX_MB if max_mb is None else max_mb
+    if not path:
+        return None
+    return TensorCache(path, max_bytes=int(max_mb * 1024 * 1024), name="preprocess cache")
+
+
+def preprocess_cache_key(image_path, digest=None):
+    """sha256(image bytes) + the settings that change the image tensors; the prompt is not part of it."""
+    preprocess_settings = {
+        "BASE_SIZE": settings.BASE_SIZE,
+        "IMAGE_SIZE": settings.IMAGE_SIZE,
+        "CROP_MODE": settings.CROP_MODE,
+        "MIN_CROPS": settings.MIN_CROPS,
+        "MAX_CROPS": settings.MAX_CROPS,
+        "DECODE_DOWNSCALE": settings.DECODE_DOWNSCALE,
+        "UINT8_TILES": settings.UINT8_TILES,
+        # PREPROCESS_ENGINE is left out: 'pil' and 'tensor' both resize with PIL and give identical tensors
+    }
+    return make_cache_key("preprocess", digest or sha256_file(image_path), preprocess_settings)
+
+
+def ocr_cache_key(image_path, digest=None):
+    """sha256(image bytes) + every setting that changes the OCR output."""
+    ocr_settings = {
+        "BASE_SIZE": settings.BASE_SIZE,
+        "IMAGE_SIZE": settings.IMAGE_SIZE,
+        "CROP_MODE": settings.CROP_MODE,
+        "MIN_CROPS": settings.MIN_CROPS,
+        "MAX_CROPS": settings.MAX_CROPS,
+        "DECODE_DOWNSCALE": settings.DECODE_DOWNSCALE,
+        "PROMPT": settings.PROMPT,
+        "MODEL_PATH": settings.MODEL_PATH,
+        "max_tokens": sampling_params.max_tokens,
+        "ngram": [(lp.ngram_size, lp.window_size) for lp in logits_processors],
+    }
+    return make_cache_key("ocr", digest or sha256_file(image_path), ocr_settings)
+
 class Colors:
     RED = '\033[31m'
     GREEN = '\033[32m'
@@ -78,84 +163,484 @@ def re_match(text):
         mathes_other.append(a_match[0])
     return matches, mathes_other
 
-def process_single_image(image):
-    """single image"""
-    prompt_in = prompt
+def image_id(image_path):
+    """path relative to INPUT_PATH without extension (Coopmart/1), the same ID as the manifest and outputs"""
+    return relative_image_id(image_path, settings.INPUT_PATH)
+
+
+def process_single_image(image, name=None):
+    """single image (name only labels the trace span)"""
+    prompt_in = settings.PROMPT
+    with tracer.span("tokenize_with_images", image=name):
+        image_input = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=settings.CROP_MODE)
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": image_input},
     }
     return cache_item
 
 
-if __name__ == "__main__":
+def num_visual_tokens(request):
+    """image tokens of a process_single_image request (num_image_tokens from tokenize_with_images)"""
+    return sum(request["multi_modal_data"]["image"][0][5])
 
-    # INPUT_PATH = OmniDocBench images path
 
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
+def record_ocr_output(request, output):
+    IMAGES_PROCESSED.inc(stage="ocr")
+    VISUAL_TOKENS.observe(num_visual_tokens(request))
+    GENERATED_TOKENS.observe(len(output.outputs[0].token_ids), stage="ocr")
 
-    # print('image processing until processing prompts.....')
 
-    print(f'{Colors.RED}glob images.....{Colors.RESET}')
+def record_ledger(image_path, size, output, seconds):
+    """token ledger row for one OCR'd image: visual tokens + crop grid, output tokens, wall time"""
+    if not ledger.enabled:
+        return
+    visual_tokens, crop_ratio = image_token_layout(*size)
+    metrics = getattr(output, "metrics", None)
+    if metrics is not None and metrics.finished_time and metrics.arrival_time:
+        seconds = metrics.finished_time - (metrics.first_scheduled_time or metrics.arrival_time)
+    ledger.record(image_id(image_path), retailer=retailer_of(image_path), width=size[0], height=size[1],
+                  crop_ratio=crop_ratio, visual_tokens=visual_tokens,
+                  ocr_output_tokens=len(output.outputs[0].token_ids), ocr_seconds=seconds)
 
-    images_path = glob.glob(f'{INPUT_PATH}/*')
 
+def load_images(images_path):
     images = []
 
     for image_path in images_path:
-        image = Image.open(image_path).convert('RGB')
+        # upright RGB, large JPEGs decoded at reduced scale (DECODE_DOWNSCALE)
+        image = load_image(image_path)
         images.append(image)
 
-    prompt = PROMPT
+    return images
+
+
+def try_load_image(image_path):
+    """Decode one image, None (and a printed error) if the file is unreadable."""
+    try:
+        with tracer.span("file_decode", image=image_id(image_path)):
+            return load_images([image_path])[0]
+    except Exception as e:
+        print(f'{Colors.RED}failed to load {image_path}: {e}{Colors.RESET}')
+        FAILURES.inc(stage="ocr", reason="decode")
+        return None
+
+
+_preprocess_pool = None
+
+
+def start_preprocess_pool():
+    """Start the worker processes when PREPROCESS_MODE is 'process' (None in thread mode).
+
+    Call it before the engine is built, so the workers fork from a process without a CUDA context.
+    """
+    global _preprocess_pool
+    if _preprocess_pool is None and settings.PREPROCESS_MODE == 'process':
+        _preprocess_pool = PreprocessPool(settings.NUM_WORKERS)
+    return _preprocess_pool
+
+
+def stop_preprocess_pool():
+    global _preprocess_pool
+    if _preprocess_pool is not None:
+        _preprocess_pool.shutdown()
+        _preprocess_pool = None
+
+
+def _preprocess_in_pool(image_path):
+    """decode + tokenize in a worker process -> (size, request), (None, None) if the image is unreadable"""
+    # one span for both steps, they run back to back in the worker
+    with tracer.span("tokenize_with_images", image=image_id(image_path), mode="process"):
+        size, image_input, error = start_preprocess_pool().preprocess(image_path)
+    if error is not None:
+        print(f'{Colors.RED}failed to load {image_path}: {error}{Colors.RESET}')
+        FAILURES.inc(stage="ocr", reason="decode")
+        return None, None
+    return size, {"prompt": settings.PROMPT, "multi_modal_data": {"image": image_input}}
+
+
+_preprocess_cache = None
+
+
+def use_preprocess_cache(cache):
+    """Cache pre-processed tensors in this TensorCache from now on (None turns it off)."""
+    global _preprocess_cache
+    _preprocess_cache = cache
+
+
+def _load_preprocessed(image_path, key):
+    """cached tensors -> (size, request) for the current prompt, None on a miss"""
+    hit = _preprocess_cache.get(key)
+    if hit is None:
+        return None
+    arrays, meta = hit
+    # only the token layout depends on the prompt; it is rebuilt from the cached crop ratio
+    with tracer.span("tokenize_with_images", image=image_id(image_path), cached=True):
+        input_ids, images_seq_mask, num_image_tokens = DeepseekOCRProcessor().tokenize_layout(meta["crop_ratios"])
+    image_input = [[input_ids, torch.from_numpy(arrays["pixel_values"]), torch.from_numpy(arrays["images_crop"]),
+                    images_seq_mask, torch.tensor(meta["crop_ratios"], dtype=torch.long), num_image_tokens,
+                    [tuple(shape) for shape in meta["image_shapes"]]]]
+    return tuple(meta["size"]), {"prompt": settings.PROMPT, "multi_modal_data": {"image": image_input}}
+
+
+def _store_preprocessed(key, size, request):
+    _, pixel_values, images_crop, _, images_spatial_crop, _, image_shapes = request["multi_modal_data"]["image"][0]
+    _preprocess_cache.put(key, {"pixel_values": pixel_values.numpy(), "images_crop": images_crop.numpy()},
+                          {"size": list(size), "crop_ratios": images_spatial_crop.tolist(),
+                           "image_shapes": [list(shape) for shape in image_shapes]})
+
+
+def decode_and_tokenize(image_path, digest=None, checkpoint_load=False):
+    """(size, request) for one image, (None, None) if it could not be decoded.
+
+    Runs in the calling thread, or in a worker process when PREPROCESS_MODE is 'process';
+    either way the PIL image is dropped here, only the tensors are kept.
+    With a preprocess cache, cached images skip decoding and tiling altogether.
+    checkpoint_load records the 'image_load' memory checkpoint right after the decode
+    (iter_ocr_chunks asks for it once per chunk).
+    """
+    key = None
+    if _preprocess_cache is not None:
+        key = preprocess_cache_key(image_path, digest)
+        cached = _load_preprocessed(image_path, key)
+        if cached is not None:
+            return cached
+    if settings.PREPROCESS_MODE == 'process':
+        size, request = _preprocess_in_pool(image_path)
+        if checkpoint_load:
+            # the decode happened in a worker process: only this process' RSS and the tensors are visible
+            memory_profiler.checkpoint("image_load", mode="process")
+    else:
+        image = try_load_image(image_path)
+        if image is None:
+            return None, None
+        if checkpoint_load:
+            # the decoded image (and those of the other prefetch threads) are still alive here
+            memory_profiler.checkpoint("image_load", width=image.width, height=image.height)
+        size, request = image.size, process_single_image(image, image_id(image_path))
+    if key is not None and request is not None:
+        _store_preprocessed(key, size, request)
+    return size, request
+
+
+def _prepare_one(image_path, cache, checkpoint_load=False):
+    """worker: cache lookup, else decode + tokenize.
+
+    Returns (key, hit, size, request); hit is the cached result, request is None if the
+    image could not be decoded.
+    """
+    key = digest = None
+    if cache is not None:
+        # hash the file once for both caches
+        digest = sha256_file(image_path)
+        key = ocr_cache_key(image_path, digest)
+        hit = cache.get(key)
+        if hit is not None:
+            return key, hit, None, None
+    return (key, None) + decode_and_tokenize(image_path, digest, checkpoint_load)
+
+
+def prepare_images(images_path, cache=None, prefetch=None, chunk_size=None):
+    """Yield (index, key, hit, size, request) for every image, in input order.
+
+    Images are decoded / pre-processed by NUM_WORKERS threads, at most `prefetch` ahead
+    of the consumer, so they keep going while the consumer waits on llm.generate but
+    never pile up for the whole folder.
+    With memory profiling on, the last image of every chunk_size images records the
+    'image_load' checkpoint after it is decoded.
+    """
+    prefetch = max(1, prefetch or settings.PREFETCH_IMAGES)
+    paths = iter(enumerate(images_path))
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=settings.NUM_WORKERS) as executor:
+
+        def submit_next():
+            for index, image_path in itertools.islice(paths, 1):
+                checkpoint_load = memory_profiler.enabled and bool(chunk_size) and (
+                    (index + 1) % chunk_size == 0 or index == len(images_path) - 1)
+                in_flight.append((index, executor.submit(_prepare_one, image_path, cache, checkpoint_load)))
+
+        for _ in range(prefetch):
+            submit_next()
+        while in_flight:
+            index, future = in_flight.popleft()
+            submit_next()
+            yield (index,) + future.result()
+
+
+def clean_output(content):
+    """raw model output (the _det.md content) -> cleaned markdown (the .md content)"""
+    content = clean_formula(content)
+    matches_ref, mathes_other = re_match(content)
+    for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
+        content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+    return content
+
+
+def trace_request(output, name):
+    """per-image ocr_generate span from vLLM's request metrics (scheduled -> finished)"""
+    metrics = getattr(output, "metrics", None)
+    if not tracer.enabled or metrics is None or not metrics.finished_time:
+        return
+    start = metrics.first_scheduled_time or metrics.arrival_time
+    tracer.add_wall("ocr_generate", start, metrics.finished_time, image=name,
+                    output_tokens=len(output.outputs[0].token_ids))
+
+
+def _ocr_batch(llm, images_path, batch, cache):
+    """llm.generate one chunk of (index, key, size, request) -> [(index, (raw_text, cleaned_markdown))]"""
+    if not batch:
+        return []
+    miss_indices, miss_keys, sizes, batch_inputs = (list(column) for column in zip(*batch))
+    memory_profiler.checkpoint("preprocessing", images=len(batch_inputs))
+
+    start = time.perf_counter()
+    try:
+        with tracer.span("ocr_generate_batch", images=len(batch_inputs)):
+            outputs_list = llm.generate(
+                batch_inputs,
+                sampling_params=sampling_params
+            )
+    except Exception:
+        FAILURES.inc(len(batch_inputs), stage="ocr", reason="generate")
+        raise
+    elapsed = time.perf_counter() - start
+    generated = sum(len(output.outputs[0].token_ids) for output in outputs_list)
+    TOKENS_PER_SECOND.set(generated / max(elapsed, 1e-9), stage="ocr")
+    memory_profiler.checkpoint("generate", images=len(outputs_list))
+
+    results = []
+    for index, key, request, size, output in zip(miss_indices, miss_keys, batch_inputs, sizes, outputs_list):
+        name = image_id(images_path[index])
+        trace_request(output, name)
+        record_ocr_output(request, output)
+        # without vLLM request metrics, the batch time is split evenly over its images
+        record_ledger(images_path[index], size, output, elapsed / len(outputs_list))
+        content = output.outputs[0].text
+        with tracer.span("markdown_cleanup", image=name):
+            result = (content, clean_output(content))
+        results.append((index, result))
+        if cache is not None:
+            cache.put(key, {"raw": result[0], "markdown": result[1]})
+    memory_profiler.checkpoint("post_processing", images=len(outputs_list))
+    return results
+
+
+def iter_ocr_chunks(llm, images_path, cache=None, chunk_size=None, prefetch=None):
+    """OCR a list of image paths with an already loaded engine, one chunk at a time.
+
+    Yields a list of (index, result) per chunk of at most chunk_size images (default
+    OCR_CHUNK_SIZE), result = (raw_text, cleaned_markdown), or None for images that could
+    not be decoded. The next images are decoded / pre-processed in the background while
+    a chunk is generating, and a chunk's tensors are released before it is yielded, so
+    peak RAM depends on chunk_size + prefetch, not on len(images_path).
+    With a cache, only the cache misses are decoded and sent to llm.generate.
+    """
+    chunk_size = chunk_size or settings.OCR_CHUNK_SIZE
+    done, batch = [], []
+    prepared = tqdm(prepare_images(images_path, cache, prefetch, chunk_size), total=len(images_path),
+                    desc="Pre-processed images")
+    for index, key, hit, size, request in prepared:
+        if hit is not None:
+            IMAGES_PROCESSED.inc(stage="ocr")
+            done.append((index, (hit["raw"], hit["markdown"])))
+        elif request is None:
+            done.append((index, None))
+        else:
+            batch.append((index, key, size, request))
+        del request
+        if len(done) + len(batch) >= chunk_size:
+            # drop our references to the chunk's tensors before handing the results out
+            chunk, done, batch = sorted(done + _ocr_batch(llm, images_path, batch, cache)), [], []
+            yield chunk
+    if done or batch:
+        yield sorted(done + _ocr_batch(llm, images_path, batch, cache))
+
+
+def run_ocr(llm, images_path, cache=None):
+    """OCR a list of image paths with an already loaded engine.
+
+    Returns a list of (raw_text, cleaned_markdown), in the same order as images_path;
+    the entry is None for images that could not be decoded.
+    Work is done in chunks (see iter_ocr_chunks), so memory does not grow with the list.
+    """
+    results = [None] * len(images_path)
+    for chunk in iter_ocr_chunks(llm, images_path, cache=cache):
+        for index, result in chunk:
+            results[index] = result
+    return results
+
+
+async def _stream_ocr_one(engine, index, image_path, cache):
+    key = digest = None
+    if cache is not None:
+        # hash the file once for both caches; hashing and SQLite stay off the event loop
+        digest = await asyncio.to_thread(sha256_file, image_path)
+        key = ocr_cache_key(image_path, digest)
+        hit = await asyncio.to_thread(cache.get, key)
+        if hit is not None:
+            IMAGES_PROCESSED.inc(stage="ocr")
+            return index, hit["raw"], hit["markdown"]
+
+    size, request = await asyncio.to_thread(decode_and_tokenize, image_path, digest)
+    if request is None:
+        return index, None, None
+    name = image_id(image_path)
+
+    final_output = None
+    start = time.perf_counter()
+    try:
+        with tracer.span("ocr_generate", image=name):
+            async for request_output in engine.generate(request, sampling_params, f"ocr-{index}-{uuid.uuid4().hex}"):
+                final_output = request_output
+    except Exception:
+        FAILURES.inc(stage="ocr", reason="generate")
+        raise
+    elapsed = time.perf_counter() - start
+    record_ocr_output(request, final_output)
+    record_ledger(image_path, size, final_output, elapsed)
+    TOKENS_PER_SECOND.set(len(final_output.outputs[0].token_ids) / max(elapsed, 1e-9), stage="ocr")
+
+    content = final_output.outputs[0].text
+    with tracer.span("markdown_cleanup", image=name):
+        markdown = clean_output(content)
+    if cache is not None:
+        await asyncio.to_thread(cache.put, key, {"raw": content, "markdown": markdown})
+    return index, content, markdown
+
+
+async def stream_ocr(engine, images_path, max_concurrency=None, cache=None):
+    """OCR images on an AsyncLLMEngine and yield (index, raw_text, cleaned_markdown)
+    as soon as each image finishes, i.e. in completion order, not input order.
+    raw_text / cleaned_markdown are None for images that could not be decoded.
+
+    At most max_concurrency images are in flight (hashing / cache lookup / decoding / generating,
+    or finished and waiting to be consumed); the next image is only started once the caller takes
+    a result, so a slow consumer holds back the producer instead of results piling up.
+    Cache hits are yielded without touching the engine.
+    """
+    limit = max_concurrency or settings.MAX_CONCURRENCY
+    remaining = enumerate(images_path)
+    running = set()
+    try:
+        while True:
+            for index, image_path in itertools.islice(remaining, limit - len(running)):
+                running.add(asyncio.create_task(_stream_ocr_one(engine, index, image_path, cache)))
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in running:
+            task.cancel()
 
-    # batch_inputs = []
 
+if __name__ == "__main__":
 
-    # for image in tqdm(images):
+    # every config.py setting can be overridden here, e.g. --input_path /data/in --output_path /data/out --ocr_mode base
+    # --num-shards N --shard-id K: this worker only OCRs its slice of the input tree
+    parser = add_profile_args(add_shard_args(settings.add_cli_args(argparse.ArgumentParser())), 'ocr_profile.collapsed')
+    parser.add_argument('--trace', nargs='?', const='ocr_trace.json', default=None,
+                        help='record per-image spans, save a Chrome/Perfetto trace to this file')
+    parser.add_argument('--token_ledger', nargs='?', const='ocr_token_ledger.json', default=None,
+                        help='write per-image visual / output token counts (by retailer folder) to this file')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='record RSS, tracemalloc top allocators and live tensor bytes after each stage')
+    parser.add_argument('--metrics_file', default=None,
+                        help='write Prometheus metrics (images, failures, tokens, ...) to this file at the end')
+    args = parser.parse_args()
+    settings.update_from_args(args)
+    if args.trace:
+        tracer.enable()
+    if args.token_ledger:
+        ledger.enable()
+    if args.profile_memory:
+        memory_profiler.enable()
 
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": Image.open(image).convert('RGB')},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
+    # INPUT_PATH = OmniDocBench images path
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+    os.makedirs(settings.OUTPUT_PATH, exist_ok=True)
 
+    print(f'{Colors.RED}discover images.....{Colors.RESET}')
 
-    
+    # recursive (INPUT_PATH/<Retailer>/...), partitioned by a stable hash of the relative path
+    images_path = select_shard(discover_images(settings.INPUT_PATH), settings.INPUT_PATH,
+                               args.num_shards, args.shard_id)
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
+    # resume: only images that were not OCR'd by a previous (interrupted) run into this OUTPUT_PATH
+    manifest = JobManifest(os.path.join(settings.OUTPUT_PATH, '.manifest.sqlite'))
+    # inputs/A/1.jpg and inputs/B/1.jpg are A/1 and B/1: separate manifest rows and output files
+    image_ids = {p: image_id(p) for p in images_path}
+    manifest.add_images((image_id, p) for p, image_id in image_ids.items())
+    states = manifest.states()
+    pending = [p for p in images_path if states[image_ids[p]] in (DISCOVERED, FAILED)]
+    print(f'{Colors.GREEN}{len(pending)}/{len(images_path)} images left to OCR{Colors.RESET}')
 
+    # PREPROCESS_MODE=process: fork the pre-processing workers before the engine takes the GPU
+    start_preprocess_pool()
+    llm = build_llm()
+    cache = build_ocr_cache()
+    use_preprocess_cache(build_preprocess_cache())
 
-    output_path = OUTPUT_PATH
+    # --profile: sample the OCR loop only, not the engine start-up
+    profiler = profiler_from_args(args)
+    if profiler is not None:
+        profiler.start()
 
-    os.makedirs(output_path, exist_ok=True)
+    output_path = settings.OUTPUT_PATH
 
-    for output, image in zip(outputs_list, images_path):
+    # images are decoded ahead in the background; outputs are written and checkpointed per chunk
+    for chunk in iter_ocr_chunks(llm, pending, cache=cache):
 
-        content = output.outputs[0].text
-        mmd_det_path = output_path + image.split('/')[-1].replace('.jpg', '_det.md')
+        done, failed = [], []
 
-        with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-            afile.write(content)
+        for index, result in chunk:
+            image = pending[index]
 
-        content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
-        
-        mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
+            if result is None:
+                failed.append((image_ids[image], 'image could not be decoded'))
+                continue
+
+            raw_content, content = result
+
+            mmd_det_path = os.path.join(output_path, image_ids[image] + '_det.md')
+            mmd_path = os.path.join(output_path, image_ids[image] + '.md')
+            os.makedirs(os.path.dirname(mmd_path), exist_ok=True)
+
+            with tracer.span('file_write', image=image_ids[image]):
+                with open(mmd_det_path, 'w', encoding='utf-8') as afile:
+                    afile.write(raw_content)
+
+                with open(mmd_path, 'w', encoding='utf-8') as afile:
+                    afile.write(content)
+
+            done.append((image_ids[image], content))
+
+        # checkpoint once per chunk
+        manifest.mark_ocr_done(done)
+        manifest.mark_failed(failed)
+
+    finish_profile(profiler, args.profile)
+    stop_preprocess_pool()
+
+    print(manifest.format_counts())
+
+    if cache is not None:
+        print(cache.format_stats())
+    if _preprocess_cache is not None:
+        print(_preprocess_cache.format_stats())
+
+    if args.trace:
+        print(tracer.format_summary())
+        tracer.export(args.trace)
+
+    if args.metrics_file:
+        registry.write(args.metrics_file)
+
+    if args.token_ledger:
+        print(ledger.format_table())
+        ledger.write(args.token_ledger)
 
-        with open(mmd_path, 'w', encoding='utf-8') as afile:
-            afile.write(content)
+    if args.profile_memory:
+        print(memory_profiler.format_summary())
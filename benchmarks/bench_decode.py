@@ -0,0 +1,96 @@
+"""
+So sánh đọc ảnh đầy đủ (Image.open().convert('RGB')) với load_image của process/image_loader.py
+(DECODE_DOWNSCALE: JPEG lớn được giải mã ở 1/2, 1/4, 1/8 kích thước, vẫn đủ cho các tile + ảnh toàn cục).
+
+In thời gian giải mã, dung lượng ảnh đã giải mã và kiểm tra tỉ lệ cắt tile (crop ratio) không đổi.
+Không truyền --input_dir thì tạo ảnh JPEG tổng hợp 12 / 24 / 48 MP như ảnh chụp hoá đơn bằng điện thoại.
+
+    python benchmarks/bench_decode.py
+    python benchmarks/bench_decode.py --input_dir inputs --limit 50
+
+Không cần GPU / vLLM / tokenizer.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import DEEPSEEK_REPO_DIR
+from sharding import discover_images
+
+sys.path.insert(0, DEEPSEEK_REPO_DIR)
+from config import settings
+from process.image_loader import load_image, crop_ratio_for
+
+MB = 1024 * 1024
+# ảnh chụp điện thoại 12 / 24 / 48 MP (dọc, 3:4)
+PHOTO_SIZES = [(3024, 4032), (4240, 5656), (6000, 8000)]
+
+def synthetic_photos(directory):
+    rng = np.random.default_rng(0)
+    paths = []
+    for width, height in PHOTO_SIZES:
+        # nhiễu ở độ phân giải thấp rồi phóng to: giống ảnh chụp hơn nhiễu từng pixel, file nhỏ hơn
+        pixels = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+        path = os.path.join(directory, f"photo_{width}x{height}.jpg")
+        Image.fromarray(pixels).resize((width, height)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def timed(load, path, repeat):
+    best, image = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = load(path)
+        best = min(best, time.perf_counter() - start)
+    return best, image
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark giải mã ảnh: đầy đủ vs DECODE_DOWNSCALE")
+    parser.add_argument("--input_dir", default=None, help="Dùng ảnh thật trong thư mục này thay vì ảnh tổng hợp")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3, help="Lấy thời gian nhỏ nhất của N lần chạy")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.input_dir:
+        paths = discover_images(args.input_dir)[:args.limit]
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        paths = synthetic_photos(tmp_dir.name)
+
+    print(f"CROP_MODE={settings.CROP_MODE}, BASE_SIZE={settings.BASE_SIZE}, IMAGE_SIZE={settings.IMAGE_SIZE}")
+    print(f"{'IMAGE':<24} {'FULL':>11} {'DECODED':>11} {'FULL (ms)':>10} {'LOAD (ms)':>10} {'SPEEDUP':>8} "
+          f"{'FULL MB':>8} {'MB':>6} {'RATIO':>6}")
+    total_full = total_reduced = 0.0
+    mismatches = 0
+    for path in paths:
+        full_time, full = timed(lambda p: Image.open(p).convert("RGB"), path, args.repeat)
+        reduced_time, reduced = timed(lambda p: load_image(p, downscale=True), path, args.repeat)
+        # load_image xoay ảnh theo EXIF -> so crop ratio với ảnh đầy đủ đã xoay
+        upright_full = load_image(path, downscale=False).size
+        ratio = crop_ratio_for(*upright_full)
+        if crop_ratio_for(*reduced.size) != ratio:
+            mismatches += 1
+        total_full += full_time
+        total_reduced += reduced_time
+        print(f"{os.path.basename(path)[:24]:<24} {f'{full.width}x{full.height}':>11} "
+              f"{f'{reduced.width}x{reduced.height}':>11} {full_time * 1000:>10.1f} {reduced_time * 1000:>10.1f} "
+              f"{full_time / reduced_time:>7.2f}x {full.width * full.height * 3 / MB:>8.1f} "
+              f"{reduced.width * reduced.height * 3 / MB:>6.1f} {'x'.join(map(str, ratio)):>6}")
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    print(f"Total: full {total_full * 1000:.0f} ms, load_image {total_reduced * 1000:.0f} ms "
+          f"({total_full / max(total_reduced, 1e-9):.2f}x)")
+    if mismatches:
+        print(f"{mismatches} images changed crop ratio")
+        sys.exit(1)
+    print("Crop ratios unchanged")
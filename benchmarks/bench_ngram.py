@@ -0,0 +1,139 @@
+"""
+Chi phí mỗi bước decode của NoRepeatNGramLogitsProcessor (quét lại cả cửa sổ mỗi token) so với
+IncrementalNoRepeatNGramLogitsProcessor (index rolling hash, cập nhật O(1) mỗi token).
+
+Giả lập như vLLM: mỗi chuỗi có processor riêng (SamplingParams.clone -> processor.clone()), mỗi bước
+gọi processor(token đã sinh, 1 hàng logits). Chuỗi token giả có đoạn lặp lại (bảng, dòng hàng hoá) để
+có n-gram bị cấm; kết quả 2 processor được so từng bước, khác nhau -> exit code 1.
+
+Phần 2 so cách áp lệnh cấm khi backend gọi processor theo batch: gọi từng hàng logits (1 index_fill_
+mỗi chuỗi) vs ban_ngrams_batch trên ma trận [num_seqs, vocab] (1 index_fill_ cho cả batch), cho cả 2 class
+(processor riêng mỗi chuỗi; NoRepeatNGramLogitsProcessor còn được chạy thêm với 1 processor dùng chung).
+Ma trận logits của 2 cách được so ở mọi bước, khác nhau -> exit code 1.
+
+    python benchmarks/bench_ngram.py --sequences 100 --tokens 1500
+
+Không cần GPU / vLLM.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import DEEPSEEK_REPO_DIR
+
+sys.path.insert(0, DEEPSEEK_REPO_DIR)
+from process.ngram_norepeat import (NoRepeatNGramLogitsProcessor, IncrementalNoRepeatNGramLogitsProcessor,
+                                   ban_ngrams_batch)
+
+OCR_VOCAB_SIZE = 129280
+WHITELIST = {128821, 128822}   # <td>, </td> như các runner
+# (ngram_size, window_size) của run_dpsk_ocr_eval_batch.py / run_dpsk_ocr_image.py / run_dpsk_ocr_pdf.py
+CONFIGS = [(40, 90), (30, 90), (20, 50)]
+
+def fake_ocr_tokens(length, repeat_prob, rng):
+    """Token ngẫu nhiên xen các đoạn copy lại từ phía trước (giống markdown bảng lặp cấu trúc)."""
+    tokens = []
+    while len(tokens) < length:
+        if len(tokens) >= 5 and rng.random() < repeat_prob:
+            span = rng.randint(5, min(len(tokens), 80))
+            start = rng.randint(max(0, len(tokens) - 300), len(tokens) - span)
+            tokens += tokens[start:start + span]
+        else:
+            tokens.append(rng.choice((128821, 128822)) if rng.random() < 0.05 else rng.randrange(1000, 100000))
+    return tokens[:length]
+
+def replay(processor_cls, ngram_size, window_size, sequences):
+    """-> (giây cho tất cả các bước, danh sách token bị cấm mỗi bước)"""
+    template = processor_cls(ngram_size=ngram_size, window_size=window_size, whitelist_token_ids=set(WHITELIST))
+    scores = torch.zeros(OCR_VOCAB_SIZE)
+    banned = []
+    elapsed = 0.0
+    for tokens in sequences:
+        processor = template.clone() if hasattr(template, "clone") else template
+        generated = []
+        for token in tokens:
+            start = time.perf_counter()
+            out = processor(generated, scores)
+            elapsed += time.perf_counter() - start
+            # processor ghi -inf thẳng vào scores: ghi lại rồi xoá, không tính vào thời gian
+            banned.append(torch.nonzero(torch.isinf(out)).flatten().tolist())
+            scores.zero_()
+            generated.append(token)
+    return elapsed, banned
+
+def replay_batch(processor_cls, ngram_size, window_size, sequences, mode):
+    """
+    Các chuỗi decode song song, mỗi bước 1 ma trận logits [num_seqs, vocab].
+    mode: "row" (gọi từng hàng), "batch" (ban_ngrams_batch, 1 processor mỗi chuỗi), "shared" (ban_ngrams_batch,
+    1 processor cho cả batch). -> (giây, danh sách hàng/token bị cấm mỗi bước)
+    """
+    template = processor_cls(ngram_size=ngram_size, window_size=window_size, whitelist_token_ids=set(WHITELIST))
+    processors = template if mode == "shared" else [
+        template.clone() if hasattr(template, "clone") else processor_cls(ngram_size, window_size, set(WHITELIST))
+        for _ in sequences]
+    logits = torch.zeros(len(sequences), OCR_VOCAB_SIZE)
+    elapsed = 0.0
+    banned = []
+    for step in range(min(len(tokens) for tokens in sequences)):
+        generated = [tokens[:step] for tokens in sequences]
+        start = time.perf_counter()
+        if mode == "row":
+            for row, (processor, input_ids) in enumerate(zip(processors, generated)):
+                processor(input_ids, logits[row])
+        else:
+            ban_ngrams_batch(processors, generated, logits)
+        elapsed += time.perf_counter() - start
+        banned.append(torch.nonzero(torch.isinf(logits)).tolist())
+        logits.zero_()
+    return elapsed, banned
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NoRepeatNGramLogitsProcessor: quét lại vs index tăng dần")
+    parser.add_argument("--sequences", type=int, default=20, help="Số chuỗi (MAX_CONCURRENCY của runner là 100)")
+    parser.add_argument("--tokens", type=int, default=1500, help="Số token sinh ra mỗi chuỗi")
+    parser.add_argument("--repeat_prob", type=float, default=0.15, help="Xác suất chèn 1 đoạn lặp lại")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sequences = [fake_ocr_tokens(args.tokens, args.repeat_prob, rng) for _ in range(args.sequences)]
+    steps = args.sequences * args.tokens
+    print(f"{args.sequences} sequences x {args.tokens} tokens = {steps} decode steps")
+    print(f"{'NGRAM':>5} {'WINDOW':>6} {'RESCAN (us/step)':>17} {'INCREMENTAL (us/step)':>22} {'SPEEDUP':>8} {'BANNED STEPS':>13}")
+    failed = False
+    for ngram_size, window_size in CONFIGS:
+        rescan_time, rescan_banned = replay(NoRepeatNGramLogitsProcessor, ngram_size, window_size, sequences)
+        incremental_time, incremental_banned = replay(IncrementalNoRepeatNGramLogitsProcessor, ngram_size, window_size,
+                                                      sequences)
+        if rescan_banned != incremental_banned:
+            failed = True
+        banned_steps = sum(1 for tokens in rescan_banned if tokens)
+        print(f"{ngram_size:>5} {window_size:>6} {rescan_time / steps * 1e6:>17.1f} "
+              f"{incremental_time / steps * 1e6:>22.1f} {rescan_time / incremental_time:>7.1f}x {banned_steps:>13}")
+
+    print(f"{'PROCESSOR':>11} {'NGRAM':>5} {'WINDOW':>6} {'PER ROW (us/batch step)':>24} "
+          f"{'BATCHED (us/batch step)':>24} {'SPEEDUP':>8}")
+    for processor_cls, label in ((NoRepeatNGramLogitsProcessor, "rescan"),
+                                 (IncrementalNoRepeatNGramLogitsProcessor, "incremental")):
+        for ngram_size, window_size in CONFIGS:
+            row_time, row_banned = replay_batch(processor_cls, ngram_size, window_size, sequences, "row")
+            batch_time, batch_banned = replay_batch(processor_cls, ngram_size, window_size, sequences, "batch")
+            if batch_banned != row_banned:
+                failed = True
+            if processor_cls is NoRepeatNGramLogitsProcessor:
+                _, shared_banned = replay_batch(processor_cls, ngram_size, window_size, sequences, "shared")
+                if shared_banned != row_banned:
+                    failed = True
+            print(f"{label:>11} {ngram_size:>5} {window_size:>6} {row_time / args.tokens * 1e6:>24.1f} "
+                  f"{batch_time / args.tokens * 1e6:>24.1f} {row_time / batch_time:>7.1f}x")
+    if failed:
+        print("Banned tokens differ between the processors / ban paths")
+        sys.exit(1)
+    print("Banned tokens identical at every step")
@@ -0,0 +1,335 @@
+"""
+Benchmark phần CPU của pipeline (đọc ảnh, tiền xử lý, hậu xử lý, trích xuất JSON, đánh giá) không cần GPU.
+
+Chạy đúng các stage của master_pipeline.py (OCRStage, ExtractionStage, EvaluationStage qua Pipeline.run)
+nhưng thay 2 model bằng backend giả:
+  - OCR: thay vllm.LLM.generate, trả lại markdown đã ghi trong ocr_outputs/ (ưu tiên file *_det.md
+    nếu có) sau --ocr_batch_ms + --ocr_image_ms * số ảnh;
+  - trích xuất: thay model.generate (+ tokenizer) của deepseek_llm_7b.py, trả lại JSON trong outputs/
+    sau --llm_ms mỗi ảnh.
+Độ trễ giả dùng time.sleep nên không tính vào CPU time: số liệu CPU chỉ là phần việc của code pipeline.
+
+Folder inputs/ được nhân lên --replicas lần (symlink, giữ folder retailer), ground truth cũng được
+nhân theo để stage đánh giá chấm đủ mọi ảnh. Điểm số không có ý nghĩa vì JSON được trả lại xoay vòng.
+
+    python benchmarks/bench_pipeline.py --replicas 10
+    python benchmarks/bench_pipeline.py --replicas 4 --ocr_image_ms 200 --llm_ms 1500 --json_out bench.json
+    python benchmarks/bench_pipeline.py --logits_processors    # chạy cả NoRepeatNGramLogitsProcessor trên token giả
+
+Vẫn cần import được vLLM (bản CPU là đủ) vì stage OCR dùng run_dpsk_ocr_eval_batch.py thật.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import argparse
+import tempfile
+import itertools
+import threading
+import contextlib
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import Pipeline, OCRStage, ExtractionStage, EvaluationStage, discover_images
+from sharding import IMAGE_EXTENSIONS
+from memprofile import current_rss, peak_rss, MB
+
+OCR_VOCAB_SIZE = 129280   # vocab của DeepSeek-OCR (kích thước 1 hàng logits)
+
+# =============================================================================
+# 1. DỮ LIỆU GHI SẴN
+# =============================================================================
+
+def load_recorded_markdown(ocr_dir: str) -> List[str]:
+    """Output OCR đã ghi: *_det.md (output thô của model) nếu có, không thì *.md đã làm sạch."""
+    paths = sorted(glob.glob(os.path.join(ocr_dir, "**", "*_det.md"), recursive=True))
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(ocr_dir, "**", "*.md"), recursive=True))
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    if not texts:
+        raise SystemExit(f"No recorded OCR markdown in '{ocr_dir}'")
+    return texts
+
+def load_recorded_json(json_dir: str) -> List[str]:
+    texts = []
+    for path in sorted(glob.glob(os.path.join(json_dir, "**", "*.json"), recursive=True)):
+        if os.path.basename(path).startswith("ERROR_"):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    if not texts:
+        raise SystemExit(f"No recorded extraction JSON in '{json_dir}'")
+    return texts
+
+def replica_name(name: str, k: int) -> str:
+    return name if k == 0 else f"{name}__r{k}"
+
+def replicate_corpus(input_dir: str, gt_dir: str, work_dir: str, replicas: int):
+    """Nhân inputs/ (và ground truth) replicas lần bằng symlink, trả về (folder ảnh, folder GT)."""
+    image_dir = os.path.join(work_dir, "inputs")
+    replica_gt_dir = os.path.join(work_dir, "ground_truth")
+    for src_dir, dst_dir, extensions in ((input_dir, image_dir, IMAGE_EXTENSIONS), (gt_dir, replica_gt_dir, (".json",))):
+        for root, _, files in os.walk(src_dir):
+            rel = os.path.relpath(root, src_dir)
+            for fn in files:
+                stem, ext = os.path.splitext(fn)
+                if ext.lower() not in extensions:
+                    continue
+                os.makedirs(os.path.join(dst_dir, rel), exist_ok=True)
+                for k in range(replicas):
+                    os.symlink(os.path.abspath(os.path.join(root, fn)),
+                               os.path.join(dst_dir, rel, replica_name(stem, k) + ext))
+    return image_dir, replica_gt_dir
+
+# =============================================================================
+# 2. BACKEND GIẢ
+# =============================================================================
+
+def fake_token_ids(text: str, vocab_size: int) -> List[int]:
+    """1 token giả cho mỗi từ (cùng từ -> cùng id), đủ để số token và các n-gram lặp lại giống thật."""
+    return [zlib.crc32(word.encode("utf-8")) % vocab_size for word in text.split()]
+
+@dataclass
+class FakeCompletionOutput:
+    text: str
+    token_ids: List[int]
+
+@dataclass
+class FakeRequestOutput:
+    outputs: List[FakeCompletionOutput]
+    metrics: None = None   # Không có RequestMetrics -> runner chia đều thời gian batch cho từng ảnh
+
+class FakeOCRLLM:
+    """Thay vllm.LLM: generate() trả markdown ghi sẵn (xoay vòng) sau độ trễ giả."""
+
+    def __init__(self, texts: List[str], batch_latency: float = 0.0, image_latency: float = 0.0,
+                 run_logits_processors: bool = False, vocab_size: int = OCR_VOCAB_SIZE):
+        self.texts = itertools.cycle(texts)
+        self.batch_latency = batch_latency
+        self.image_latency = image_latency
+        self.run_logits_processors = run_logits_processors
+        self.vocab_size = vocab_size
+
+    def _replay_logits_processors(self, token_ids: List[int], sampling_params):
+        # Giống vLLM: mỗi request có bản clone() riêng của processor (processor có trạng thái),
+        # mỗi bước decode gọi từng processor với các token đã sinh và 1 hàng logits
+        processors = [p.clone() if hasattr(p, "clone") else p for p in sampling_params.logits_processors or []]
+        scores = torch.zeros(self.vocab_size)
+        generated = []
+        for token in token_ids:
+            for processor in processors:
+                scores = processor(generated, scores)
+            generated.append(token)
+
+    def generate(self, requests, sampling_params=None, **kwargs):
+        outputs = []
+        for _ in requests:
+            text = next(self.texts)
+            token_ids = fake_token_ids(text, self.vocab_size)
+            if self.run_logits_processors and sampling_params is not None:
+                self._replay_logits_processors(token_ids, sampling_params)
+            outputs.append(FakeRequestOutput([FakeCompletionOutput(text, token_ids)]))
+        time.sleep(self.batch_latency + self.image_latency * len(requests))
+        return outputs
+
+class FakeTokenizer:
+    """Thay tokenizer của deepseek_llm_7b.py: mỗi byte UTF-8 là 1 token (id = byte + 1, 0 là pad)."""
+    pad_token_id = 0
+    eos_token = ""
+
+    def apply_chat_template(self, messages, add_generation_prompt=True, return_tensors="pt"):
+        return self.encode("".join(m["content"] for m in messages))[None]
+
+    def encode(self, text: str) -> torch.Tensor:
+        return torch.tensor(list(text.encode("utf-8")), dtype=torch.long) + 1
+
+    def decode(self, token_ids, skip_special_tokens=True) -> str:
+        return bytes((token_ids - 1).tolist()).decode("utf-8", errors="ignore")
+
+class FakeExtractionModel:
+    """Thay model.generate: nối JSON ghi sẵn (xoay vòng) vào sau prompt, sau độ trễ giả."""
+    device = torch.device("cpu")
+
+    def __init__(self, tokenizer: FakeTokenizer, texts: List[str], latency: float = 0.0):
+        self.tokenizer = tokenizer
+        self.texts = itertools.cycle(texts)
+        self.latency = latency
+
+    def generate(self, input_ids, attention_mask=None, **generation_params):
+        output_ids = self.tokenizer.encode(next(self.texts))[None]
+        time.sleep(self.latency)
+        return torch.cat([input_ids, output_ids], dim=1)
+
+class FakeOCRStage(OCRStage):
+    def __init__(self, llm: FakeOCRLLM, **kwargs):
+        super().__init__(streaming=False, **kwargs)
+        self.fake_llm = llm
+
+    def build_engine(self, runner):
+        return self.fake_llm
+
+class FakeExtractionStage(ExtractionStage):
+    def __init__(self, output_dir: str, json_texts: List[str], latency: float = 0.0):
+        super().__init__(output_dir)
+        self.json_texts = json_texts
+        self.latency = latency
+
+    def load_model(self, llm_module):
+        # load_model() của deepseek_llm_7b trả về ngay khi model đã được gán
+        llm_module.tokenizer = FakeTokenizer()
+        llm_module.model = FakeExtractionModel(llm_module.tokenizer, self.json_texts, self.latency)
+
+# =============================================================================
+# 3. ĐO CPU / BỘ NHỚ THEO STAGE
+# =============================================================================
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    images: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float = 0.0
+
+@dataclass
+class StageMeter:
+    """
+    CPU time của cả process (gồm thread tiền xử lý) và đỉnh RSS trong lúc 1 stage chạy.
+    Pipeline.run chạy các stage lần lượt nên CPU time chia được theo stage.
+    """
+    poll_interval: float = 0.01
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def measure(self, name: str, images: int = 0):
+        stats = self.stages.setdefault(name, StageStats())
+        peak = [current_rss()]
+        stop = threading.Event()
+
+        def poll():
+            while not stop.wait(self.poll_interval):
+                peak[0] = max(peak[0], current_rss())
+
+        poller = threading.Thread(target=poll, name="rss-poller", daemon=True)
+        poller.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stats.wall_s += time.perf_counter() - wall
+            stats.cpu_s += time.process_time() - cpu
+            stop.set()
+            poller.join()
+            stats.calls += 1
+            stats.images += images
+            stats.peak_rss_mb = max(stats.peak_rss_mb, max(peak[0], current_rss()) / MB)
+
+    def wrap(self, stage, name: str):
+        """Đo mọi lần gọi stage.run (không sửa class của stage)."""
+        run = stage.run
+
+        def measured_run(results):
+            with self.measure(name, images=len(results)):
+                return run(results)
+        stage.run = measured_run
+
+# =============================================================================
+# 4. CHẠY
+# =============================================================================
+
+def run_benchmark(args) -> Dict:
+    markdown = load_recorded_markdown(args.ocr_dir)
+    json_texts = load_recorded_json(args.json_dir)
+    meter = StageMeter()
+
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as work_dir:
+        image_dir, gt_dir = replicate_corpus(args.input_dir, args.gt_dir, work_dir, args.replicas)
+        images = discover_images(image_dir)
+
+        ocr = FakeOCRStage(FakeOCRLLM(markdown, args.ocr_batch_ms / 1000, args.ocr_image_ms / 1000,
+                                      run_logits_processors=args.logits_processors))
+        extraction = FakeExtractionStage(os.path.join(work_dir, "outputs"), json_texts, args.llm_ms / 1000)
+        evaluation = EvaluationStage(gt_dir) if not args.no_evaluation else None
+        pipeline = Pipeline(ocr, extraction, evaluation, chunk_size=args.chunk_size, input_dir=image_dir)
+
+        with meter.measure("load"):
+            pipeline.load()
+        meter.wrap(ocr, "ocr")
+        meter.wrap(extraction, "extraction")
+        if evaluation is not None:
+            meter.wrap(evaluation, "evaluation")
+
+        # print() của từng ảnh cũng là chi phí thật nhưng làm bảng kết quả khó đọc
+        out = sys.stdout if args.verbose else open(os.devnull, "w")
+        with contextlib.redirect_stdout(out):
+            start, cpu_start = time.perf_counter(), time.process_time()
+            result = pipeline.run(images)
+            total_wall, total_cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        if out is not sys.stdout:
+            out.close()
+
+    return {
+        "images": len(images),
+        "replicas": args.replicas,
+        "ocr_latency_ms": {"batch": args.ocr_batch_ms, "image": args.ocr_image_ms},
+        "llm_latency_ms": args.llm_ms,
+        "logits_processors": args.logits_processors,
+        "pipeline_wall_s": round(result.wall_time, 3),
+        "images_per_sec": round(len(images) / result.wall_time, 2) if result.wall_time else 0.0,
+        "total_wall_s": round(total_wall, 3),
+        "total_cpu_s": round(total_cpu, 3),
+        "peak_rss_mb": round(peak_rss() / MB, 1),
+        "json_ok": sum(r.data is not None for r in result.results),
+        "stages": {name: {"calls": s.calls, "images": s.images, "wall_s": round(s.wall_s, 3),
+                          "cpu_s": round(s.cpu_s, 3), "peak_rss_mb": round(s.peak_rss_mb, 1)}
+                   for name, s in meter.stages.items()},
+    }
+
+def format_report(report: Dict) -> str:
+    lines = [f"{report['images']} images ({report['replicas']}x inputs), "
+             f"{report['json_ok']} JSON parsed, peak RSS {report['peak_rss_mb']:.1f} MB",
+             f"Throughput: {report['images_per_sec']:.2f} images/s "
+             f"(OCR + extraction {report['pipeline_wall_s']:.2f}s, with evaluation {report['total_wall_s']:.2f}s, "
+             f"CPU {report['total_cpu_s']:.2f}s)",
+             "",
+             f"{'STAGE':<12} {'CALLS':>6} {'WALL (s)':>9} {'CPU (s)':>9} {'CPU ms/IMG':>11} {'PEAK RSS (MB)':>14}"]
+    for name, s in report["stages"].items():
+        per_image = s["cpu_s"] * 1000 / s["images"] if s["images"] else 0.0
+        lines.append(f"{name:<12} {s['calls']:>6} {s['wall_s']:>9.2f} {s['cpu_s']:>9.2f} "
+                     f"{per_image:>11.1f} {s['peak_rss_mb']:>14.1f}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CPU của pipeline với backend OCR / LLM giả")
+    parser.add_argument("--input_dir", default=os.path.join(ROOT_DIR, "inputs"))
+    parser.add_argument("--gt_dir", default=os.path.join(ROOT_DIR, "ground_truth"))
+    parser.add_argument("--ocr_dir", default=os.path.join(ROOT_DIR, "ocr_outputs"), help="Markdown OCR ghi sẵn")
+    parser.add_argument("--json_dir", default=os.path.join(ROOT_DIR, "outputs"), help="JSON trích xuất ghi sẵn")
+    parser.add_argument("--replicas", type=int, default=4, help="Số lần nhân folder inputs/")
+    parser.add_argument("--ocr_batch_ms", type=float, default=0.0, help="Độ trễ giả mỗi lần llm.generate")
+    parser.add_argument("--ocr_image_ms", type=float, default=0.0, help="Độ trễ giả thêm cho mỗi ảnh OCR")
+    parser.add_argument("--llm_ms", type=float, default=0.0, help="Độ trễ giả mỗi lần model.generate (1 ảnh)")
+    parser.add_argument("--logits_processors", action="store_true",
+                        help="Gọi logits processor của OCR (no-repeat n-gram) cho từng token giả, như vLLM")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Chia ảnh thành chunk như master_pipeline.py")
+    parser.add_argument("--no_evaluation", action="store_true")
+    parser.add_argument("--json_out", default=None, help="Lưu kết quả ra file JSON (để so sánh giữa các commit)")
+    parser.add_argument("--verbose", action="store_true", help="In log của từng stage")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print(format_report(report))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved: {args.json_out}")
@@ -0,0 +1,84 @@
+"""
+So sánh tiền xử lý ảnh OCR (đọc ảnh + tokenize_with_images) chạy bằng thread và bằng process.
+
+tokenize_with_images chủ yếu là resize / crop của PIL và dựng list Python nên giữ GIL: thêm thread
+gần như không nhanh hơn. PREPROCESS_MODE=process (process/preprocess_pool.py) chạy trong nhiều
+process và trả pixel_values / images_crop qua file /dev/shm thay vì pickle.
+
+Các chế độ đo:
+  - thread:      ThreadPoolExecutor (như PREPROCESS_MODE=thread)
+  - process:     PreprocessPool, tensor trả về qua /dev/shm (như PREPROCESS_MODE=process)
+  - process_ipc: PreprocessPool(share=False), tensor đi qua cơ chế IPC mặc định của torch.multiprocessing
+
+    python benchmarks/bench_preprocess.py --workers 1,4,16,64 --replicas 2
+
+Thời gian khởi động pool process không tính vào ảnh/giây (được in riêng). Cần tokenizer của
+settings.MODEL_PATH (tải từ HuggingFace lần đầu), không cần GPU / vLLM.
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import DEEPSEEK_REPO_DIR
+from sharding import discover_images
+
+sys.path.insert(0, DEEPSEEK_REPO_DIR)
+from config import settings, get_tokenizer
+from process.preprocess_pool import PreprocessPool, decode_and_tokenize
+
+MODES = ("thread", "process", "process_ipc")
+
+def run_threads(images, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        for _ in executor.map(decode_and_tokenize, images):
+            pass
+        return time.perf_counter() - start, 0.0
+
+def run_processes(images, workers, share):
+    start = time.perf_counter()
+    with PreprocessPool(workers, share=share) as pool:
+        startup = time.perf_counter() - start
+        # Giống runner: các thread prefetch gọi pool.preprocess() rồi chờ kết quả
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            start = time.perf_counter()
+            for size, image_input, error in executor.map(pool.preprocess, images):
+                if error is not None:
+                    raise RuntimeError(error)
+            return time.perf_counter() - start, startup
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tiền xử lý OCR: thread vs process")
+    parser.add_argument("--input_dir", default=os.path.join(ROOT_DIR, "inputs"))
+    parser.add_argument("--workers", default="1,4,16,64", help="Danh sách số worker, cách nhau bởi dấu phẩy")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--replicas", type=int, default=2, help="Số lần lặp lại danh sách ảnh")
+    args = parser.parse_args()
+
+    images = discover_images(args.input_dir) * args.replicas
+    workers_list = [int(w) for w in args.workers.split(",")]
+    modes = args.modes.split(",")
+    get_tokenizer(settings.MODEL_PATH)  # Load tokenizer 1 lần trước khi fork / đo
+    print(f"{len(images)} images, {os.cpu_count()} CPUs, CROP_MODE={settings.CROP_MODE}")
+
+    rows = []
+    for workers in workers_list:
+        for mode in modes:
+            if mode == "thread":
+                elapsed, startup = run_threads(images, workers)
+            else:
+                elapsed, startup = run_processes(images, workers, share=(mode == "process"))
+            rows.append((mode, workers, elapsed, startup))
+            print(f"  {mode:<12} workers={workers:<3} {len(images) / elapsed:7.2f} images/s")
+
+    baseline = next((len(images) / e for m, w, e, _ in rows if m == "thread" and w == workers_list[0]), None)
+    print(f"\n{'MODE':<12} {'WORKERS':>7} {'TIME (s)':>9} {'IMAGES/s':>9} {'SPEEDUP':>8} {'POOL START (s)':>15}")
+    for mode, workers, elapsed, startup in rows:
+        rate = len(images) / elapsed
+        speedup = f"{rate / baseline:.2f}x" if baseline else "-"
+        print(f"{mode:<12} {workers:>7} {elapsed:>9.2f} {rate:>9.2f} {speedup:>8} {startup:>15.2f}")
@@ -0,0 +1,71 @@
+"""
+So sánh chế độ batch (OCR hết cả folder rồi mới trích xuất) với chế độ streaming
+(OCR xong ảnh nào trích xuất ảnh đó) trên cùng 1 folder ảnh.
+
+Đo 2 chỉ số, không tính thời gian load model:
+  - time-to-first-JSON: từ lúc bắt đầu tới khi có file JSON đầu tiên
+  - total wall time:    từ lúc bắt đầu tới khi trích xuất xong ảnh cuối cùng
+
+Mỗi chế độ chạy trong 1 process riêng để 2 engine vLLM không cùng chiếm GPU.
+
+    python benchmarks/bench_streaming.py --input_dir inputs/Coopmart
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+RESULT_PREFIX = "BENCH_RESULT "
+
+def run_mode(mode, input_dir, queue_size):
+    from pipeline import Pipeline, OCRStage, ExtractionStage, discover_images
+
+    images = discover_images(input_dir)
+    with tempfile.TemporaryDirectory(prefix=f"bench_{mode}_") as output_dir:
+        pipeline = Pipeline(OCRStage(streaming=(mode == "stream")), ExtractionStage(output_dir))
+        pipeline.load()
+        if mode == "stream":
+            result = pipeline.run_streaming(images, queue_size=queue_size)
+        else:
+            result = pipeline.run(images)
+
+    print(RESULT_PREFIX + json.dumps({
+        "mode": mode,
+        "images": len(images),
+        "time_to_first_json": result.time_to_first_json,
+        "wall_time": result.wall_time,
+    }))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", required=True, help="Folder ảnh để benchmark")
+    parser.add_argument("--queue_size", type=int, default=8)
+    parser.add_argument("--mode", choices=["batch", "stream"], help="Chỉ chạy 1 chế độ trong process hiện tại")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.input_dir, args.queue_size)
+        sys.exit(0)
+
+    rows = []
+    for mode in ["batch", "stream"]:
+        print(f"\n>>> Benchmark mode: {mode}")
+        command = [sys.executable, os.path.abspath(__file__), "--mode", mode,
+                   "--input_dir", args.input_dir, "--queue_size", str(args.queue_size)]
+        proc = subprocess.run(command, capture_output=True, text=True, cwd=ROOT_DIR)
+        lines = [l for l in proc.stdout.splitlines() if l.startswith(RESULT_PREFIX)]
+        if proc.returncode != 0 or not lines:
+            print(proc.stdout[-2000:])
+            print(proc.stderr[-2000:])
+            sys.exit(f"Benchmark mode '{mode}' failed")
+        rows.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+
+    print(f"\n{'MODE':<8} {'IMAGES':>7} {'FIRST JSON (s)':>15} {'TOTAL (s)':>10} {'s/IMAGE':>8}")
+    for r in rows:
+        per_image = r["wall_time"] / r["images"] if r["images"] else 0.0
+        print(f"{r['mode']:<8} {r['images']:>7} {r['time_to_first_json']:>15.2f} {r['wall_time']:>10.2f} {per_image:>8.2f}")
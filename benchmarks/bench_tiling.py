@@ -0,0 +1,109 @@
+"""
+Microbenchmark tiền xử lý 1 ảnh: PREPROCESS_ENGINE=pil (crop + ToTensor/Normalize từng tile) và
+PREPROCESS_ENGINE=tensor (resize 1 lần, cắt tile bằng reshape/permute, pad + normalize theo batch).
+
+Đo tokenize_with_images trên ảnh tổng hợp với các tỉ lệ hay gặp của hoá đơn (bill nhiệt dài, A4, ảnh
+chụp điện thoại), cho cả UINT8_TILES bật và tắt, và kiểm tra 2 engine cho ra cùng tensor (max abs diff).
+
+    python benchmarks/bench_tiling.py --repeat 5
+    python benchmarks/bench_tiling.py --input_dir inputs --limit 20   # dùng ảnh thật thay vì ảnh tổng hợp
+
+Cần tokenizer của settings.MODEL_PATH (tải từ HuggingFace lần đầu), không cần GPU / vLLM.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import DEEPSEEK_REPO_DIR
+from sharding import discover_images
+
+sys.path.insert(0, DEEPSEEK_REPO_DIR)
+from config import settings
+from process.image_process import DeepseekOCRProcessor
+
+# (tên, rộng, cao) - kích thước ảnh hoá đơn hay gặp
+RECEIPT_SIZES = [
+    ("thermal 58mm", 384, 1600),
+    ("thermal 80mm", 576, 2200),
+    ("phone 9:16", 720, 1280),
+    ("phone 3:4", 1536, 2048),
+    ("A4 150dpi", 1240, 1754),
+    ("A4 300dpi", 2480, 3508),
+    ("landscape", 1600, 900),
+    ("small", 600, 500),
+]
+
+def synthetic_receipt(width, height, seed=0):
+    """Nền trắng + nhiễu + các dòng "chữ" tối, đủ chi tiết để resize không bị tối ưu tắt."""
+    rng = np.random.default_rng(seed)
+    pixels = np.full((height, width, 3), 235, dtype=np.uint8)
+    pixels += rng.integers(0, 20, size=pixels.shape, dtype=np.uint8)
+    for top in range(20, height - 20, 28):
+        pixels[top:top + 12, 15:width - rng.integers(15, width // 2)] = rng.integers(0, 80)
+    return Image.fromarray(pixels)
+
+def run_engine(engine, image, repeat):
+    settings.update(PREPROCESS_ENGINE=engine)
+    processor = DeepseekOCRProcessor()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = processor.tokenize_with_images(images=[image], bos=True, eos=True, cropping=settings.CROP_MODE)[0]
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+def max_diff(a, b):
+    _, pixels_a, crops_a, *_ = a
+    _, pixels_b, crops_b, *_ = b
+    if pixels_a.shape != pixels_b.shape or crops_a.shape != crops_b.shape:
+        return float("inf")
+    return max((pixels_a.float() - pixels_b.float()).abs().max().item(),
+               (crops_a.float() - crops_b.float()).abs().max().item())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark PREPROCESS_ENGINE pil vs tensor")
+    parser.add_argument("--input_dir", default=None, help="Dùng ảnh thật trong thư mục này thay vì ảnh tổng hợp")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5, help="Lấy thời gian nhỏ nhất của N lần chạy")
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    if args.input_dir:
+        cases = [(os.path.basename(p), Image.open(p).convert("RGB")) for p in discover_images(args.input_dir)[:args.limit]]
+    else:
+        cases = [(name, synthetic_receipt(w, h)) for name, w, h in RECEIPT_SIZES]
+    original = (settings.PREPROCESS_ENGINE, settings.UINT8_TILES)
+
+    print(f"CROP_MODE={settings.CROP_MODE}, BASE_SIZE={settings.BASE_SIZE}, IMAGE_SIZE={settings.IMAGE_SIZE}")
+    print(f"{'IMAGE':<16} {'SIZE':>10} {'TILES':>6} {'DTYPE':>6} {'PIL (ms)':>9} {'TENSOR (ms)':>12} {'SPEEDUP':>8} {'MAX DIFF':>9}")
+    worst = 0.0
+    totals = {}
+    for name, image in cases:
+        for uint8_tiles in (True, False):
+            settings.update(UINT8_TILES=uint8_tiles)
+            pil_time, pil_out = run_engine("pil", image, args.repeat)
+            tensor_time, tensor_out = run_engine("tensor", image, args.repeat)
+            diff = max_diff(pil_out, tensor_out)
+            worst = max(worst, diff)
+            dtype = "uint8" if uint8_tiles else "f32"
+            pil_total, tensor_total = totals.get(dtype, (0.0, 0.0))
+            totals[dtype] = (pil_total + pil_time, tensor_total + tensor_time)
+            tiles = "x".join(str(int(n)) for n in pil_out[4][0].tolist())
+            print(f"{name[:16]:<16} {f'{image.width}x{image.height}':>10} {tiles:>6} {dtype:>6} "
+                  f"{pil_time * 1000:>9.1f} {tensor_time * 1000:>12.1f} {pil_time / tensor_time:>7.2f}x {diff:>9.2g}")
+    settings.update(PREPROCESS_ENGINE=original[0], UINT8_TILES=original[1])
+
+    for dtype, (pil_total, tensor_total) in totals.items():
+        print(f"Total {dtype}: pil {pil_total * 1000:.0f} ms, tensor {tensor_total * 1000:.0f} ms "
+              f"({pil_total / tensor_total:.2f}x)")
+    if worst > args.tolerance:
+        print(f"Engines differ: max abs diff {worst:.3g} > {args.tolerance}")
+        sys.exit(1)
+    print(f"Engines match (max abs diff {worst:.3g})")
@@ -0,0 +1,91 @@
+"""
+Kiểm tra + đo UINT8_TILES: processor trả tile uint8, model tự chia 255 + normalize trên GPU.
+
+Với mỗi ảnh, chạy tokenize_with_images 2 lần (float32 như cũ và uint8), rồi đưa tensor uint8 qua
+ImageTransform.normalize_pixels (đúng hàm mà DeepseekOCRForCausalLM._process_image_input dùng) và so
+với tensor float32: phải bằng nhau từng phần tử, cả sau khi ép về bfloat16 như trước SAM encoder.
+In thêm dung lượng tensor và thời gian tiền xử lý của 2 chế độ. Có ảnh lệch -> exit code 1.
+
+    python benchmarks/bench_uint8_tiles.py --input_dir inputs --limit 50 [--device cuda]
+
+Cần tokenizer của settings.MODEL_PATH (tải từ HuggingFace lần đầu), không cần vLLM.
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from pipeline import DEEPSEEK_REPO_DIR
+from sharding import discover_images
+
+sys.path.insert(0, DEEPSEEK_REPO_DIR)
+from config import settings
+from process.image_process import DeepseekOCRProcessor, ImageTransform
+
+MB = 1024 * 1024
+
+def preprocess(processor, image):
+    start = time.perf_counter()
+    _, pixel_values, images_crop, *_ = processor.tokenize_with_images(
+        images=[image], bos=True, eos=True, cropping=settings.CROP_MODE)[0]
+    return pixel_values, images_crop, time.perf_counter() - start
+
+def compare(reference, raw, transform, device):
+    """-> (max abs diff float32, bfloat16 bằng nhau không); tensor toàn 0 là placeholder "không có crop"."""
+    if not raw.any():
+        return (0.0, True) if not reference.any() else (float("inf"), False)
+    restored = transform.normalize_pixels(raw.to(device))
+    reference = reference.to(device)
+    diff = (restored - reference).abs().max().item()
+    return diff, torch.equal(restored.to(torch.bfloat16), reference.to(torch.bfloat16))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="So sánh tile uint8 + normalize trên device với tile float32")
+    parser.add_argument("--input_dir", default=os.path.join(ROOT_DIR, "inputs"))
+    parser.add_argument("--limit", type=int, default=0, help="Chỉ xét N ảnh đầu (0 = tất cả)")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    images = discover_images(args.input_dir)
+    if args.limit:
+        images = images[:args.limit]
+    float_processor = DeepseekOCRProcessor(uint8_tiles=False)
+    uint8_processor = DeepseekOCRProcessor(uint8_tiles=True)
+    transform = ImageTransform()
+
+    float_bytes = uint8_bytes = 0
+    float_time = uint8_time = 0.0
+    worst = 0.0
+    mismatches = []
+    for path in images:
+        image = Image.open(path).convert("RGB")
+        ref_global, ref_crop, elapsed = preprocess(float_processor, image)
+        float_time += elapsed
+        raw_global, raw_crop, elapsed = preprocess(uint8_processor, image)
+        uint8_time += elapsed
+        float_bytes += ref_global.nbytes + ref_crop.nbytes
+        uint8_bytes += raw_global.nbytes + raw_crop.nbytes
+
+        for name, reference, raw in (("global", ref_global, raw_global), ("crops", ref_crop, raw_crop)):
+            diff, same_bf16 = compare(reference, raw, transform, args.device)
+            worst = max(worst, diff)
+            if diff > 1e-6 or not same_bf16:
+                mismatches.append(f"{os.path.basename(path)} [{name}]: max diff {diff:.3g}, bf16 equal={same_bf16}")
+
+    print(f"{len(images)} images, CROP_MODE={settings.CROP_MODE}, normalize on {args.device}")
+    print(f"{'MODE':<8} {'TENSORS (MB)':>13} {'PREPROCESS (s)':>15}")
+    print(f"{'float32':<8} {float_bytes / MB:>13.1f} {float_time:>15.2f}")
+    print(f"{'uint8':<8} {uint8_bytes / MB:>13.1f} {uint8_time:>15.2f}")
+    print(f"Max abs diff after normalize_pixels: {worst:.3g}")
+    if mismatches:
+        print(f"{len(mismatches)} mismatches:")
+        for line in mismatches:
+            print(f"  {line}")
+        sys.exit(1)
+    print("uint8 tiles match the float32 tiles")
@@ -0,0 +1,170 @@
+"""
+Load test cho server.py: nhiều client gửi ảnh đồng thời, đo độ trễ (p50/p95/p99), throughput và số lần bị 429.
+
+Mặc định chạy server.py ngay trong process này với backend giả (không cần GPU): mỗi batch tốn
+--stub_batch_ms + --stub_image_ms * số ảnh, mô phỏng việc gộp batch giúp vLLM / LLM chạy nhanh hơn
+so với từng ảnh một. JSON trả về lấy từ outputs/ (hoặc JSON mẫu nếu folder trống).
+
+    python benchmarks/load_test.py --concurrency 32 --requests 500 --batch_window_ms 50
+    python benchmarks/load_test.py --url http://gpu-host:8000 --image inputs/Coopmart/1.jpg   # server thật
+"""
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from server import ExtractionService
+from daemon import percentile
+
+SAMPLE_JSON = {"retailer_name": "BÁCH HÓA XANH", "store_name": None, "store_address": None,
+               "bill_id": "OV109141411144292", "bill_id_barcode": None, "buy_date": "01/11/2024",
+               "buy_time": "07:24", "line_items": []}
+
+class StubOCRStage:
+    """Thay OCRStage: ngủ batch_latency + image_latency * len(batch), trả markdown giả."""
+
+    def __init__(self, batch_latency: float, image_latency: float):
+        self.batch_latency = batch_latency
+        self.image_latency = image_latency
+
+    def load(self):
+        pass
+
+    def run(self, results):
+        time.sleep(self.batch_latency + self.image_latency * len(results))
+        for r in results:
+            r.markdown = f"stub markdown for {r.name}"
+        return results
+
+class StubExtractionStage:
+    """Thay ExtractionStage: ngủ như StubOCRStage, trả lần lượt các JSON có sẵn trong outputs/."""
+
+    def __init__(self, batch_latency: float, image_latency: float, json_dir: str):
+        self.batch_latency = batch_latency
+        self.image_latency = image_latency
+        self.samples = []
+        for path in sorted(glob.glob(os.path.join(json_dir, "*.json")))[:50]:
+            with open(path, "r", encoding="utf-8") as f:
+                self.samples.append(json.load(f))
+        self.samples = self.samples or [SAMPLE_JSON]
+        self.count = 0
+
+    def load(self):
+        pass
+
+    def run(self, results):
+        time.sleep(self.batch_latency + self.image_latency * len(results))
+        for r in results:
+            r.data = self.samples[self.count % len(self.samples)]
+            r.json_text = json.dumps(r.data, ensure_ascii=False)
+            self.count += 1
+        return results
+
+    # Độ trễ ở trên đã là 1 lần generate cho cả batch
+    run_batch = run
+
+def start_stub_server(args) -> ExtractionService:
+    """Chạy ExtractionService với stage giả trong thread nền, trả về khi server đã nghe trên cổng."""
+    batch_latency, image_latency = args.stub_batch_ms / 1000, args.stub_image_ms / 1000
+    service = ExtractionService(
+        StubOCRStage(batch_latency, image_latency),
+        StubExtractionStage(batch_latency, image_latency, os.path.join(ROOT_DIR, "outputs")),
+        upload_dir=tempfile.mkdtemp(prefix="load_test_uploads_"),
+        batch_window=args.batch_window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        max_queue=args.max_queue,
+    )
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        event = asyncio.Event()
+        loop.create_task(service.serve("127.0.0.1", 0, ready=event))
+        loop.run_until_complete(event.wait())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="stub-server", daemon=True).start()
+    ready.wait()
+    return service
+
+def send(host: str, port: int, image_bytes: bytes, name: str):
+    """Gửi 1 request, trả (status, latency giây)."""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    try:
+        conn.request("POST", f"/extract?name={name}", body=image_bytes, headers={"Content-Type": "image/jpeg"})
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    except (ConnectionError, OSError):
+        return 0, time.perf_counter() - start
+    finally:
+        conn.close()
+
+def get_health(host: str, port: int):
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        conn.request("GET", "/health")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="Server có sẵn; bỏ trống để chạy server với backend giả")
+    parser.add_argument("--image", default=None, help="Ảnh gửi đi (mặc định: ảnh đầu tiên trong inputs/)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Số client gửi đồng thời")
+    parser.add_argument("--requests", type=int, default=500, help="Tổng số request")
+    # Cài đặt cho server giả
+    parser.add_argument("--batch_window_ms", type=float, default=50)
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    parser.add_argument("--max_queue", type=int, default=64)
+    parser.add_argument("--stub_batch_ms", type=float, default=200, help="Chi phí cố định mỗi batch (mỗi stage)")
+    parser.add_argument("--stub_image_ms", type=float, default=20, help="Chi phí thêm cho mỗi ảnh (mỗi stage)")
+    args = parser.parse_args()
+
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        service = start_stub_server(args)
+        host, port = "127.0.0.1", service.port
+
+    image_path = args.image or next(iter(sorted(glob.glob(os.path.join(ROOT_DIR, "inputs", "**", "*.jpg"),
+                                                          recursive=True))), None)
+    image_bytes = open(image_path, "rb").read() if image_path else b"\xff\xd8stub image\xff\xd9"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        responses = list(pool.map(lambda i: send(host, port, image_bytes, f"load_{i}"), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    ok = [latency for status, latency in responses if status == 200]
+    statuses = {}
+    for status, _ in responses:
+        statuses[status] = statuses.get(status, 0) + 1
+    health = get_health(host, port)
+
+    print(f"\nRequests: {args.requests} | concurrency: {args.concurrency} | wall time: {elapsed:.2f}s")
+    print(f"Status codes: {dict(sorted(statuses.items()))}")
+    print(f"Throughput (200 OK): {len(ok) / elapsed:.2f} req/s")
+    if ok:
+        print(f"Latency (200 OK): avg {statistics.mean(ok) * 1000:.0f}ms | p50 {percentile(ok, 50) * 1000:.0f}ms | "
+              f"p95 {percentile(ok, 95) * 1000:.0f}ms | p99 {percentile(ok, 99) * 1000:.0f}ms")
+    batches = health.get("batches", 0)
+    if batches:
+        print(f"Batches: {batches} | avg batch size: {(health['processed'] + health['failed']) / batches:.1f}")
+    print(f"Health: {json.dumps(health)}")
@@ -0,0 +1,208 @@
+"""
+Chế độ daemon: theo dõi folder input, gom hoá đơn mới thành micro-batch và đưa vào pipeline
+đang chạy sẵn (OCR + LLM chỉ load 1 lần), thay cho việc cron gọi lại master_pipeline.py.
+
+    python master_pipeline.py --watch --max_batch_size 16 --max_wait 5
+
+- FolderWatcher: quét đệ quy input_dir mỗi poll_interval giây; file chỉ được coi là đã ghi xong
+  khi kích thước và mtime không đổi trong settle_seconds giây.
+- MicroBatcher: batch đóng khi đủ max_batch_size file hoặc file chờ lâu nhất đã chờ max_wait giây.
+- Mỗi batch in ra độ sâu hàng đợi (file đang ghi + đang chờ) và độ trễ từng hoá đơn
+  (từ lúc file ghi xong tới lúc có JSON); p50 / p95 tính trên latency_window hoá đơn gần nhất
+  để daemon chạy lâu không giữ mãi mọi độ trễ.
+"""
+import os
+import json
+import time
+import signal
+import statistics
+import collections
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from sharding import discover_files, duplicate_ids, image_id, IMAGE_EXTENSIONS
+from pipeline import image_name
+from job_manifest import FINISHED_STATES, FAILED
+from metrics import registry, QUEUE_DEPTH
+
+@dataclass
+class PendingFile:
+    path: str
+    size: int
+    mtime: float
+    stable_since: float     # time.time() lần đầu thấy (size, mtime) hiện tại
+    ready_at: float = 0.0   # time.time() lúc được coi là ghi xong (0 = đang ghi)
+
+class FolderWatcher:
+    def __init__(self, input_dir: str, settle_seconds: float = 2.0):
+        self.input_dir = input_dir
+        self.settle_seconds = settle_seconds
+        self.pending: Dict[str, PendingFile] = {}
+        self.seen: Set[str] = set()
+        self.duplicates: Set[str] = set()
+
+    def mark_seen(self, paths):
+        """Bỏ qua các file này (đã xử lý ở lần chạy trước / đã đưa vào batch)."""
+        self.seen.update(paths)
+        for p in paths:
+            self.pending.pop(p, None)
+
+    def scan(self) -> List[str]:
+        """
+        Ảnh trong input_dir. Ảnh chưa xử lý mà trùng image_id với ảnh khác (vd A/1.jpg và A/1.png) bị bỏ qua
+        và cảnh báo 1 lần, thay vì ghi đè output của nhau; discover_images báo lỗi nhưng daemon thì không nên dừng.
+        """
+        paths = discover_files(self.input_dir, IMAGE_EXTENSIONS)
+        duplicates = {p for group in duplicate_ids(paths, self.input_dir).values() for p in group if p not in self.seen}
+        for p in sorted(duplicates - self.duplicates):
+            print(f"Warning: skipping {p}, another image has the same ID '{image_id(p, self.input_dir)}'")
+        self.duplicates = duplicates
+        return [p for p in paths if p not in duplicates]
+
+    def poll(self) -> List[PendingFile]:
+        """Quét folder, trả về các file vừa ghi xong (theo thứ tự ghi xong)."""
+        now = time.time()
+        newly_ready = []
+        paths = self.scan()
+        # File đã bị xoá / chuyển đi: bỏ khỏi seen và khỏi các file đang ghi để 2 tập này không lớn mãi
+        existing = set(paths)
+        self.seen.intersection_update(existing)
+        for path in [p for p, item in self.pending.items() if p not in existing and not item.ready_at]:
+            del self.pending[path]
+        for path in paths:
+            if path in self.seen:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue  # File bị xoá / đổi tên giữa lúc quét
+            item = self.pending.get(path)
+            if item is None or (item.size, item.mtime) != (st.st_size, st.st_mtime):
+                # File mới hoặc vẫn đang được ghi
+                self.pending[path] = PendingFile(path, st.st_size, st.st_mtime, stable_since=now)
+                continue
+            if not item.ready_at and st.st_size > 0 and now - item.stable_since >= self.settle_seconds:
+                item.ready_at = now
+                newly_ready.append(item)
+        return sorted(newly_ready, key=lambda i: i.mtime)
+
+    def depth(self) -> Tuple[int, int]:
+        """(số file đang ghi, số file đã ghi xong đang chờ xử lý)"""
+        ready = sum(1 for i in self.pending.values() if i.ready_at)
+        return len(self.pending) - ready, ready
+
+class MicroBatcher:
+    def __init__(self, max_batch_size: int = 16, max_wait: float = 5.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.waiting: List[PendingFile] = []
+
+    def add(self, items: List[PendingFile]):
+        self.waiting.extend(items)
+
+    def next_batch(self, now: Optional[float] = None) -> List[PendingFile]:
+        """Lấy batch nếu đã đủ kích thước hoặc file chờ lâu nhất đã quá max_wait, không thì []."""
+        if not self.waiting:
+            return []
+        now = time.time() if now is None else now
+        if len(self.waiting) < self.max_batch_size and now - self.waiting[0].ready_at < self.max_wait:
+            return []
+        batch, self.waiting = self.waiting[:self.max_batch_size], self.waiting[self.max_batch_size:]
+        return batch
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+class WatchDaemon:
+    """
+    pipeline: Pipeline (pipeline.py) không có EvaluationStage, nên có manifest để khi daemon
+    khởi động lại thì các file đã xử lý không bị chạy lại.
+    """
+
+    def __init__(self, pipeline, input_dir: str, max_batch_size: int = 16, max_wait: float = 5.0,
+                 settle_seconds: float = 2.0, poll_interval: float = 1.0, status_file: Optional[str] = None,
+                 metrics_file: Optional[str] = None, latency_window: int = 10000):
+        self.pipeline = pipeline
+        self.watcher = FolderWatcher(input_dir, settle_seconds)
+        self.batcher = MicroBatcher(max_batch_size, max_wait)
+        self.poll_interval = poll_interval
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.latencies: Deque[float] = collections.deque(maxlen=latency_window)  # chỉ giữ N hoá đơn gần nhất
+        self.processed = 0
+        self.failed = 0
+        self._stop = False
+
+    def stop(self, *args):
+        print("\nStopping after the current batch...")
+        self._stop = True
+
+    def skip_finished(self):
+        manifest = self.pipeline.manifest
+        if manifest is None:
+            return
+        done = {key for key, state in manifest.states().items() if state in FINISHED_STATES + (FAILED,)}
+        self.watcher.mark_seen([p for p in self.watcher.scan()
+                                if image_name(p, self.pipeline.input_dir) in done])
+        print(f"Skipping {len(self.watcher.seen)} files already processed in earlier runs")
+
+    def process(self, batch: List[PendingFile]):
+        self.watcher.mark_seen([item.path for item in batch])
+        result = self.pipeline.run([item.path for item in batch])
+
+        # finished_at là perf_counter -> đổi sang giờ hệ thống để so với lúc file ghi xong
+        now_wall, now_perf = time.time(), time.perf_counter()
+        batch_latencies = []
+        for item, r in zip(batch, result.results):
+            done_at = now_wall - (now_perf - r.finished_at) if r.finished_at else now_wall
+            batch_latencies.append(done_at - item.ready_at)
+            if r.data is None:
+                self.failed += 1
+        self.processed += len(batch)
+        self.latencies.extend(batch_latencies)
+        self.report(len(batch), batch_latencies)
+
+    def status(self) -> Dict:
+        writing, waiting = self.watcher.depth()
+        latencies = sorted(self.latencies)  # tối đa latency_window phần tử; list đã sort thì percentile() sort lại ~O(n)
+        return {
+            "queue_depth": writing + waiting,
+            "writing": writing,
+            "waiting": waiting,
+            "processed": self.processed,
+            "failed": self.failed,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    def report(self, batch_size: int, batch_latencies: List[float]):
+        s = self.status()
+        QUEUE_DEPTH.set(s["queue_depth"], queue="watch")
+        print(f"[watch] batch: {batch_size} | latency avg: {statistics.mean(batch_latencies):.1f}s "
+              f"max: {max(batch_latencies):.1f}s | queue depth: {s['queue_depth']} "
+              f"(writing {s['writing']}, waiting {s['waiting']}) | processed: {s['processed']} "
+              f"(failed {s['failed']}) | p50: {s['latency_p50']:.1f}s p95: {s['latency_p95']:.1f}s")
+        if self.status_file:
+            with open(self.status_file, "w", encoding="utf-8") as f:
+                json.dump(s, f, indent=2)
+        if self.metrics_file:
+            registry.write(self.metrics_file)
+
+    def run_forever(self):
+        self.pipeline.load()
+        self.skip_finished()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        print(f"Watching '{self.watcher.input_dir}' (batch ≤ {self.batcher.max_batch_size} files "
+              f"or ≤ {self.batcher.max_wait:.0f}s wait)...")
+        while not self._stop:
+            self.batcher.add(self.watcher.poll())
+            batch = self.batcher.next_batch()
+            if batch:
+                self.process(batch)
+            else:
+                time.sleep(self.poll_interval)
@@ -1,213 +1,454 @@
-import os
-import json
-import torch
-import re
-import argparse
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
-
-# 1. Load Model & Tokenizer
-model_name = "deepseek-ai/deepseek-llm-7b-chat"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-# FIX: Gán pad_token nếu chưa có 
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-
-model = AutoModelForCausalLM.from_pretrained(
-    model_name, 
-    device_map="auto", 
-    torch_dtype=torch.bfloat16,
-    trust_remote_code=True 
-)
-model.generation_config = GenerationConfig.from_pretrained(model_name)
-model.generation_config.pad_token_id = tokenizer.pad_token_id
-
-def extract_json_from_text(file_text):
-    prompt = f"""
-You are a generic invoice extraction system.
-Your task is to extract data from the provided OCR text into a JSON object.
-
-### GUIDELINES:
-
-1. **Retailer Name (Flexible)**: 
-   - Look at the header (top) of the text.
-   - Identify the main **Brand Name** (e.g., "co.opmart").
-   - **Constraint**: If the text contains the brand name, extract it. If the top section is garbled, missing, or unclear, set `"retailer_name": null`.
-
-
-2. **Prices & Line Items (Coopmart Logic)**:
-   - Coopmart receipts typically list items in **2 lines**:
-     	Product Name.
-        VAT	Quantity	Unit_price	Product_total
-   - SKU - typically a long number starting with 89...
-   - Quantity - Unit Price - Product Total.
-     **Math Logic**: If `product_total` is missing or merged, but `unit_price` and `quantity` exist, CALCULATE: `product_total` = `unit_price` * `quantity`.
-     If `product_total` is found on a separate line below the product name, link them together.
-     **Clean Data**: Remove "VAT", "CK", "|" characters from the numbers.
-
-3. **General Rules**:
-   - **Bill ID**: Look for "Ma CQT”, “CQT”, “ Ma CCT”.
-   - **Barcode**: Usually at the BOTTOM, typically a long number starting with 00...
-   - **Date/Time**: Convert to DD/MM/YYYY. Ignore seconds in time, convert to HH:MM.
-   - Nulls: Use `null` for any missing field.
-
-For example:
-
-    input:
-    '
-        co.opmart  
-        
-        Co.opMart Phan Van Tri
-        Mã số thực: 0309120630  
-        543/1 Phan Van Tri, Phuong 7, Quan Go Vap,  
-        Thanh pho Ho Chi Minh  
-    
-        Don hang siêu thị  
-        Ma CQT: M1-24-MKWR-00251306951  
-        Quay: 13  
-        Ngày: 11/12/2024 09:00:51 
-
-        8936036025194  
-        B.ANGIFTsetTET2 OR hg1005.6g  
-        VAT8% 580 160,000 ₫ 92,800,000 ₫
-        893603024746 B: ANGIFISETIET3 OR HGD204.6g  
-        VAT86: 33 214.500 ₫                             #missing value for 'product_total'
-        8936036027259 B.MartikacookFlow.or.h443zg-VAT8%  53    149.000 ₫   7.897.000 ₫
-
-        Cam on Quy khach - Hen gap lai  
-
-        001580112412061576                              #this is barcode ID
-    '
-    
-    output: 
-        retailer_name: "co.opmart",
-        store_name: "Co.opmart Phan Van Tri",
-        store_address: “543/1 Phan Van Tri, Phuong 7, Quan Go Vap, Thanh pho Ho Chi Minh”,
-        bill_id: "M1-24-MKWR-00251306951 "
-        bill_id_barcode: “001580112412061576”,
-        buy_date: "11/12/2024",
-        buy_time: "09:00",
-        line_items: 
-            product_SKU: "8936036025194",
-            quantity: "580",
-            product_name: "B.ANGIFTsetTET2 OR hg1005.6g",
-            unit_price: "160,000",
-            product_total: "92,800,000",
-
-	        product_SKU: "893603024746",
-            quantity: "33",
-            product_name: "B: ANGIFISETIET3 OR HGD204.6g",
-            unit_price: "214.500",
-            product_total: "7.078.500",                     #'product_total'= 'unit_price' * 'quantity'
-
-            product_SKU: "8936036027259",
-            quantity: "53",
-            product_name: "B.MartikacookFlow.or.h443zg-",
-            unit_price: "149.000",
-            product_total: "7.897.000"
-
-
-            
-### JSON SCHEMA:
-{{
-  "retailer_name": "Brand name found in text (or null)",
-  "store_name": "Store/Branch name (or null)",
-  "store_address": "Address string (or null)",
-  "bill_id": "Invoice Number (or null)",
-  "bill_id_barcode": "Lookup code/Barcode string (or null)",
-  "buy_date": "DD/MM/YYYY",
-  "buy_time": "HH:MM",
-  "line_items": [
-    {{
-      "product_SKU": "Product code (Look for long number like 89...)",
-      "quantity": "String",
-      "product_name": "String",
-      "unit_price": "String",
-      "product_total": "String"
-    }}
-  ]
-}}
-
-### INPUT TEXT:
-{file_text}
-
-### OUTPUT JSON:
-"""
-    
-    messages = [{"role": "user", "content": prompt}]
-    
-    # Tạo input tensor
-    input_tensor = tokenizer.apply_chat_template(
-        messages, 
-        add_generation_prompt=True, 
-        return_tensors="pt"
-    )
-    
-    # FIX: Đưa input vào đúng device của model
-    input_tensor = input_tensor.to(model.device)
-    
-    # Tạo mask (đã fix pad_token ở trên nên dòng này sẽ chạy đúng)
-    attention_mask = input_tensor.ne(tokenizer.pad_token_id).long()
-
-    # Generate
-    with torch.no_grad():
-        outputs = model.generate(
-            input_tensor,
-            attention_mask=attention_mask,
-            max_new_tokens=1000, # Tăng lên chút để tránh bị cắt giữa chừng nếu hóa đơn dài
-            do_sample=True,     # Greedy decoding để kết quả ổn định (deterministic)
-            temperature=0.1
-        )
-
-    # Decode
-    result = tokenizer.decode(outputs[0][input_tensor.shape[1]:], skip_special_tokens=True)
-
-    # FIX: Dùng Regex để tìm JSON object chuẩn xác hơn
-    # Tìm chuỗi bắt đầu bằng { và kết thúc bằng } (non-greedy)
-    match = re.search(r'\{.*\}', result, re.DOTALL)
-    if match:
-        json_str = match.group(0)
-        return json_str
-    
-    return result
-
-if __name__ == "__main__":
-    # Thêm bộ đọc tham số dòng lệnh
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input_dir", required=True, help="Folder chứa file .md")
-    parser.add_argument("--output_dir", required=True, help="Folder lưu .json")
-    args = parser.parse_args()
-
-    input_dir = args.input_dir
-    output_dir = args.output_dir
-    os.makedirs(output_dir, exist_ok=True)
-
-    print(f"LLM Processing from: {input_dir}")
-
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".md") and not filename.endswith("det.md"):
-            file_path = os.path.join(input_dir, filename)
-            print(f"Processing: {filename}...")
-        
-            with open(file_path, "r", encoding="utf-8") as f:
-                file_text = f.read()
-
-            # Bỏ qua file rỗng hoặc quá ngắn
-            if len(file_text.strip()) < 10:
-                print(f"Skipping empty file: {filename}")
-                continue
-
-            json_text = extract_json_from_text(file_text)
-
-            try:
-                data = json.loads(json_text)
-                output_path = os.path.join(output_dir, filename.replace(".md", ".json"))
-                with open(output_path, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                print(f"Saved: {output_path}")
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse JSON from: {filename}")
-                print(f"Error: {e}")
-                # Ghi log lỗi để debug
-                with open(os.path.join(output_dir, f"ERROR_{filename}"), "w", encoding="utf-8") as f:
-                    f.write(json_text)
+import os
+import json
+import torch
+import re
+import time
+import hashlib
+import argparse
+from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+
+from result_cache import DiskLRUCache, make_cache_key
+from job_manifest import JobManifest, FINISHED_STATES, FAILED, chunked
+from sharding import discover_files, select_shard, add_shard_args, image_id
+from tracing import tracer
+from token_ledger import ledger
+from memprofile import memory_profiler
+from sampling_profiler import add_profile_args, profiler_from_args, finish_profile
+from metrics import registry, IMAGES_PROCESSED, FAILURES, JSON_PARSE_FAILURES, GENERATED_TOKENS, TOKENS_PER_SECOND
+
+# 1. Model & Tokenizer (load 1 lần, dùng lại cho mọi lần gọi)
+model_name = "deepseek-ai/deepseek-llm-7b-chat"
+tokenizer = None
+model = None
+
+def load_model():
+    """Load model + tokenizer nếu chưa load. Gọi nhiều lần không load lại."""
+    global tokenizer, model
+    if model is not None:
+        return tokenizer, model
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    # FIX: Gán pad_token nếu chưa có 
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, 
+        device_map="auto", 
+        torch_dtype=torch.bfloat16,
+        trust_remote_code=True 
+    )
+    model.generation_config = GenerationConfig.from_pretrained(model_name)
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return tokenizer, model
+
+PROMPT_TEMPLATE = """
+You are a generic invoice extraction system.
+Your task is to extract data from the provided OCR text into a JSON object.
+
+### GUIDELINES:
+
+1. **Retailer Name (Flexible)**: 
+   - Look at the header (top) of the text.
+   - Identify the main **Brand Name** (e.g., "co.opmart").
+   - **Constraint**: If the text contains the brand name, extract it. If the top section is garbled, missing, or unclear, set `"retailer_name": null`.
+
+
+2. **Prices & Line Items (Coopmart Logic)**:
+   - Coopmart receipts typically list items in **2 lines**:
+     	Product Name.
+        VAT	Quantity	Unit_price	Product_total
+   - SKU - typically a long number starting with 89...
+   - Quantity - Unit Price - Product Total.
+     **Math Logic**: If `product_total` is missing or merged, but `unit_price` and `quantity` exist, CALCULATE: `product_total` = `unit_price` * `quantity`.
+     If `product_total` is found on a separate line below the product name, link them together.
+     **Clean Data**: Remove "VAT", "CK", "|" characters from the numbers.
+
+3. **General Rules**:
+   - **Bill ID**: Look for "Ma CQT”, “CQT”, “ Ma CCT”.
+   - **Barcode**: Usually at the BOTTOM, typically a long number starting with 00...
+   - **Date/Time**: Convert to DD/MM/YYYY. Ignore seconds in time, convert to HH:MM.
+   - Nulls: Use `null` for any missing field.
+
+For example:
+
+    input:
+    '
+        co.opmart  
+        
+        Co.opMart Phan Van Tri
+        Mã số thực: 0309120630  
+        543/1 Phan Van Tri, Phuong 7, Quan Go Vap,  
+        Thanh pho Ho Chi Minh  
+    
+        Don hang siêu thị  
+        Ma CQT: M1-24-MKWR-00251306951  
+        Quay: 13  
+        Ngày: 11/12/2024 09:00:51 
+
+        8936036025194  
+        B.ANGIFTsetTET2 OR hg1005.6g  
+        VAT8% 580 160,000 ₫ 92,800,000 ₫
+        893603024746 B: ANGIFISETIET3 OR HGD204.6g  
+        VAT86: 33 214.500 ₫                             #missing value for 'product_total'
+        8936036027259 B.MartikacookFlow.or.h443zg-VAT8%  53    149.000 ₫   7.897.000 ₫
+
+        Cam on Quy khach - Hen gap lai  
+
+        001580112412061576                              #this is barcode ID
+    '
+    
+    output: 
+        retailer_name: "co.opmart",
+        store_name: "Co.opmart Phan Van Tri",
+        store_address: “543/1 Phan Van Tri, Phuong 7, Quan Go Vap, Thanh pho Ho Chi Minh”,
+        bill_id: "M1-24-MKWR-00251306951 "
+        bill_id_barcode: “001580112412061576”,
+        buy_date: "11/12/2024",
+        buy_time: "09:00",
+        line_items: 
+            product_SKU: "8936036025194",
+            quantity: "580",
+            product_name: "B.ANGIFTsetTET2 OR hg1005.6g",
+            unit_price: "160,000",
+            product_total: "92,800,000",
+
+	        product_SKU: "893603024746",
+            quantity: "33",
+            product_name: "B: ANGIFISETIET3 OR HGD204.6g",
+            unit_price: "214.500",
+            product_total: "7.078.500",                     #'product_total'= 'unit_price' * 'quantity'
+
+            product_SKU: "8936036027259",
+            quantity: "53",
+            product_name: "B.MartikacookFlow.or.h443zg-",
+            unit_price: "149.000",
+            product_total: "7.897.000"
+
+
+            
+### JSON SCHEMA:
+{{
+  "retailer_name": "Brand name found in text (or null)",
+  "store_name": "Store/Branch name (or null)",
+  "store_address": "Address string (or null)",
+  "bill_id": "Invoice Number (or null)",
+  "bill_id_barcode": "Lookup code/Barcode string (or null)",
+  "buy_date": "DD/MM/YYYY",
+  "buy_time": "HH:MM",
+  "line_items": [
+    {{
+      "product_SKU": "Product code (Look for long number like 89...)",
+      "quantity": "String",
+      "product_name": "String",
+      "unit_price": "String",
+      "product_total": "String"
+    }}
+  ]
+}}
+
+### INPUT TEXT:
+{file_text}
+
+### OUTPUT JSON:
+"""
+
+# Đổi prompt -> đổi PROMPT_VERSION -> cache trích xuất cũ tự động không còn khớp
+PROMPT_VERSION = hashlib.sha256(PROMPT_TEMPLATE.encode("utf-8")).hexdigest()[:16]
+
+# Tham số sinh mặc định (sampling, nhiệt độ thấp)
+GENERATION_PARAMS = {
+    "max_new_tokens": 1000, # Tăng lên chút để tránh bị cắt giữa chừng nếu hóa đơn dài
+    "do_sample": True,
+    "temperature": 0.1,
+}
+# Greedy decoding: cùng input luôn cho cùng output -> kết quả cache mới dùng lại được
+DETERMINISTIC_GENERATION_PARAMS = {
+    "max_new_tokens": 1000,
+    "do_sample": False,
+}
+
+def normalize_ocr_text(file_text):
+    """Chuẩn hoá xuống dòng và khoảng trắng thừa để markdown giống nhau cho ra cùng prompt / cùng cache key."""
+    lines = file_text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+def build_prompt(file_text):
+    return PROMPT_TEMPLATE.format(file_text=normalize_ocr_text(file_text))
+
+def extraction_cache_key(file_text, generation_params):
+    return make_cache_key("extract", normalize_ocr_text(file_text), PROMPT_VERSION, model_name, generation_params)
+
+def extract_json_from_text(file_text, cache=None, deterministic=False, name=None):
+    """
+    Trích xuất JSON (dạng text) từ markdown OCR.
+    cache: DiskLRUCache, chỉ được dùng khi deterministic=True (sampling thì kết quả cache không tái sử dụng được).
+    name: tên ảnh, chỉ dùng để gắn nhãn span khi bật tracing.
+    """
+    generation_params = DETERMINISTIC_GENERATION_PARAMS if deterministic else GENERATION_PARAMS
+    use_cache = cache is not None and deterministic
+    if use_cache:
+        key = extraction_cache_key(file_text, generation_params)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit["json_text"]
+
+    tokenizer, model = load_model()
+    build_start = time.perf_counter()
+    with tracer.span("prompt_build", image=name):
+        prompt = build_prompt(file_text)
+
+        messages = [{"role": "user", "content": prompt}]
+        
+        # Tạo input tensor
+        input_tensor = tokenizer.apply_chat_template(
+            messages, 
+            add_generation_prompt=True, 
+            return_tensors="pt"
+        )
+        
+        # FIX: Đưa input vào đúng device của model
+        input_tensor = input_tensor.to(model.device)
+        
+        # Tạo mask (đã fix pad_token ở trên nên dòng này sẽ chạy đúng)
+        attention_mask = input_tensor.ne(tokenizer.pad_token_id).long()
+
+    # Generate
+    start = time.perf_counter()
+    try:
+        with tracer.span("llm_generate", image=name), torch.no_grad():
+            outputs = model.generate(
+                input_tensor,
+                attention_mask=attention_mask,
+                **generation_params
+            )
+    except Exception:
+        FAILURES.inc(stage="extraction", reason="generate")
+        raise
+    num_generated = outputs.shape[1] - input_tensor.shape[1]
+    GENERATED_TOKENS.observe(num_generated, stage="extraction")
+    TOKENS_PER_SECOND.set(num_generated / max(time.perf_counter() - start, 1e-9), stage="extraction")
+    if name:
+        ledger.record(name, prompt_tokens=input_tensor.shape[1], output_tokens=num_generated,
+                      extraction_seconds=time.perf_counter() - build_start)
+
+    # Decode
+    result = tokenizer.decode(outputs[0][input_tensor.shape[1]:], skip_special_tokens=True)
+    json_str = find_json(result)
+
+    if use_cache:
+        cache.put(key, {"json_text": json_str})
+    return json_str
+
+def find_json(result):
+    # FIX: Dùng Regex để tìm JSON object chuẩn xác hơn
+    # Tìm chuỗi bắt đầu bằng { và kết thúc bằng } (non-greedy)
+    match = re.search(r'\{.*\}', result, re.DOTALL)
+    return match.group(0) if match else result
+
+def extract_json_batch(file_texts, cache=None, deterministic=False, names=None):
+    """
+    Như extract_json_from_text nhưng cho nhiều markdown cùng lúc: prompt của các cache miss được pad trái
+    thành 1 tensor và sinh trong 1 lần model.generate. Trả về list JSON text theo đúng thứ tự file_texts.
+    names: tên ảnh (tracing / token ledger), cùng độ dài với file_texts.
+    """
+    names = list(names) if names is not None else [None] * len(file_texts)
+    generation_params = DETERMINISTIC_GENERATION_PARAMS if deterministic else GENERATION_PARAMS
+    use_cache = cache is not None and deterministic
+    json_texts = [None] * len(file_texts)
+    keys = [None] * len(file_texts)
+    if use_cache:
+        for i, file_text in enumerate(file_texts):
+            keys[i] = extraction_cache_key(file_text, generation_params)
+            hit = cache.get(keys[i])
+            if hit is not None:
+                json_texts[i] = hit["json_text"]
+    misses = [i for i, json_text in enumerate(json_texts) if json_text is None]
+    if not misses:
+        return json_texts
+
+    tokenizer, model = load_model()
+    build_start = time.perf_counter()
+    with tracer.span("prompt_build", images=len(misses)):
+        prompts = [tokenizer.apply_chat_template([{"role": "user", "content": build_prompt(file_texts[i])}],
+                                                 add_generation_prompt=True, return_tensors="pt")[0]
+                   for i in misses]
+        width = max(len(p) for p in prompts)
+        # Pad bên trái: mỗi hàng sinh tiếp ngay sau token cuối của prompt
+        input_tensor = torch.full((len(prompts), width), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_tensor)
+        for row, p in enumerate(prompts):
+            input_tensor[row, width - len(p):] = p
+            attention_mask[row, width - len(p):] = 1
+        input_tensor = input_tensor.to(model.device)
+        attention_mask = attention_mask.to(model.device)
+
+    start = time.perf_counter()
+    try:
+        with tracer.span("llm_generate_batch", images=len(misses)), torch.no_grad():
+            outputs = model.generate(
+                input_tensor,
+                attention_mask=attention_mask,
+                **generation_params
+            )
+    except Exception:
+        FAILURES.inc(len(misses), stage="extraction", reason="generate")
+        raise
+    elapsed = time.perf_counter() - start
+
+    total_generated = 0
+    for row, i in enumerate(misses):
+        generated = outputs[row][width:]
+        # Hàng xong sớm được điền pad_token_id (= eos) tới hết độ dài của batch
+        num_generated = int(generated.ne(tokenizer.pad_token_id).sum())
+        total_generated += num_generated
+        GENERATED_TOKENS.observe(num_generated, stage="extraction")
+        if names[i]:
+            ledger.record(names[i], prompt_tokens=len(prompts[row]), output_tokens=num_generated,
+                          extraction_seconds=time.perf_counter() - build_start)
+        json_texts[i] = find_json(tokenizer.decode(generated, skip_special_tokens=True))
+        if use_cache:
+            cache.put(keys[i], {"json_text": json_texts[i]})
+    TOKENS_PER_SECOND.set(total_generated / max(elapsed, 1e-9), stage="extraction")
+    return json_texts
+
+def save_json_result(json_text, output_dir, name):
+    """
+    Parse JSON do LLM sinh ra và lưu vào <output_dir>/<name>.json.
+    Nếu parse lỗi thì ghi raw output ra ERROR_<name>.md để debug và trả về None.
+    name có thể chứa folder (ID ảnh "Coopmart/1" -> <output_dir>/Coopmart/1.json, Coopmart/ERROR_1.md).
+    """
+    output_subdir = os.path.join(output_dir, os.path.dirname(name))
+    os.makedirs(output_subdir, exist_ok=True)
+    try:
+        with tracer.span("json_parse", image=name):
+            data = json.loads(json_text)
+    except json.JSONDecodeError as e:
+        print(f"Failed to parse JSON from: {name}.md")
+        print(f"Error: {e}")
+        JSON_PARSE_FAILURES.inc()
+        # Ghi log lỗi để debug
+        with tracer.span("file_write", image=name), \
+                open(os.path.join(output_subdir, f"ERROR_{os.path.basename(name)}.md"), "w", encoding="utf-8") as f:
+            f.write(json_text)
+        return None
+
+    output_path = os.path.join(output_dir, f"{name}.json")
+    with tracer.span("file_write", image=name), open(output_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"Saved: {output_path}")
+    IMAGES_PROCESSED.inc(stage="extraction")
+    return data
+
+if __name__ == "__main__":
+    # Thêm bộ đọc tham số dòng lệnh
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", required=True, help="Folder chứa file .md")
+    parser.add_argument("--output_dir", required=True, help="Folder lưu .json")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="Greedy decoding (do_sample=False), bắt buộc để dùng cache")
+    parser.add_argument("--cache_file", default=None, help="File SQLite cache kết quả trích xuất")
+    parser.add_argument("--cache_max_mb", type=int, default=512)
+    parser.add_argument("--manifest", default=None,
+                        help="File manifest SQLite (vd: <input_dir>/.manifest.sqlite của OCR runner) để chạy tiếp khi bị dừng")
+    parser.add_argument("--chunk_size", type=int, default=32, help="Số file mỗi lần checkpoint vào manifest")
+    parser.add_argument("--retry_failed", action="store_true", help="Chạy lại cả các file đã failed")
+    parser.add_argument("--trace", nargs="?", const="extraction_trace.json", default=None,
+                        help="Đo thời gian từng bước cho từng file, lưu trace Chrome/Perfetto vào file này")
+    parser.add_argument("--token_ledger", nargs="?", const="extraction_token_ledger.json", default=None,
+                        help="Ghi số token prompt / output của từng file ra file này "
+                             "(gộp với ledger của OCR runner bằng: python token_ledger.py merge ...)")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="Đo RSS, top allocators (tracemalloc), tensor còn giữ sau mỗi chunk")
+    parser.add_argument("--metrics_file", default=None,
+                        help="Ghi metric Prometheus (số ảnh, số lỗi, số token, ...) ra file này khi chạy xong")
+    add_shard_args(parser)
+    add_profile_args(parser, "extraction_profile.collapsed")
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable()
+    if args.token_ledger:
+        ledger.enable()
+    if args.profile_memory:
+        memory_profiler.enable()
+
+    cache = None
+    if args.cache_file:
+        if args.deterministic:
+            cache = DiskLRUCache(args.cache_file, max_bytes=args.cache_max_mb * 1024 * 1024, name="extraction cache")
+        else:
+            print("Extraction cache disabled: sampling decode is not reproducible, add --deterministic to use it.")
+
+    input_dir = args.input_dir
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"LLM Processing from: {input_dir}")
+
+    # Quét cả folder con; mỗi worker (--num-shards/--shard-id) chỉ xử lý phần của mình
+    md_paths = [p for p in discover_files(input_dir, (".md",)) if not p.endswith("det.md")]
+    md_paths = select_shard(md_paths, input_dir, args.num_shards, args.shard_id)
+
+    manifest = JobManifest(args.manifest) if args.manifest else None
+    if manifest is not None:
+        # Bỏ qua các file đã trích xuất xong ở lần chạy trước
+        states = manifest.states()
+        skip_states = FINISHED_STATES if args.retry_failed else FINISHED_STATES + (FAILED,)
+        md_paths = [p for p in md_paths if states.get(image_id(p, input_dir)) not in skip_states]
+        print(f"{len(md_paths)} files left to extract")
+
+    # --profile: load model trước để chỉ lấy mẫu phần trích xuất
+    profiler = profiler_from_args(args)
+    if profiler is not None and md_paths:
+        load_model()
+        profiler.start()
+
+    for chunk in chunked(md_paths, args.chunk_size):
+        extracted, failed = [], []
+
+        for file_path in chunk:
+            filename = os.path.basename(file_path)
+            # ID như OCR runner: đường dẫn tương đối không đuôi (Coopmart/1), output lưu theo cùng folder con
+            name = image_id(file_path, input_dir)
+            print(f"Processing: {filename}...")
+        
+            with open(file_path, "r", encoding="utf-8") as f:
+                file_text = f.read()
+
+            # Bỏ qua file rỗng hoặc quá ngắn
+            if len(file_text.strip()) < 10:
+                print(f"Skipping empty file: {filename}")
+                failed.append((name, "empty OCR result"))
+                FAILURES.inc(stage="extraction", reason="empty")
+                continue
+
+            json_text = extract_json_from_text(file_text, cache=cache, deterministic=args.deterministic, name=name)
+            if save_json_result(json_text, output_dir, name) is None:
+                failed.append((name, "JSON parse error"))
+            else:
+                extracted.append((name, json_text))
+
+        memory_profiler.checkpoint("extraction", images=len(chunk))
+
+        # Checkpoint 1 lần cho mỗi chunk
+        if manifest is not None:
+            manifest.mark_extracted(extracted)
+            manifest.mark_failed(failed)
+
+    finish_profile(profiler, args.profile)
+
+    if manifest is not None:
+        print(manifest.format_counts())
+    if cache is not None:
+        print(cache.format_stats())
+    if args.trace:
+        print(tracer.format_summary())
+        tracer.export(args.trace)
+    if args.metrics_file:
+        registry.write(args.metrics_file)
+    if args.token_ledger:
+        print(ledger.format_table())
+        ledger.write(args.token_ledger)
+    if args.profile_memory:
+        print(memory_profiler.format_summary())
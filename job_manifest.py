@@ -0,0 +1,135 @@
+"""
+Manifest theo từng ảnh (1 file SQLite) để chạy tiếp được sau khi bị dừng giữa chừng.
+
+Mỗi ảnh có 1 trạng thái:
+    discovered -> ocr_done -> extracted -> evaluated
+                \\-> failed (ở bất kỳ bước nào)
+Markdown OCR và JSON trích xuất cũng được lưu lại để lần chạy sau không phải làm lại.
+
+OCR runner và vòng lặp LLM ghi checkpoint theo chunk: mỗi lần gọi mark_*() là 1 transaction,
+nên khi crash / bị preempt chỉ mất tối đa 1 chunk.
+"""
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+DISCOVERED = "discovered"
+OCR_DONE = "ocr_done"
+EXTRACTED = "extracted"
+EVALUATED = "evaluated"
+FAILED = "failed"
+
+STATES = [DISCOVERED, OCR_DONE, EXTRACTED, EVALUATED, FAILED]
+FINISHED_STATES = (EXTRACTED, EVALUATED)
+
+def chunked(items: Sequence, size: Optional[int]) -> Iterator[Sequence]:
+    """Chia list thành các chunk size phần tử (size None/0 = 1 chunk duy nhất)."""
+    if not size:
+        if items:
+            yield items
+        return
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class JobManifest:
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            " image_id TEXT PRIMARY KEY, image_path TEXT NOT NULL DEFAULT '',"
+            " state TEXT NOT NULL, markdown TEXT, json_text TEXT, error TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS images_state ON images(state)")
+
+    def _write(self, sql: str, rows: List[tuple]):
+        """Ghi nhiều dòng trong 1 transaction (= 1 checkpoint)."""
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_images(self, images: Iterable[Tuple[str, str]]):
+        """Đăng ký ảnh mới ở trạng thái discovered; ảnh đã có trong manifest giữ nguyên trạng thái."""
+        now = time.time()
+        self._write(
+            "INSERT OR IGNORE INTO images(image_id, image_path, state, updated_at) VALUES (?, ?, ?, ?)",
+            [(image_id, image_path, DISCOVERED, now) for image_id, image_path in images])
+
+    def mark_ocr_done(self, items: Iterable[Tuple[str, str]]):
+        """items: (image_id, markdown)"""
+        now = time.time()
+        self._write(
+            "INSERT INTO images(image_id, state, markdown, error, updated_at) VALUES (?, ?, ?, NULL, ?) "
+            "ON CONFLICT(image_id) DO UPDATE SET state = excluded.state, markdown = excluded.markdown,"
+            " error = NULL, updated_at = excluded.updated_at",
+            [(image_id, OCR_DONE, markdown, now) for image_id, markdown in items])
+
+    def mark_extracted(self, items: Iterable[Tuple[str, str]]):
+        """items: (image_id, json_text)"""
+        now = time.time()
+        self._write(
+            "INSERT INTO images(image_id, state, json_text, error, updated_at) VALUES (?, ?, ?, NULL, ?) "
+            "ON CONFLICT(image_id) DO UPDATE SET state = excluded.state, json_text = excluded.json_text,"
+            " error = NULL, updated_at = excluded.updated_at",
+            [(image_id, EXTRACTED, json_text, now) for image_id, json_text in items])
+
+    def mark_failed(self, items: Iterable[Tuple[str, str]]):
+        """items: (image_id, error)"""
+        now = time.time()
+        self._write(
+            "INSERT INTO images(image_id, state, error, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(image_id) DO UPDATE SET state = excluded.state, error = excluded.error,"
+            " updated_at = excluded.updated_at",
+            [(image_id, FAILED, error, now) for image_id, error in items])
+
+    def mark_evaluated(self, image_ids: Iterable[str]):
+        now = time.time()
+        self._write("UPDATE images SET state = ?, updated_at = ? WHERE image_id = ?",
+                    [(EVALUATED, now, image_id) for image_id in image_ids])
+
+    def get(self, image_id: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT image_id, image_path, state, markdown, json_text, error FROM images WHERE image_id = ?",
+                (image_id,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(["image_id", "image_path", "state", "markdown", "json_text", "error"], row))
+
+    def records(self) -> Dict[str, Dict[str, str]]:
+        """Toàn bộ manifest trong 1 lần đọc: image_id -> {state, markdown, json_text, error}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT image_id, state, markdown, json_text, error FROM images").fetchall()
+        return {row[0]: dict(zip(["state", "markdown", "json_text", "error"], row[1:])) for row in rows}
+
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT image_id, state FROM images").fetchall())
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = dict(self._conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state").fetchall())
+        return {state: rows.get(state, 0) for state in STATES}
+
+    def format_counts(self) -> str:
+        return "[manifest] " + " | ".join(f"{state}: {n}" for state, n in self.counts().items())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,321 @@
+"""
+Hàng đợi công việc (work-stealing) trên 1 file SQLite cho nhiều worker / nhiều máy.
+
+Khác với chia shard tĩnh (sharding.py): worker nào rảnh thì tự lấy (claim) batch tiếp theo,
+nên worker nhanh không phải ngồi chờ worker đang xử lý hoá đơn dài.
+
+Mỗi job thuộc 1 stage ("ocr" -> "extract") và có trạng thái:
+    queued -> leased (có hạn lease) -> done
+                                    \\-> failed (lỗi quá max_attempts lần)
+claim / complete / fail đều là 1 transaction (BEGIN IMMEDIATE). Worker bị crash không gia hạn
+lease nữa, job của nó hết hạn và được trả lại hàng đợi ở lần claim kế tiếp của worker khác.
+
+Dùng chung giữa nhiều máy theo 2 cách:
+  - file SQLite trên NFS: JobQueue(path, nfs=True) (journal DELETE thay cho WAL, WAL không chạy trên NFS)
+  - server nhỏ: python job_queue.py serve --db queue.sqlite --port 8765,
+    worker dùng open_queue("http://host:8765") (cùng interface với JobQueue).
+    Server không có xác thực và worker đọc image_path bất kỳ trong payload, nên mặc định chỉ nghe
+    127.0.0.1; worker ở máy khác thì chạy với --host 0.0.0.0 (hoặc IP nội bộ) trong mạng tin cậy.
+
+    python job_queue.py enqueue --queue queue.sqlite --input_dir inputs
+    python queue_worker.py ocr --queue queue.sqlite        # trên mỗi GPU chạy OCR
+    python queue_worker.py extract --queue queue.sqlite --output_dir outputs
+    python job_queue.py status --queue queue.sqlite
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import urllib.request
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+STATES = [QUEUED, LEASED, DONE, FAILED]
+OCR_STAGE = "ocr"
+EXTRACT_STAGE = "extract"
+
+@dataclass
+class Job:
+    stage: str
+    job_id: str
+    payload: Dict[str, Any]
+    attempts: int = 0
+
+class JobQueue:
+    def __init__(self, path: str, lease_seconds: float = 600, max_attempts: int = 3, nfs: bool = False):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=DELETE" if nfs else "PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " stage TEXT NOT NULL, job_id TEXT NOT NULL, payload TEXT NOT NULL,"
+            " state TEXT NOT NULL, worker TEXT, lease_expires REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (stage, job_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs(stage, state, created_at)")
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, stage: str, items: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """items: (job_id, payload). Job đã có trong hàng đợi (cùng stage) được giữ nguyên."""
+        now = time.time()
+        rows = [(stage, job_id, json.dumps(payload, ensure_ascii=False), QUEUED, now, now)
+                for job_id, payload in items]
+
+        def write(conn):
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs(stage, job_id, payload, state, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+        return self._transaction(write) if rows else 0
+
+    def _requeue_expired(self, conn, stage: str, now: float):
+        # Lease hết hạn = worker đã chết / treo: trả job lại hàng đợi (hoặc failed nếu đã thử đủ số lần)
+        conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+            " error = CASE WHEN attempts >= ? THEN 'lease expired' ELSE error END,"
+            " worker = NULL, lease_expires = NULL, updated_at = ?"
+            " WHERE stage = ? AND state = ? AND lease_expires < ?",
+            (self.max_attempts, FAILED, QUEUED, self.max_attempts, now, stage, LEASED, now))
+
+    def claim(self, stage: str, worker: str, batch_size: int = 1) -> List[Job]:
+        """Lấy tối đa batch_size job đang chờ của stage và lease chúng cho worker."""
+        def write(conn):
+            now = time.time()
+            self._requeue_expired(conn, stage, now)
+            rows = conn.execute(
+                "SELECT job_id, payload, attempts FROM jobs WHERE stage = ? AND state = ?"
+                " ORDER BY created_at, job_id LIMIT ?", (stage, QUEUED, batch_size)).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1,"
+                " updated_at = ? WHERE stage = ? AND job_id = ?",
+                [(LEASED, worker, now + self.lease_seconds, now, stage, job_id) for job_id, _, _ in rows])
+            return [Job(stage, job_id, json.loads(payload), attempts + 1) for job_id, payload, attempts in rows]
+        return self._transaction(write)
+
+    def heartbeat(self, stage: str, worker: str, job_ids: Iterable[str]):
+        """Gia hạn lease cho các job worker vẫn đang xử lý."""
+        now = time.time()
+        rows = [(now + self.lease_seconds, now, stage, job_id, LEASED, worker) for job_id in job_ids]
+        if rows:
+            self._transaction(lambda conn: conn.executemany(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ?"
+                " WHERE stage = ? AND job_id = ? AND state = ? AND worker = ?", rows))
+
+    def complete(self, stage: str, worker: str, results: Iterable[Tuple[str, Dict[str, Any]]],
+                 next_stage: Optional[str] = None) -> int:
+        """
+        Đánh dấu done các job worker đang giữ; next_stage: đưa result vào hàng đợi stage sau
+        trong cùng transaction. Job đã bị worker khác lấy lại (lease hết hạn) thì bỏ qua.
+        """
+        results = [(job_id, json.dumps(result, ensure_ascii=False)) for job_id, result in results]
+
+        def write(conn):
+            now = time.time()
+            completed = 0
+            for job_id, result in results:
+                cur = conn.execute(
+                    "UPDATE jobs SET state = ?, result = ?, error = NULL, worker = NULL, lease_expires = NULL,"
+                    " updated_at = ? WHERE stage = ? AND job_id = ? AND state = ? AND worker = ?",
+                    (DONE, result, now, stage, job_id, LEASED, worker))
+                if cur.rowcount and next_stage:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO jobs(stage, job_id, payload, state, created_at, updated_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?)", (next_stage, job_id, result, QUEUED, now, now))
+                completed += cur.rowcount
+            return completed
+        return self._transaction(write) if results else 0
+
+    def fail(self, stage: str, worker: str, errors: Iterable[Tuple[str, str]], retry: bool = True):
+        """errors: (job_id, error). retry=True: trả lại hàng đợi nếu chưa thử đủ max_attempts lần."""
+        now = time.time()
+        rows = [(FAILED if not retry else None, self.max_attempts, FAILED, QUEUED, error, now,
+                 stage, job_id, LEASED, worker) for job_id, error in errors]
+        if rows:
+            self._transaction(lambda conn: conn.executemany(
+                "UPDATE jobs SET state = COALESCE(?, CASE WHEN attempts >= ? THEN ? ELSE ? END),"
+                " error = ?, worker = NULL, lease_expires = NULL, updated_at = ?"
+                " WHERE stage = ? AND job_id = ? AND state = ? AND worker = ?", rows))
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state").fetchall()
+        counts = {}
+        for stage, state, n in rows:
+            counts.setdefault(stage, {s: 0 for s in STATES})[state] = n
+        return counts
+
+    def pending(self, stage: str) -> int:
+        """Số job của stage chưa xong (queued + leased)."""
+        c = self.counts().get(stage, {})
+        return c.get(QUEUED, 0) + c.get(LEASED, 0)
+
+    def format_counts(self) -> str:
+        return " || ".join(f"[queue:{stage}] " + " | ".join(f"{s}: {n}" for s, n in c.items())
+                           for stage, c in sorted(self.counts().items())) or "[queue] empty"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# =============================================================================
+# SERVER / CLIENT (dùng chung hàng đợi qua HTTP khi không có NFS)
+# =============================================================================
+
+class RemoteJobQueue:
+    """Client của `python job_queue.py serve`, cùng interface với JobQueue."""
+
+    def __init__(self, url: str, timeout: float = 60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._config = None
+
+    def _call(self, method: str, **kwargs):
+        request = urllib.request.Request(
+            f"{self.url}/{method}", data=json.dumps(kwargs, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    @property
+    def lease_seconds(self) -> float:
+        """Thời hạn lease do server quyết định (--lease_seconds của serve), worker gia hạn theo giá trị này."""
+        if self._config is None:
+            self._config = self._call("config")
+        return self._config["lease_seconds"]
+
+    def enqueue(self, stage, items):
+        return self._call("enqueue", stage=stage, items=[list(i) for i in items])
+
+    def claim(self, stage, worker, batch_size=1):
+        return [Job(**job) for job in self._call("claim", stage=stage, worker=worker, batch_size=batch_size)]
+
+    def heartbeat(self, stage, worker, job_ids):
+        self._call("heartbeat", stage=stage, worker=worker, job_ids=list(job_ids))
+
+    def complete(self, stage, worker, results, next_stage=None):
+        return self._call("complete", stage=stage, worker=worker, results=[list(r) for r in results],
+                          next_stage=next_stage)
+
+    def fail(self, stage, worker, errors, retry=True):
+        self._call("fail", stage=stage, worker=worker, errors=[list(e) for e in errors], retry=retry)
+
+    def counts(self):
+        return self._call("counts")
+
+    pending = JobQueue.pending
+    format_counts = JobQueue.format_counts
+
+    def close(self):
+        pass
+
+def make_server(queue: JobQueue, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+    methods = {
+        "enqueue": queue.enqueue,
+        "claim": lambda **kw: [asdict(job) for job in queue.claim(**kw)],
+        "heartbeat": queue.heartbeat,
+        "complete": queue.complete,
+        "fail": queue.fail,
+        "counts": queue.counts,
+        "config": lambda: {"lease_seconds": queue.lease_seconds, "max_attempts": queue.max_attempts},
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = methods.get(self.path.strip("/"))
+            if method is None:
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                kwargs = json.loads(self.rfile.read(length) or b"{}")
+                body, status = json.dumps(method(**kwargs), ensure_ascii=False).encode("utf-8"), 200
+            except Exception as e:
+                body, status = json.dumps({"error": str(e)}).encode("utf-8"), 500
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Không in 1 dòng log cho mỗi lần claim
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+def open_queue(spec: str, **kwargs):
+    """
+    spec là URL http(s)://... (server) hoặc đường dẫn file SQLite.
+    kwargs (lease_seconds, max_attempts, nfs) chỉ dùng cho file SQLite, server có cài đặt riêng
+    (RemoteJobQueue.lease_seconds đọc lại từ server).
+    """
+    if spec.startswith(("http://", "https://")):
+        return RemoteJobQueue(spec)
+    return JobQueue(spec, **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hàng đợi OCR / trích xuất dùng chung cho nhiều worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="Chạy server hàng đợi nhỏ trên file SQLite local")
+    serve.add_argument("--db", default="queue.sqlite")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="Địa chỉ nghe; worker ở máy khác cần --host 0.0.0.0 hoặc IP nội bộ "
+                            "(không có xác thực, chỉ dùng trong mạng tin cậy)")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--lease_seconds", type=float, default=600)
+    serve.add_argument("--max_attempts", type=int, default=3)
+
+    enqueue = sub.add_parser("enqueue", help="Đưa toàn bộ ảnh trong input_dir (đệ quy) vào hàng đợi OCR")
+    enqueue.add_argument("--queue", required=True, help="File SQLite hoặc URL server")
+    enqueue.add_argument("--input_dir", required=True)
+
+    status = sub.add_parser("status", help="In số job theo stage / trạng thái")
+    status.add_argument("--queue", required=True, help="File SQLite hoặc URL server")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = make_server(JobQueue(args.db, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts),
+                             args.host, args.port)
+        print(f"Job queue ({args.db}) listening on http://{args.host}:{args.port}")
+        server.serve_forever()
+    elif args.command == "enqueue":
+        from sharding import discover_images, relative_key, image_id
+        queue = open_queue(args.queue)
+        images = discover_images(args.input_dir)
+        # job_id = đường dẫn tương đối không đuôi (Coopmart/1): ảnh cùng tên ở 2 folder là 2 job
+        added = queue.enqueue(OCR_STAGE, [
+            (image_id(p, args.input_dir),
+             {"image_path": os.path.abspath(p), "relative_path": relative_key(p, args.input_dir)})
+            for p in images])
+        print(f"Enqueued {added} new images ({len(images)} found)")
+        print(queue.format_counts())
+    else:
+        print(open_queue(args.queue).format_counts())
+    sys.exit(0)
@@ -1,228 +1,286 @@
-import os
-import shutil
-import subprocess
-import sys
-import json
-import re
-import cv2
-import numpy as np
-
-# ================= CẤU HÌNH ĐƯỜNG DẪN =================
-INPUT_DIR = "inputs"
-GT_DIR = "ground_truth"
-FINAL_OUTPUT_DIR = "outputs"      
-OCR_SAVE_DIR = "ocr_results"      # Folder lưu kết quả OCR
-TEMP_DIR = "temp"                 # Folder tạm chứa ảnh đã qua xử lý
-EVAL_REPORT_FILE = "final_evaluation_report.json"
-
-# --- CẤU HÌNH DEEPSEEK (SỬA CHO ĐÚNG MÁY BẠN) ---
-DEEPSEEK_REPO_DIR = "DeepSeek-OCR/DeepSeek-OCR-master/DeepSeek-OCR-vllm" 
-PATH_TO_OCR_SCRIPT = os.path.join(DEEPSEEK_REPO_DIR, "run_dpsk_ocr_eval_batch.py")
-PATH_TO_CONFIG_FILE = os.path.join(DEEPSEEK_REPO_DIR, "config.py")
-
-PATH_TO_LLM_SCRIPT = "deepseek_llm_7b.py"
-PATH_TO_EVAL_SCRIPT = "parse_level_evaluate.py"
-
-# ================= CÁC HÀM TIỆN ÍCH HIỂN THỊ =================
-
-def print_styled_table(title, headers, rows, col_widths):
-    """Hàm in bảng đẹp với khung Unicode (Copy từ evaluate script)"""
-    TL, TM, TR = '┌', '┬', '┐'; BL, BM, BR = '└', '┴', '┘'
-    VL, VR = '│', '│'; HL, VM = '─', '┼'; ML, MR = '├', '┤'
-
-    fmt_parts = [f" {{{i}:{'<' if i==0 else '>'}{w}}} " for i, w in enumerate(col_widths)]
-    row_fmt = VL + VL.join(fmt_parts) + VR
-    
-    def get_sep(left, mid, right, cross):
-        segs = [mid * (w + 2) for w in col_widths]
-        return left + cross.join(segs) + right
-
-    print("\n" + " " + title.upper())
-    print(get_sep(TL, HL, TR, TM))
-    print(row_fmt.format(*headers))
-    print(get_sep(ML, HL, MR, VM))
-    for row in rows:
-        print(row_fmt.format(*row))
-    print(get_sep(BL, HL, BR, BM))
-
-# ================= CÁC HÀM PIPELINE =================
-
-def setup_dirs():
-    # Dọn dẹp folder tạm
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR, ignore_errors=True)
-        
-    os.makedirs(FINAL_OUTPUT_DIR, exist_ok=True)
-    os.makedirs(OCR_SAVE_DIR, exist_ok=True)
-    
-    if not os.path.exists(GT_DIR):
-        os.makedirs(GT_DIR)
-
-def update_deepseek_config(config_path, input_path, output_path):
-    print(f"Updating config file...")
-    abs_input = os.path.abspath(input_path)
-    abs_output = os.path.abspath(output_path)
-    
-    # [QUAN TRỌNG] Thêm dấu / vào cuối đường dẫn output để tránh lỗi dính tên file
-    if not abs_output.endswith(os.sep):
-        abs_output += os.sep
-
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Regex thay thế đường dẫn
-        content = re.sub(r"INPUT_PATH\s*=\s*['\"].*?['\"]", f"INPUT_PATH = '{abs_input}'", content)
-        content = re.sub(r"OUTPUT_PATH\s*=\s*['\"].*?['\"]", f"OUTPUT_PATH = '{abs_output}'", content)
-        # Bắt buộc bật chế độ tự cắt ảnh (CROP_MODE) cho ảnh dài
-        content = re.sub(r"CROP_MODE\s*=\s*(False|True)", "CROP_MODE = True", content)
-
-        with open(config_path, 'w', encoding='utf-8') as f:
-            f.write(content) 
-        print(" Config updated successfully!")
-    except Exception as e:
-        print(f"Error updating config: {e}")
-        sys.exit(1)
-
-def run_deepseek_ocr():
-    print("\n>>> STEP 1: Running DeepSeek-OCR...")
-    
-    # Update config để trỏ vào folder ảnh đầu vào
-    update_deepseek_config(PATH_TO_CONFIG_FILE, INPUT_DIR, OCR_SAVE_DIR)
-    
-    working_dir = os.path.dirname(PATH_TO_OCR_SCRIPT)
-    command = [sys.executable, PATH_TO_OCR_SCRIPT]
-    
-    # Chạy OCR và ẩn bớt output rác nếu muốn, ở đây để hiện để debug
-    result = subprocess.run(command, cwd=working_dir)
-    if result.returncode != 0:
-        print(" ERROR: DeepSeek-OCR failed!")
-        sys.exit(1)
-
-def run_deepseek_llm():
-    print("\n>>> STEP 2: Running DeepSeek-LLM Extraction...")
-    
-    # Xóa file rác _det.md sinh ra từ bước OCR
-    for f in os.listdir(OCR_SAVE_DIR):
-        if "_det.md" in f:
-            try: os.remove(os.path.join(OCR_SAVE_DIR, f))
-            except: pass
-
-    if not os.listdir(OCR_SAVE_DIR):
-        print("No markdown files found. Skipping LLM...")
-        return
-
-    command = [
-        sys.executable, PATH_TO_LLM_SCRIPT,
-        "--input_dir", OCR_SAVE_DIR, 
-        "--output_dir", FINAL_OUTPUT_DIR
-    ]
-    subprocess.run(command, check=True)
-
-def evaluate():
-    print("\n>>> STEP 3: Evaluating Results...")
-    
-    gt_files = [f for f in os.listdir(GT_DIR) if f.endswith('.json')]
-    if not gt_files:
-        print(f"Skipping evaluation (No GT files in '{GT_DIR}').")
-        return
-
-    # Chạy script đánh giá và lưu kết quả vào JSON, không in ra màn hình console của subprocess
-    command = [
-        sys.executable, PATH_TO_EVAL_SCRIPT,
-        "--gt_dir", GT_DIR,
-        "--pred_dir", FINAL_OUTPUT_DIR,
-        "--out", EVAL_REPORT_FILE
-    ]
-    
-    # capture_output=True để script đánh giá không in bảng 2 lần (1 lần trong subprocess, 1 lần ở đây)
-    result = subprocess.run(command, capture_output=True, text=True)
-    
-    if result.returncode == 0:
-        print(f"Evaluation Calculation Complete! Reading report...")
-        
-        if not os.path.exists(EVAL_REPORT_FILE):
-            print("Error: Report file not found.")
-            return
-
-        try:
-            with open(EVAL_REPORT_FILE, 'r', encoding='utf-8') as f:
-                report = json.load(f)
-                
-            summ = report.get('summary', {})
-            total = summ.get('total_images', 0)
-            
-            print("\n" * 2)
-            print(f"📊  BÁO CÁO ĐÁNH GIÁ TỔNG HỢP (Images: {total})")
-            print("=" * 135)
-            
-            # Cấu hình bảng hiển thị
-            headers = ["FIELD", "T_PRE", "T_REC", "T_F1", "T_ACC", "C_PRE", "C_REC", "C_F1", "C_ACC", "EDIT", "WER", "CER"]
-            widths =  [18,      6,       6,       6,      6,       6,       6,       6,       6,       6,      6,     6]
-
-            # 1. OVERALL SYSTEM
-            ov = summ.get("overall", {})
-            rows_ov = [[
-                "OVERALL",
-                f"{ov.get('precision',0):.1%}", f"{ov.get('recall',0):.1%}", f"{ov.get('f1_score',0):.1%}", f"{ov.get('accuracy',0):.1%}",
-                f"{ov.get('char_precision',0):.1%}", f"{ov.get('char_recall',0):.1%}", f"{ov.get('char_f1',0):.1%}", f"{ov.get('char_accuracy',0):.1%}",
-                f"{ov.get('avg_edit_distance',0):.2f}", f"{ov.get('avg_wer',0):.2f}", f"{ov.get('avg_cer',0):.2f}"
-            ]]
-            print_styled_table("🔷 TỔNG QUAN (OVERALL SYSTEM)", headers, rows_ov, widths)
-
-            # 2. GENERAL FIELDS
-            rows_gen = []
-            for k, v in summ.get("fields", {}).items():
-                rows_gen.append([
-                    k,
-                    f"{v['precision']:.1%}", f"{v['recall']:.1%}", f"{v['f1_score']:.1%}", f"{v['accuracy']:.1%}",
-                    f"{v['char_precision']:.1%}", f"{v['char_recall']:.1%}", f"{v['char_f1']:.1%}", f"{v['char_accuracy']:.1%}",
-                    f"{v['edit_distance']:.2f}", f"{v['wer']:.2f}", f"{v['cer']:.2f}"
-                ])
-            print_styled_table("🔷 THÔNG TIN CHUNG (HEADER FIELDS)", headers, rows_gen, widths)
-
-            # 3. LINE ITEMS
-            rows_li = []
-            li_gen = summ.get("line_item", {}).get("general", {})
-            li_subs = summ.get("line_item", {}).get("sub_fields", {})
-            
-            # System Level (Detection only)
-            rows_li.append([
-                "► LI (SYSTEM)",
-                f"{li_gen.get('precision',0):.1%}", f"{li_gen.get('recall',0):.1%}", f"{li_gen.get('f1_score',0):.1%}", f"{li_gen.get('accuracy',0):.1%}",
-                "-", "-", "-", "-", 
-                "-", "-", "-"
-            ])
-            
-            # Sub-fields
-            for k, v in li_subs.items():
-                rows_li.append([
-                    f"  └ {k}",
-                    f"{v['precision']:.1%}", f"{v['recall']:.1%}", f"{v['f1_score']:.1%}", f"{v['accuracy']:.1%}",
-                    f"{v['char_precision']:.1%}", f"{v['char_recall']:.1%}", f"{v['char_f1']:.1%}", f"{v['char_accuracy']:.1%}",
-                    f"{v['edit_distance']:.2f}", f"{v['wer']:.2f}", f"{v['cer']:.2f}"
-                ])
-                
-            print_styled_table("🔷 CHI TIẾT SẢN PHẨM (LINE ITEMS)", headers, rows_li, widths)
-            
-            print("\n📝 GHI CHÚ:")
-            print("  - T_...: Token Metrics (Theo từ).")
-            print("  - C_...: Char Metrics (Theo ký tự).")
-            print("  - EDIT: Edit Distance (Số thao tác sửa đổi).")
-            print("=" * 135 + "\n")
-
-        except Exception as e:
-            print(f"Error displaying report: {e}")
-            # Nếu lỗi hiển thị bảng, in raw output từ subprocess để debug
-            print("Raw output from eval script:")
-            print(result.stdout)
-            print(result.stderr)
-    else:
-        print("Evaluation Script Failed!")
-        print(result.stderr)
-
-if __name__ == "__main__":
-    setup_dirs()
-    run_deepseek_ocr()
-    run_deepseek_llm()
-    evaluate()
\ No newline at end of file
+import os
+import shutil
+import sys
+import json
+import argparse
+
+from pipeline import Pipeline, OCRStage, ExtractionStage, EvaluationStage, discover_images
+from result_cache import DiskLRUCache, TensorCache
+from job_manifest import JobManifest
+from sharding import add_shard_args, select_shard, shard_suffix
+from daemon import WatchDaemon
+from tracing import tracer
+from metrics import registry
+from token_ledger import ledger
+from memprofile import memory_profiler
+from sampling_profiler import add_profile_args, profiler_from_args, finish_profile
+
+# ================= CẤU HÌNH ĐƯỜNG DẪN =================
+INPUT_DIR = "inputs"
+GT_DIR = "ground_truth"
+FINAL_OUTPUT_DIR = "outputs"      
+TEMP_DIR = "temp"                 # Folder tạm chứa ảnh đã qua xử lý
+EVAL_REPORT_FILE = "final_evaluation_report.json"
+OCR_CACHE_FILE = ".cache/ocr_cache.sqlite"   # Cache kết quả OCR giữa các lần chạy
+OCR_CACHE_MAX_MB = 2048
+PREPROCESS_CACHE_DIR = ".cache/preprocess"   # Tensor ảnh đã tiền xử lý (dùng lại khi đổi prompt OCR)
+PREPROCESS_CACHE_MAX_MB = 8192
+EXTRACT_CACHE_FILE = ".cache/extraction_cache.sqlite"   # Chỉ dùng với --deterministic
+EXTRACT_CACHE_MAX_MB = 512
+MANIFEST_FILE = os.path.join(FINAL_OUTPUT_DIR, ".manifest.sqlite")   # Trạng thái từng ảnh, để chạy tiếp khi bị dừng
+TRACE_FILE = "pipeline_trace.json"   # --trace: mở bằng https://ui.perfetto.dev
+PROFILE_FILE = "pipeline_profile.collapsed"   # --profile: collapsed stacks cho flamegraph.pl / speedscope
+TOKEN_LEDGER_FILE = "token_ledger.json"   # --token_ledger: số token từng ảnh, cộng theo retailer
+CHUNK_SIZE = 256                  # Số ảnh mỗi lần checkpoint vào manifest
+
+# --- CẤU HÌNH DEEPSEEK (SỬA CHO ĐÚNG MÁY BẠN) ---
+DEEPSEEK_REPO_DIR = "DeepSeek-OCR/DeepSeek-OCR-master/DeepSeek-OCR-vllm" 
+PATH_TO_OCR_SCRIPT = os.path.join(DEEPSEEK_REPO_DIR, "run_dpsk_ocr_eval_batch.py")
+# Cài đặt OCR chỉ áp dụng trong process này (config.py không bị sửa nên chạy nhiều pipeline song song được).
+# Bắt buộc bật chế độ tự cắt ảnh (CROP_MODE) cho ảnh dài
+OCR_SETTINGS = {"CROP_MODE": True}
+# OCR (vLLM) và LLM 7B cùng nằm trên 1 GPU trong 1 process
+OCR_GPU_MEMORY_UTILIZATION = 0.5
+
+# ================= CÁC HÀM TIỆN ÍCH HIỂN THỊ =================
+
+def print_styled_table(title, headers, rows, col_widths):
+    """Hàm in bảng đẹp với khung Unicode (Copy từ evaluate script)"""
+    TL, TM, TR = '┌', '┬', '┐'; BL, BM, BR = '└', '┴', '┘'
+    VL, VR = '│', '│'; HL, VM = '─', '┼'; ML, MR = '├', '┤'
+
+    fmt_parts = [f" {{{i}:{'<' if i==0 else '>'}{w}}} " for i, w in enumerate(col_widths)]
+    row_fmt = VL + VL.join(fmt_parts) + VR
+    
+    def get_sep(left, mid, right, cross):
+        segs = [mid * (w + 2) for w in col_widths]
+        return left + cross.join(segs) + right
+
+    print("\n" + " " + title.upper())
+    print(get_sep(TL, HL, TR, TM))
+    print(row_fmt.format(*headers))
+    print(get_sep(ML, HL, MR, VM))
+    for row in rows:
+        print(row_fmt.format(*row))
+    print(get_sep(BL, HL, BR, BM))
+
+# ================= CÁC HÀM PIPELINE =================
+
+def setup_dirs(fresh=False):
+    # Dọn dẹp folder tạm
+    if os.path.exists(TEMP_DIR):
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    # Chạy lại từ đầu: bỏ manifest cũ (kể cả file WAL của SQLite)
+    if fresh:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(MANIFEST_FILE + suffix):
+                os.remove(MANIFEST_FILE + suffix)
+        
+    os.makedirs(FINAL_OUTPUT_DIR, exist_ok=True)
+    
+    if not os.path.exists(GT_DIR):
+        os.makedirs(GT_DIR)
+
+def print_report(report):
+    """In báo cáo đánh giá (dict trả về từ parse_level_evaluate) dưới dạng bảng"""
+    try:
+        summ = report.get('summary', {})
+        total = summ.get('total_images', 0)
+        
+        print("\n" * 2)
+        print(f"📊  BÁO CÁO ĐÁNH GIÁ TỔNG HỢP (Images: {total})")
+        print("=" * 135)
+        
+        # Cấu hình bảng hiển thị
+        headers = ["FIELD", "T_PRE", "T_REC", "T_F1", "T_ACC", "C_PRE", "C_REC", "C_F1", "C_ACC", "EDIT", "WER", "CER"]
+        widths =  [18,      6,       6,       6,      6,       6,       6,       6,       6,       6,      6,     6]
+
+        # 1. OVERALL SYSTEM
+        ov = summ.get("overall", {})
+        rows_ov = [[
+            "OVERALL",
+            f"{ov.get('precision',0):.1%}", f"{ov.get('recall',0):.1%}", f"{ov.get('f1_score',0):.1%}", f"{ov.get('accuracy',0):.1%}",
+            f"{ov.get('char_precision',0):.1%}", f"{ov.get('char_recall',0):.1%}", f"{ov.get('char_f1',0):.1%}", f"{ov.get('char_accuracy',0):.1%}",
+            f"{ov.get('avg_edit_distance',0):.2f}", f"{ov.get('avg_wer',0):.2f}", f"{ov.get('avg_cer',0):.2f}"
+        ]]
+        print_styled_table("🔷 TỔNG QUAN (OVERALL SYSTEM)", headers, rows_ov, widths)
+
+        # 2. GENERAL FIELDS
+        rows_gen = []
+        for k, v in summ.get("fields", {}).items():
+            rows_gen.append([
+                k,
+                f"{v['precision']:.1%}", f"{v['recall']:.1%}", f"{v['f1_score']:.1%}", f"{v['accuracy']:.1%}",
+                f"{v['char_precision']:.1%}", f"{v['char_recall']:.1%}", f"{v['char_f1']:.1%}", f"{v['char_accuracy']:.1%}",
+                f"{v['edit_distance']:.2f}", f"{v['wer']:.2f}", f"{v['cer']:.2f}"
+            ])
+        print_styled_table("🔷 THÔNG TIN CHUNG (HEADER FIELDS)", headers, rows_gen, widths)
+
+        # 3. LINE ITEMS
+        rows_li = []
+        li_gen = summ.get("line_item", {}).get("general", {})
+        li_subs = summ.get("line_item", {}).get("sub_fields", {})
+        
+        # System Level (Detection only)
+        rows_li.append([
+            "► LI (SYSTEM)",
+            f"{li_gen.get('precision',0):.1%}", f"{li_gen.get('recall',0):.1%}", f"{li_gen.get('f1_score',0):.1%}", f"{li_gen.get('accuracy',0):.1%}",
+            "-", "-", "-", "-", 
+            "-", "-", "-"
+        ])
+        
+        # Sub-fields
+        for k, v in li_subs.items():
+            rows_li.append([
+                f"  └ {k}",
+                f"{v['precision']:.1%}", f"{v['recall']:.1%}", f"{v['f1_score']:.1%}", f"{v['accuracy']:.1%}",
+                f"{v['char_precision']:.1%}", f"{v['char_recall']:.1%}", f"{v['char_f1']:.1%}", f"{v['char_accuracy']:.1%}",
+                f"{v['edit_distance']:.2f}", f"{v['wer']:.2f}", f"{v['cer']:.2f}"
+            ])
+            
+        print_styled_table("🔷 CHI TIẾT SẢN PHẨM (LINE ITEMS)", headers, rows_li, widths)
+        
+        print("\n📝 GHI CHÚ:")
+        print("  - T_...: Token Metrics (Theo từ).")
+        print("  - C_...: Char Metrics (Theo ký tự).")
+        print("  - EDIT: Edit Distance (Số thao tác sửa đổi).")
+        print("=" * 135 + "\n")
+
+    except Exception as e:
+        print(f"Error displaying report: {e}")
+        # Nếu lỗi hiển thị bảng, in raw report để debug
+        print(json.dumps(report.get('summary', {}), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true",
+                        help="OCR và LLM chạy chồng lên nhau: ảnh nào OCR xong là trích xuất ngay")
+    parser.add_argument("--queue_size", type=int, default=8,
+                        help="Số kết quả OCR tối đa chờ trích xuất (chế độ --stream)")
+    parser.add_argument("--no_cache", action="store_true", help="Tắt cache kết quả OCR / tensor tiền xử lý / trích xuất")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="LLM dùng greedy decoding; bật cache kết quả trích xuất")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Bỏ manifest cũ và chạy lại toàn bộ ảnh (mặc định: chạy tiếp lần trước)")
+    parser.add_argument("--retry_failed", action="store_true", help="Chạy lại cả những ảnh đã lỗi ở lần trước")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Số ảnh mỗi lần checkpoint")
+    parser.add_argument("--input_dir", default=INPUT_DIR, help="Folder ảnh đầu vào")
+    parser.add_argument("--output_dir", default=FINAL_OUTPUT_DIR, help="Folder lưu JSON (và manifest)")
+    parser.add_argument("--ocr_mode", choices=["tiny", "small", "base", "large", "gundam"], default=None,
+                        help="Preset độ phân giải OCR (xem config.py); mặc định: config.py + OCR_SETTINGS")
+    parser.add_argument("--report_file", default=None,
+                        help=f"File báo cáo đánh giá (mặc định {EVAL_REPORT_FILE}, có hậu tố .shard-K-of-N khi chia shard)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Chạy như daemon: theo dõi input_dir và xử lý ảnh mới theo micro-batch (xem daemon.py)")
+    parser.add_argument("--max_batch_size", type=int, default=16, help="(--watch) Số ảnh tối đa mỗi batch")
+    parser.add_argument("--max_wait", type=float, default=5,
+                        help="(--watch) Số giây tối đa ảnh đầu tiên chờ trước khi batch được xử lý")
+    parser.add_argument("--settle_seconds", type=float, default=2,
+                        help="(--watch) File không đổi kích thước / mtime trong ngần ấy giây mới coi là ghi xong")
+    parser.add_argument("--poll_interval", type=float, default=1, help="(--watch) Chu kỳ quét folder (giây)")
+    parser.add_argument("--status_file", default=None,
+                        help="(--watch) Ghi độ sâu hàng đợi / độ trễ ra file JSON sau mỗi batch")
+    parser.add_argument("--trace", nargs="?", const=TRACE_FILE, default=None,
+                        help=f"Đo thời gian từng bước cho từng ảnh, lưu trace Chrome/Perfetto (mặc định {TRACE_FILE}) "
+                             "và thêm bảng p50/p95/p99 vào báo cáo đánh giá")
+    parser.add_argument("--token_ledger", nargs="?", const=TOKEN_LEDGER_FILE, default=None,
+                        help=f"Ghi số token (visual, OCR output, prompt / output LLM) và thời gian từng ảnh, "
+                             f"cộng theo folder retailer (mặc định {TOKEN_LEDGER_FILE})")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="Đo RSS, top allocators (tracemalloc) và tensor / ảnh còn giữ sau mỗi bước, "
+                             "in cuối lần chạy và thêm vào báo cáo đánh giá")
+    parser.add_argument("--metrics_port", type=int, default=None,
+                        help="Mở metric Prometheus tại http://127.0.0.1:<port>/metrics trong lúc chạy")
+    parser.add_argument("--metrics_file", default=None,
+                        help="Ghi metric Prometheus ra file khi chạy xong (--watch: sau mỗi batch)")
+    add_shard_args(parser)
+    add_profile_args(parser, PROFILE_FILE)
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable()
+    if args.metrics_port:
+        registry.serve(args.metrics_port)
+    if args.token_ledger:
+        ledger.enable()
+    if args.profile_memory:
+        memory_profiler.enable()
+
+    # Mỗi instance dùng input/output riêng -> chạy song song nhiều instance (vd mỗi GPU 1 instance,
+    # CUDA_VISIBLE_DEVICES=1 python master_pipeline.py --input_dir inputs/Coopmart --output_dir outputs/Coopmart)
+    INPUT_DIR = args.input_dir
+    FINAL_OUTPUT_DIR = args.output_dir
+    MANIFEST_FILE = os.path.join(FINAL_OUTPUT_DIR, ".manifest.sqlite")
+    # Mỗi shard ghi báo cáo riêng, gộp lại bằng: python sharding.py merge --reports ... --report ...
+    report_file = args.report_file or EVAL_REPORT_FILE.replace(
+        ".json", shard_suffix(args.num_shards, args.shard_id) + ".json")
+
+    setup_dirs(fresh=args.fresh)
+
+    ocr_cache = preprocess_cache = None
+    if not args.no_cache:
+        ocr_cache = DiskLRUCache(OCR_CACHE_FILE, max_bytes=OCR_CACHE_MAX_MB * 1024 * 1024, name="ocr cache")
+        preprocess_cache = TensorCache(PREPROCESS_CACHE_DIR, max_bytes=PREPROCESS_CACHE_MAX_MB * 1024 * 1024,
+                                       name="preprocess cache")
+
+    extract_cache = None
+    if not args.no_cache and args.deterministic:
+        extract_cache = DiskLRUCache(EXTRACT_CACHE_FILE, max_bytes=EXTRACT_CACHE_MAX_MB * 1024 * 1024,
+                                     name="extraction cache")
+
+    pipeline = Pipeline(
+        OCRStage(DEEPSEEK_REPO_DIR, gpu_memory_utilization=OCR_GPU_MEMORY_UTILIZATION,
+                 streaming=args.stream and not args.watch, cache=ocr_cache, mode=args.ocr_mode,
+                 settings={"INPUT_PATH": INPUT_DIR} if args.ocr_mode else {**OCR_SETTINGS, "INPUT_PATH": INPUT_DIR},
+                 preprocess_cache=preprocess_cache),
+        ExtractionStage(FINAL_OUTPUT_DIR, cache=extract_cache, deterministic=args.deterministic),
+        # Daemon không có "cuối batch" để chấm điểm -> đánh giá chạy riêng bằng parse_level_evaluate.py
+        None if args.watch else EvaluationStage(GT_DIR, report_file),
+        manifest=JobManifest(MANIFEST_FILE),
+        chunk_size=args.chunk_size,
+        retry_failed=args.retry_failed,
+        # ID ảnh = đường dẫn tương đối so với INPUT_DIR: inputs/A/1.jpg -> outputs/A/1.json
+        input_dir=INPUT_DIR,
+    )
+    # --profile: load model trước để chỉ lấy mẫu phần xử lý (OCR, trích xuất, đánh giá)
+    profiler = profiler_from_args(args)
+    if profiler is not None:
+        pipeline.load()
+        profiler.start()
+
+    if args.watch:
+        WatchDaemon(pipeline, INPUT_DIR, max_batch_size=args.max_batch_size, max_wait=args.max_wait,
+                    settle_seconds=args.settle_seconds, poll_interval=args.poll_interval,
+                    status_file=args.status_file, metrics_file=args.metrics_file).run_forever()
+        finish_profile(profiler, args.profile)
+        sys.exit(0)
+
+    images = select_shard(discover_images(INPUT_DIR), INPUT_DIR, args.num_shards, args.shard_id)
+    if args.num_shards > 1:
+        print(f"Shard {args.shard_id}/{args.num_shards}: {len(images)} images")
+    if args.stream:
+        result = pipeline.run_streaming(images, queue_size=args.queue_size)
+    else:
+        result = pipeline.run(images)
+    print(f"Time to first JSON: {result.time_to_first_json:.1f}s | Total: {result.wall_time:.1f}s")
+    finish_profile(profiler, args.profile)
+
+    if result.report:
+        print_report(result.report)
+
+    if args.trace:
+        print(tracer.format_summary())
+        tracer.export(args.trace)
+        tracer.append_to_report(report_file)
+        print(f"Timing summary added to: {report_file}")
+
+    if args.metrics_file:
+        registry.write(args.metrics_file)
+
+    if args.token_ledger:
+        print(ledger.format_table())
+        ledger.write(args.token_ledger)
+
+    if args.profile_memory:
+        print(memory_profiler.format_summary())
+        memory_profiler.append_to_report(report_file)
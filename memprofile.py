@@ -0,0 +1,146 @@
+"""
+Đo bộ nhớ sau từng bước (bật bằng `--profile_memory`, tắt mặc định vì tracemalloc làm chậm Python).
+
+Mỗi checkpoint ghi lại:
+- rss_mb / peak_rss_mb: RSS hiện tại và đỉnh RSS của process;
+- traced_mb / traced_peak_mb + top_allocators: bộ nhớ Python theo tracemalloc và các dòng code cấp phát nhiều nhất;
+- tensor_mb / pil_image_mb: tổng dung lượng torch.Tensor (trên CPU) và ảnh PIL còn sống lúc đó.
+
+Các bước đang đo: image_load (ngay sau khi giải mã ảnh cuối của chunk, ảnh PIL còn sống), preprocessing
+(đọc ảnh + tiền xử lý), generate, post_processing (mỗi chunk của run_dpsk_ocr_eval_batch.iter_ocr_chunks)
+và extraction (ExtractionStage / deepseek_llm_7b.py).
+Bảng tổng hợp được in cuối lần chạy và master_pipeline.py ghi thêm vào báo cáo đánh giá (key "memory").
+"""
+import gc
+import os
+import sys
+import json
+import resource
+import threading
+import tracemalloc
+from typing import Any, Dict, List
+
+MB = 1024 * 1024
+
+def current_rss() -> int:
+    """RSS hiện tại (byte), 0 nếu không có /proc (không phải Linux)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux trả về KB, macOS trả về byte
+
+def live_object_bytes() -> Dict[str, int]:
+    """Tổng byte của torch.Tensor trên CPU và ảnh PIL còn được tham chiếu (chỉ xét module đã import)."""
+    torch = sys.modules.get("torch")
+    pil_image = sys.modules.get("PIL.Image")
+    tensor_bytes = pil_bytes = 0
+    seen_storages = set()
+    for obj in gc.get_objects():
+        # type() thay vì isinstance(): isinstance đọc obj.__class__, vài object của torch in cảnh báo deprecated
+        cls = type(obj)
+        if torch is not None and issubclass(cls, torch.Tensor):
+            if obj.device.type != "cpu":
+                continue
+            # View dùng chung storage chỉ tính 1 lần
+            try:
+                storage = obj.untyped_storage()
+            except (RuntimeError, NotImplementedError):
+                continue  # Tensor sparse / meta không có storage thường
+            if storage.data_ptr() in seen_storages:
+                continue
+            seen_storages.add(storage.data_ptr())
+            tensor_bytes += storage.nbytes()
+        elif pil_image is not None and issubclass(cls, pil_image.Image):
+            pil_bytes += obj.width * obj.height * len(obj.getbands())
+    return {"tensor": tensor_bytes, "pil_image": pil_bytes}
+
+class MemoryProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.top_n = 10
+        self.checkpoints: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def enable(self, top_n: int = 10):
+        self.enabled = True
+        self.top_n = top_n
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(8)
+        return self
+
+    def _top_allocators(self) -> List[Dict[str, Any]]:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ])
+        return [{"where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 "size_mb": round(stat.size / MB, 3), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:self.top_n]]
+
+    def checkpoint(self, stage: str, **info):
+        """Ghi trạng thái bộ nhớ ngay sau 1 bước; info (vd images=...) được lưu kèm."""
+        if not self.enabled:
+            return
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        live = live_object_bytes()
+        record = {
+            "stage": stage,
+            "rss_mb": round(current_rss() / MB, 1),
+            "peak_rss_mb": round(peak_rss() / MB, 1),
+            "traced_mb": round(traced / MB, 1),
+            "traced_peak_mb": round(traced_peak / MB, 1),
+            "tensor_mb": round(live["tensor"] / MB, 1),
+            "pil_image_mb": round(live["pil_image"] / MB, 1),
+            "top_allocators": self._top_allocators(),
+            **info,
+        }
+        with self._lock:
+            self.checkpoints.append(record)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Mỗi bước: số lần đo, các giá trị lớn nhất, top allocators của lần đo có traced_mb lớn nhất."""
+        with self._lock:
+            checkpoints = list(self.checkpoints)
+        summary: Dict[str, Dict[str, Any]] = {}
+        for record in checkpoints:
+            row = summary.setdefault(record["stage"], {"count": 0, "top_allocators": [], "_traced": -1.0})
+            row["count"] += 1
+            for key in ("rss_mb", "peak_rss_mb", "traced_mb", "traced_peak_mb", "tensor_mb", "pil_image_mb"):
+                row[f"max_{key}"] = max(row.get(f"max_{key}", 0.0), record[key])
+            if record["traced_mb"] > row["_traced"]:
+                row["_traced"] = record["traced_mb"]
+                row["top_allocators"] = record["top_allocators"]
+        for row in summary.values():
+            del row["_traced"]
+        return summary
+
+    def format_summary(self) -> str:
+        lines = [f"{'STAGE':<16} {'COUNT':>6} {'RSS (MB)':>9} {'PEAK RSS':>9} {'PY HEAP':>9} {'TENSORS':>9} {'PIL':>9}"]
+        summary = self.summary()
+        for stage, row in summary.items():
+            lines.append(f"{stage:<16} {row['count']:>6} {row['max_rss_mb']:>9.1f} {row['max_peak_rss_mb']:>9.1f} "
+                         f"{row['max_traced_mb']:>9.1f} {row['max_tensor_mb']:>9.1f} {row['max_pil_image_mb']:>9.1f}")
+        if summary:
+            stage, row = max(summary.items(), key=lambda item: item[1]["max_traced_mb"])
+            lines.append(f"Top allocators at '{stage}':")
+            lines += [f"  {a['size_mb']:>9.2f} MB  {a['count']:>8}  {a['where']}" for a in row["top_allocators"]]
+        return "\n".join(lines)
+
+    def append_to_report(self, report_file: str):
+        """Thêm bảng bộ nhớ vào báo cáo đánh giá (key "memory"), tạo file nếu chưa có."""
+        report = {}
+        if os.path.exists(report_file):
+            with open(report_file, "r", encoding="utf-8") as f:
+                report = json.load(f)
+        report["memory"] = self.summary()
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+# Dùng chung cho cả process (như tracing.tracer)
+memory_profiler = MemoryProfiler()
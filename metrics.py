@@ -0,0 +1,189 @@
+"""
+Counter / gauge / histogram cho deployment chạy liên tục, xuất theo định dạng text của Prometheus.
+
+    from metrics import IMAGES_PROCESSED
+    IMAGES_PROCESSED.inc(stage="ocr")
+
+Xuất ra:
+- cổng HTTP local: `--metrics_port 9100` (master_pipeline.py), GET /metrics trên server.py;
+- file (cho node_exporter textfile collector) ghi ở cuối lần chạy: `--metrics_file metrics.prom`.
+
+Các metric dùng chung được khai báo ở cuối file để runner OCR, vòng trích xuất, pipeline,
+daemon và server cùng cập nhật 1 registry.
+"""
+import os
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self.values.items())]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]):
+        super().__init__(name, help_text)
+        self.buckets = sorted(buckets)
+        # label key -> (số quan sát theo từng bucket (không cộng dồn), tổng, số lượng)
+        self.values: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total, n = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value, n + 1)
+
+    def get(self, **labels) -> Tuple[float, int]:
+        """(tổng, số lượng) của các quan sát."""
+        _, total, n = self.values.get(_label_key(labels), (None, 0.0, 0))
+        return total, n
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, n) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {n}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError(f"metric {name} already registered as {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float]) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, buckets)
+
+    def render(self) -> str:
+        """Toàn bộ metric theo Prometheus text exposition format 0.0.4."""
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+    def write(self, path: str):
+        """Ghi ra file (ghi file tạm rồi rename để collector không đọc phải file ghi dở)."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+        print(f"Metrics saved to: {path}")
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Mở GET /metrics trên host:port trong thread nền, trả về server (gọi .shutdown() để dừng)."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Prometheus scrape mỗi vài giây, không in log
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        print(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+registry = Registry()
+
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# stage = "ocr" | "extraction"
+IMAGES_PROCESSED = registry.counter("invoice_images_processed_total", "Images finished by a stage")
+# reason = "decode" (ảnh không đọc được), "generate" (lỗi model), "empty" (markdown OCR rỗng)
+FAILURES = registry.counter("invoice_failures_total", "Images that failed in a stage")
+# Mỗi lần lỗi này cũng sinh ra 1 file ERROR_<name>.md trong folder output
+JSON_PARSE_FAILURES = registry.counter("invoice_json_parse_failures_total",
+                                       "LLM outputs that could not be parsed as JSON")
+VISUAL_TOKENS = registry.histogram("invoice_visual_tokens", "Image tokens fed to the OCR model per image",
+                                   TOKEN_BUCKETS)
+GENERATED_TOKENS = registry.histogram("invoice_generated_tokens", "Tokens generated per image", TOKEN_BUCKETS)
+# OCR: cả batch llm.generate; extraction: lần model.generate gần nhất (1 ảnh)
+TOKENS_PER_SECOND = registry.gauge("invoice_tokens_per_second", "Generated tokens per second in the last generate call")
+# queue = "ocr_to_extraction" (--stream), "watch" (daemon), "http" (server.py)
+QUEUE_DEPTH = registry.gauge("invoice_queue_depth", "Items waiting in a queue")
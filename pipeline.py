@@ -0,0 +1,452 @@
+"""
+Pipeline chạy trong cùng 1 process: OCR -> LLM extraction -> evaluation.
+
+Mỗi model chỉ load 1 lần và được giữ lại giữa các stage / các lần chạy.
+Markdown OCR và JSON trích xuất được truyền giữa các stage trong bộ nhớ,
+không đi qua folder ocr_results/ nữa.
+
+Ví dụ:
+    pipeline = Pipeline(OCRStage(), ExtractionStage("outputs"), EvaluationStage("ground_truth"))
+    result = pipeline.run(discover_images("inputs"))
+
+Chế độ streaming (OCRStage(streaming=True) + Pipeline.run_streaming): mỗi kết quả OCR
+được đẩy vào 1 queue có giới hạn ngay khi xong và stage trích xuất lấy ra xử lý luôn,
+nên OCR và LLM chạy chồng lên nhau thay vì chờ nhau hết cả batch.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import threading
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from job_manifest import FINISHED_STATES, OCR_DONE, FAILED, chunked
+from sharding import discover_images, image_id, IMAGE_EXTENSIONS
+from tracing import tracer
+from metrics import FAILURES, QUEUE_DEPTH
+from memprofile import memory_profiler
+
+DEEPSEEK_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "DeepSeek-OCR/DeepSeek-OCR-master/DeepSeek-OCR-vllm")
+
+# =============================================================================
+# 1. DATA STRUCTURES
+# =============================================================================
+
+@dataclass
+class InvoiceResult:
+    name: str                       # ID ảnh (đường dẫn tương đối không có đuôi, vd Coopmart/1), dùng làm tên file output
+    image_path: str
+    raw_ocr: str = ""               # Output gốc của OCR (nội dung file _det.md cũ)
+    markdown: str = ""              # Markdown đã làm sạch (nội dung file .md cũ)
+    json_text: str = ""             # Output thô của LLM
+    data: Optional[Dict[str, Any]] = None   # JSON đã parse, None nếu lỗi / bị bỏ qua
+    error: str = ""
+    finished_at: float = 0.0        # time.perf_counter() lúc trích xuất xong ảnh này
+
+@dataclass
+class PipelineResult:
+    results: List[InvoiceResult] = field(default_factory=list)
+    report: Dict[str, Any] = field(default_factory=dict)
+    wall_time: float = 0.0          # Giây, từ lúc bắt đầu OCR tới khi trích xuất xong ảnh cuối
+    time_to_first_json: float = 0.0 # Giây, từ lúc bắt đầu OCR tới khi có JSON đầu tiên
+
+def image_name(image_path: str, input_dir: Optional[str] = None) -> str:
+    """ID của ảnh, tương đối so với input_dir (xem sharding.image_id)."""
+    return image_id(image_path, input_dir)
+
+# =============================================================================
+# 2. STAGES
+# =============================================================================
+
+class OCRStage:
+    """
+    Bọc run_dpsk_ocr_eval_batch.py: engine vLLM được load 1 lần ở load().
+    streaming=True dùng AsyncLLMEngine (như run_dpsk_ocr_image.py) để trả từng kết quả ngay khi xong.
+    cache: DiskLRUCache (result_cache.py) đặt trước OCR, chỉ ảnh cache miss mới vào llm.generate.
+    preprocess_cache: TensorCache (result_cache.py) lưu tensor ảnh đã tiền xử lý, đổi prompt vẫn dùng lại được.
+    mode / settings: ghi đè config.settings của DeepSeek-OCR trong process này (không sửa file config.py),
+    vd OCRStage(mode="gundam", settings={"CROP_MODE": True, "MAX_CROPS": 6}).
+    """
+
+    def __init__(self, repo_dir: str = DEEPSEEK_REPO_DIR, gpu_memory_utilization: float = 0.5,
+                 streaming: bool = False, cache=None, mode: Optional[str] = None,
+                 settings: Optional[Dict[str, Any]] = None, preprocess_cache=None):
+        self.repo_dir = os.path.abspath(repo_dir)
+        # OCR và LLM 7B dùng chung GPU nên không để vLLM chiếm 0.9 như khi chạy riêng
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.streaming = streaming
+        self.cache = cache
+        self.preprocess_cache = preprocess_cache
+        self.mode = mode
+        self.settings = settings or {}
+        self.runner = None
+        self.llm = None
+        self.engine = None
+        self._loop = None
+
+    def load(self):
+        if self.runner is not None:
+            return
+        # Code DeepSeek-OCR import theo kiểu "from config import ..." nên cần repo_dir trong sys.path
+        if self.repo_dir not in sys.path:
+            sys.path.insert(0, self.repo_dir)
+        from config import settings
+        if self.mode:
+            settings.apply_mode(self.mode)
+        settings.update(**self.settings)
+        import run_dpsk_ocr_eval_batch as runner
+        runner.use_preprocess_cache(self.preprocess_cache)
+        # PREPROCESS_MODE=process: worker processes must exist before the engine holds a CUDA context
+        runner.start_preprocess_pool()
+
+        if self.streaming:
+            # AsyncLLMEngine cần 1 event loop sống suốt đời engine -> chạy loop riêng trong thread nền
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="ocr-engine-loop", daemon=True).start()
+            self.engine = self.build_engine(runner)
+        else:
+            self.llm = self.build_engine(runner)
+        self.runner = runner
+
+    def build_engine(self, runner):
+        """
+        Tạo engine vLLM (AsyncLLMEngine nếu streaming, LLM nếu không).
+        Subclass ghi đè để thay backend, vd backend giả của benchmarks/bench_pipeline.py.
+        """
+        if self.streaming:
+            async def build():
+                return runner.build_async_engine(gpu_memory_utilization=self.gpu_memory_utilization)
+            return asyncio.run_coroutine_threadsafe(build(), self._loop).result()
+        return runner.build_llm(gpu_memory_utilization=self.gpu_memory_utilization)
+
+    def run(self, results: List[InvoiceResult]) -> List[InvoiceResult]:
+        self.load()
+        if self.streaming:
+            for _ in self.iter_results(results):
+                pass
+            return results
+
+        with tracer.span("ocr_stage", images=len(results)):
+            outputs = self.runner.run_ocr(self.llm, [r.image_path for r in results], cache=self.cache)
+        for r, output in zip(results, outputs):
+            self._set_output(r, *(output or (None, None)))
+        return results
+
+    @staticmethod
+    def _set_output(r: InvoiceResult, raw_ocr: Optional[str], markdown: Optional[str]):
+        # Runner trả None cho ảnh không đọc được -> đánh dấu lỗi, các ảnh khác vẫn chạy tiếp
+        if raw_ocr is None:
+            r.error = "image could not be decoded"
+            return
+        r.raw_ocr = raw_ocr
+        r.markdown = markdown
+
+    def iter_results(self, results: List[InvoiceResult], queue_size: int = 8):
+        """
+        Generator trả từng InvoiceResult ngay khi OCR xong (theo thứ tự hoàn thành).
+        Kết quả đi qua queue tối đa queue_size phần tử: consumer chậm thì OCR tự chờ (backpressure).
+        """
+        self.load()
+        if not self.streaming:
+            # Engine đồng bộ chỉ trả kết quả khi xong cả batch
+            yield from self.run(results)
+            return
+
+        result_queue = queue.Queue(maxsize=queue_size)
+        done = object()
+
+        async def produce():
+            loop = asyncio.get_running_loop()
+            try:
+                async for index, raw_ocr, markdown in self.runner.stream_ocr(
+                        self.engine, [r.image_path for r in results], cache=self.cache):
+                    r = results[index]
+                    self._set_output(r, raw_ocr, markdown)
+                    # put() chặn khi queue đầy -> chạy trong executor để không chặn event loop
+                    await loop.run_in_executor(None, result_queue.put, r)
+                    QUEUE_DEPTH.set(result_queue.qsize(), queue="ocr_to_extraction")
+            finally:
+                await loop.run_in_executor(None, result_queue.put, done)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self._loop)
+        finished = False
+        try:
+            while True:
+                item = result_queue.get()
+                QUEUE_DEPTH.set(result_queue.qsize(), queue="ocr_to_extraction")
+                if item is done:
+                    finished = True
+                    break
+                yield item
+        finally:
+            if not finished:
+                # Consumer dừng giữa chừng: huỷ OCR còn lại và giải phóng producer đang chờ put()
+                future.cancel()
+                while not future.done():
+                    try:
+                        result_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+        future.result()  # Ném lại lỗi của OCR (nếu có)
+
+class ExtractionStage:
+    """
+    Bọc deepseek_llm_7b.extract_json_from_text (run, từng ảnh) / extract_json_batch (run_batch, 1 lần generate
+    cho cả batch), lưu JSON cuối cùng vào output_dir.
+    cache chỉ có tác dụng khi deterministic=True (greedy decoding).
+    """
+
+    def __init__(self, output_dir: str, cache=None, deterministic: bool = False):
+        self.output_dir = output_dir
+        self.cache = cache
+        self.deterministic = deterministic
+        self.llm_module = None
+
+    def load(self):
+        if self.llm_module is not None:
+            return
+        import deepseek_llm_7b
+        self.load_model(deepseek_llm_7b)
+        self.llm_module = deepseek_llm_7b
+
+    def load_model(self, llm_module):
+        """Load tokenizer + model 7B; subclass ghi đè để thay backend (vd benchmarks/bench_pipeline.py)."""
+        llm_module.load_model()
+
+    def run(self, results: List[InvoiceResult]) -> List[InvoiceResult]:
+        self.load()
+        os.makedirs(self.output_dir, exist_ok=True)
+        with tracer.span("extraction_stage", images=len(results)):
+            self._run(results)
+        memory_profiler.checkpoint("extraction", images=len(results))
+        return results
+
+    def run_batch(self, results: List[InvoiceResult]) -> List[InvoiceResult]:
+        """Như run() nhưng mọi ảnh hợp lệ được trích xuất trong 1 lần model.generate (server.py gom request thành batch)."""
+        self.load()
+        os.makedirs(self.output_dir, exist_ok=True)
+        with tracer.span("extraction_stage", images=len(results), batched=True):
+            ready = [r for r in results if self._ready(r)]
+            if ready:
+                print(f"Processing batch of {len(ready)}: {', '.join(r.name for r in ready)}...")
+                json_texts = self.llm_module.extract_json_batch(
+                    [r.markdown for r in ready], cache=self.cache, deterministic=self.deterministic,
+                    names=[r.name for r in ready])
+                for r, json_text in zip(ready, json_texts):
+                    self._save(r, json_text)
+        memory_profiler.checkpoint("extraction", images=len(results))
+        return results
+
+    def _ready(self, r: InvoiceResult) -> bool:
+        if r.error:
+            return False  # Đã lỗi ở bước OCR
+        # Bỏ qua markdown rỗng hoặc quá ngắn (giống deepseek_llm_7b.py)
+        if len(r.markdown.strip()) < 10:
+            print(f"Skipping empty OCR result: {r.name}")
+            r.error = "empty OCR result"
+            FAILURES.inc(stage="extraction", reason="empty")
+            return False
+        return True
+
+    def _save(self, r: InvoiceResult, json_text: str):
+        r.json_text = json_text
+        r.data = self.llm_module.save_json_result(r.json_text, self.output_dir, r.name)
+        if r.data is None:
+            r.error = "JSON parse error"
+        r.finished_at = time.perf_counter()
+
+    def _run(self, results: List[InvoiceResult]):
+        for r in results:
+            if not self._ready(r):
+                continue
+            print(f"Processing: {r.name}...")
+            self._save(r, self.llm_module.extract_json_from_text(
+                r.markdown, cache=self.cache, deterministic=self.deterministic, name=r.name))
+
+class EvaluationStage:
+    """Bọc parse_level_evaluate: chấm điểm trực tiếp trên JSON trong bộ nhớ."""
+
+    def __init__(self, gt_dir: str, report_file: Optional[str] = None):
+        self.gt_dir = gt_dir
+        self.report_file = report_file
+
+    def load(self):
+        pass
+
+    def run(self, results: List[InvoiceResult]) -> Dict[str, Any]:
+        from parse_level_evaluate import evaluate_predictions, find_gt_files
+
+        if not os.path.isdir(self.gt_dir) or not find_gt_files(self.gt_dir):
+            print(f"Skipping evaluation (No GT files in '{self.gt_dir}').")
+            return {}
+
+        # Serialize giống hệt file đã lưu để text_metrics không đổi so với đọc từ outputs/
+        predictions = {
+            f"{r.name}.json": json.dumps(r.data, ensure_ascii=False, indent=2)
+            for r in results if r.data is not None
+        }
+        with tracer.span("evaluation_stage", images=len(predictions)):
+            report = evaluate_predictions(self.gt_dir, predictions)
+
+        if self.report_file and report:
+            with open(self.report_file, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            print(f"✅ Calculation complete. Results saved to: {self.report_file}")
+        return report
+
+# =============================================================================
+# 3. PIPELINE
+# =============================================================================
+
+class Pipeline:
+    """
+    manifest: JobManifest (job_manifest.py) để chạy tiếp sau khi bị dừng. Ảnh đã trích xuất xong
+    được lấy lại từ manifest, ảnh đã OCR xong chỉ chạy lại bước trích xuất; kết quả được
+    checkpoint sau mỗi chunk_size ảnh nên crash chỉ mất tối đa 1 chunk.
+    input_dir: folder gốc của ảnh; ID ảnh / tên file output là đường dẫn tương đối so với folder này
+    (inputs/A/1.jpg -> outputs/A/1.json), None thì chỉ dùng tên file.
+    """
+
+    def __init__(self, ocr: OCRStage, extraction: ExtractionStage, evaluation: Optional[EvaluationStage] = None,
+                 manifest=None, chunk_size: Optional[int] = None, retry_failed: bool = False,
+                 input_dir: Optional[str] = None):
+        self.ocr = ocr
+        self.extraction = extraction
+        self.evaluation = evaluation
+        self.manifest = manifest
+        self.chunk_size = chunk_size
+        self.retry_failed = retry_failed
+        self.input_dir = input_dir
+
+    def load(self):
+        """Load toàn bộ model trước (OCR trước để vLLM giữ phần bộ nhớ GPU của nó)."""
+        self.ocr.load()
+        self.extraction.load()
+        if self.evaluation is not None:
+            self.evaluation.load()
+
+    def _prepare(self, image_paths: List[str]):
+        """
+        Tạo InvoiceResult cho từng ảnh và khôi phục những gì manifest đã có.
+        Trả về (results, need_ocr, need_extraction).
+        """
+        results = [InvoiceResult(name=image_name(p, self.input_dir), image_path=p) for p in image_paths]
+        if self.manifest is None:
+            return results, list(results), []
+
+        self.manifest.add_images((r.name, r.image_path) for r in results)
+        records = self.manifest.records()
+        need_ocr, need_extraction = [], []
+        for r in results:
+            record = records[r.name]
+            if record["state"] in FINISHED_STATES:
+                r.markdown = record["markdown"] or ""
+                r.json_text = record["json_text"] or ""
+                r.data = json.loads(r.json_text) if r.json_text else None
+            elif record["state"] == OCR_DONE:
+                r.markdown = record["markdown"] or ""
+                need_extraction.append(r)
+            elif record["state"] == FAILED and not self.retry_failed:
+                r.error = record["error"] or "failed"
+            else:
+                need_ocr.append(r)
+
+        print(self.manifest.format_counts())
+        skipped = len(results) - len(need_ocr) - len(need_extraction)
+        if skipped:
+            print(f"Resuming: {skipped} images already done / failed, "
+                  f"{len(need_extraction)} need extraction only, {len(need_ocr)} need OCR.")
+        return results, need_ocr, need_extraction
+
+    def _checkpoint_ocr(self, results: List[InvoiceResult]):
+        if self.manifest is None:
+            return
+        self.manifest.mark_ocr_done([(r.name, r.markdown) for r in results if not r.error])
+        self.manifest.mark_failed([(r.name, r.error) for r in results if r.error])
+
+    def _checkpoint_extraction(self, results: List[InvoiceResult]):
+        if self.manifest is None:
+            return
+        self.manifest.mark_extracted([(r.name, r.json_text) for r in results if r.data is not None])
+        self.manifest.mark_failed([(r.name, r.error) for r in results if r.data is None and r.error])
+
+    def run(self, image_paths: List[str]) -> PipelineResult:
+        self.load()
+        results, need_ocr, need_extraction = self._prepare(image_paths)
+        if not results:
+            print("No images found. Skipping...")
+            return PipelineResult()
+
+        start = time.perf_counter()
+        if need_extraction:
+            print("\n>>> STEP 2: Running DeepSeek-LLM Extraction (OCR restored from manifest)...")
+            for chunk in chunked(need_extraction, self.chunk_size):
+                self.extraction.run(chunk)
+                self._checkpoint_extraction(chunk)
+
+        chunks = list(chunked(need_ocr, self.chunk_size))
+        for i, chunk in enumerate(chunks, 1):
+            progress = f" (chunk {i}/{len(chunks)})" if len(chunks) > 1 else ""
+            print(f"\n>>> STEP 1: Running DeepSeek-OCR{progress}...")
+            self.ocr.run(chunk)
+            self._checkpoint_ocr(chunk)
+
+            print(f"\n>>> STEP 2: Running DeepSeek-LLM Extraction{progress}...")
+            self.extraction.run(chunk)
+            self._checkpoint_extraction(chunk)
+
+        return self._finish(results, start)
+
+    def run_streaming(self, image_paths: List[str], queue_size: int = 8) -> PipelineResult:
+        """
+        OCR và trích xuất chạy chồng lên nhau: ảnh nào OCR xong là được trích xuất ngay.
+        Cần OCRStage(streaming=True); với engine đồng bộ thì kết quả giống run().
+        """
+        self.load()
+        results, need_ocr, need_extraction = self._prepare(image_paths)
+        if not results:
+            print("No images found. Skipping...")
+            return PipelineResult()
+
+        start = time.perf_counter()
+        print("\n>>> STEP 1+2: Streaming DeepSeek-OCR -> DeepSeek-LLM Extraction...")
+        pending = []
+        for r in itertools.chain(need_extraction, self.ocr.iter_results(need_ocr, queue_size=queue_size)):
+            self.extraction.run([r])
+            pending.append(r)
+            if self.chunk_size and len(pending) >= self.chunk_size:
+                self._checkpoint_ocr(pending)
+                self._checkpoint_extraction(pending)
+                pending = []
+        self._checkpoint_ocr(pending)
+        self._checkpoint_extraction(pending)
+
+        return self._finish(results, start)
+
+    def _finish(self, results: List[InvoiceResult], start: float) -> PipelineResult:
+        finished = [r.finished_at for r in results if r.finished_at]
+        wall_time = time.perf_counter() - start
+        time_to_first_json = (min(finished) - start) if finished else 0.0
+
+        caches = (getattr(self.ocr, "cache", None), getattr(self.ocr, "preprocess_cache", None),
+                  getattr(self.extraction, "cache", None))
+        for cache in caches:
+            if cache is not None:
+                print(cache.format_stats())
+
+        report = {}
+        if self.evaluation is not None:
+            print("\n>>> STEP 3: Evaluating Results...")
+            report = self.evaluation.run(results)
+            if self.manifest is not None and report:
+                self.manifest.mark_evaluated(
+                    os.path.splitext(item["image_id"])[0] for item in report.get("per_image_results", []))
+        if self.manifest is not None:
+            print(self.manifest.format_counts())
+        return PipelineResult(results=results, report=report,
+                              wall_time=wall_time, time_to_first_json=time_to_first_json)
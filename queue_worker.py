@@ -0,0 +1,127 @@
+"""
+Worker lấy việc từ job_queue.py theo batch.
+
+    python queue_worker.py ocr --queue queue.sqlite --batch_size 64
+    python queue_worker.py extract --queue http://host:8765 --output_dir outputs
+
+Worker OCR dùng OCRStage (run_dpsk_ocr_eval_batch.run_ocr, engine vLLM resident), worker trích xuất
+dùng ExtractionStage (deepseek_llm_7b). Markdown OCR đi từ stage "ocr" sang stage "extract" qua
+hàng đợi nên 2 loại worker có thể nằm trên các máy / GPU khác nhau và tăng giảm số lượng tuỳ ý.
+Trong lúc xử lý, 1 thread nền gia hạn lease cho batch đang giữ; worker chết thì lease hết hạn
+và batch được worker khác nhận lại.
+"""
+import os
+import time
+import socket
+import argparse
+import threading
+from typing import List
+
+from job_queue import open_queue, Job, OCR_STAGE, EXTRACT_STAGE
+from pipeline import InvoiceResult, OCRStage, ExtractionStage
+
+class LeaseKeeper:
+    """Gia hạn lease của các job đang xử lý mỗi interval giây (context manager)."""
+
+    def __init__(self, queue, stage: str, worker: str, jobs: List[Job], interval: float):
+        self.queue = queue
+        self.stage = stage
+        self.worker = worker
+        self.job_ids = [job.job_id for job in jobs]
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.stage, self.worker, self.job_ids)
+            except Exception as e:
+                print(f"Warning: lease heartbeat failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def process_ocr_batch(queue, stage: OCRStage, worker: str, jobs: List[Job]):
+    results = [InvoiceResult(name=job.job_id, image_path=job.payload["image_path"]) for job in jobs]
+    stage.run(results)
+    ok = [r for r in results if not r.error]
+    queue.complete(OCR_STAGE, worker, [
+        (r.name, {"image_path": r.image_path, "markdown": r.markdown}) for r in ok], next_stage=EXTRACT_STAGE)
+    # Ảnh không đọc được thì thử lại cũng vô ích
+    queue.fail(OCR_STAGE, worker, [(r.name, r.error) for r in results if r.error], retry=False)
+    return len(ok)
+
+def process_extract_batch(queue, stage: ExtractionStage, worker: str, jobs: List[Job]):
+    results = [InvoiceResult(name=job.job_id, image_path=job.payload.get("image_path", ""),
+                             markdown=job.payload["markdown"]) for job in jobs]
+    stage.run(results)
+    ok = [r for r in results if r.data is not None]
+    queue.complete(EXTRACT_STAGE, worker, [(r.name, {"json_text": r.json_text}) for r in ok])
+    # Markdown rỗng: không retry; JSON lỗi: sampling lần sau có thể ra JSON hợp lệ
+    queue.fail(EXTRACT_STAGE, worker,
+               [(r.name, r.error) for r in results if r.error == "empty OCR result"], retry=False)
+    queue.fail(EXTRACT_STAGE, worker,
+               [(r.name, r.error) for r in results if r.data is None and r.error != "empty OCR result"])
+    return len(ok)
+
+def run_worker(queue, stage_name: str, stage, worker: str, batch_size: int, poll_interval: float,
+               exit_when_idle: bool):
+    process = process_ocr_batch if stage_name == OCR_STAGE else process_extract_batch
+    stage.load()
+    # Lease của hàng đợi (server dùng --lease_seconds của chính nó, không phải của worker)
+    heartbeat_interval = queue.lease_seconds / 3
+    done = 0
+    while True:
+        jobs = queue.claim(stage_name, worker, batch_size)
+        if not jobs:
+            # Worker trích xuất chỉ dừng khi OCR cũng đã hết việc (có thể còn job sắp được đẩy sang)
+            upstream_busy = stage_name == EXTRACT_STAGE and queue.pending(OCR_STAGE) > 0
+            if exit_when_idle and not upstream_busy and queue.pending(stage_name) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        start = time.perf_counter()
+        with LeaseKeeper(queue, stage_name, worker, jobs, interval=heartbeat_interval):
+            done += process(queue, stage, worker, jobs)
+        elapsed = time.perf_counter() - start
+        print(f"[{worker}] {stage_name}: {len(jobs)} jobs in {elapsed:.1f}s ({len(jobs) / elapsed:.2f} img/s) | "
+              f"{queue.format_counts()}")
+    print(f"[{worker}] {stage_name} worker finished, {done} jobs done")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stage", choices=[OCR_STAGE, EXTRACT_STAGE])
+    parser.add_argument("--queue", required=True, help="File SQLite (local / NFS) hoặc URL của job_queue.py serve")
+    parser.add_argument("--nfs", action="store_true", help="File SQLite nằm trên NFS (tắt WAL)")
+    parser.add_argument("--batch_size", type=int, default=None, help="Mặc định: 64 cho OCR, 8 cho extract")
+    parser.add_argument("--lease_seconds", type=float, default=600,
+                        help="Thời hạn lease khi --queue là file SQLite; với server thì dùng --lease_seconds của serve")
+    parser.add_argument("--poll_interval", type=float, default=5)
+    parser.add_argument("--worker_id", default=default_worker_id())
+    parser.add_argument("--forever", action="store_true", help="Không thoát khi hàng đợi rỗng")
+    parser.add_argument("--output_dir", default="outputs", help="Folder lưu JSON (worker extract)")
+    parser.add_argument("--deterministic", action="store_true", help="LLM dùng greedy decoding")
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.9,
+                        help="Phần bộ nhớ GPU cho vLLM (worker OCR chạy riêng nên mặc định như runner gốc)")
+    args = parser.parse_args()
+
+    queue = open_queue(args.queue, lease_seconds=args.lease_seconds, nfs=args.nfs)
+    if args.stage == OCR_STAGE:
+        stage = OCRStage(gpu_memory_utilization=args.gpu_memory_utilization)
+        batch_size = args.batch_size or 64
+    else:
+        stage = ExtractionStage(args.output_dir, deterministic=args.deterministic)
+        batch_size = args.batch_size or 8
+
+    run_worker(queue, args.stage, stage, args.worker_id, batch_size, args.poll_interval,
+               exit_when_idle=not args.forever)
@@ -0,0 +1,235 @@
+"""
+Cache kết quả lưu trên đĩa (1 file SQLite), có giới hạn dung lượng và loại bỏ theo LRU.
+
+Dùng chung cho cache OCR (run_dpsk_ocr_eval_batch.py) và cache trích xuất (deepseek_llm_7b.py).
+Key là chuỗi hash do make_cache_key() tạo ra, value là object bất kỳ serialize được bằng JSON.
+Nhiều process có thể dùng chung 1 file cache (SQLite tự lo việc khoá).
+
+TensorCache: cache mảng lớn (tensor ảnh đã tiền xử lý của OCR), mỗi entry là 1 folder chứa các
+file .npy, đọc lại bằng memory map nên không phải đọc cả file vào RAM.
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+def make_cache_key(*parts: Any) -> str:
+    """SHA-256 của các thành phần key (serialize JSON, sort_keys để ổn định)."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class DiskLRUCache:
+    def __init__(self, path: str, max_bytes: int = 2 * 1024 ** 3, name: str = "cache"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries(key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, data, size, time.time()))
+                self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Xoá entry lâu chưa dùng nhất cho tới khi dưới giới hạn
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size_mb": self.size_bytes() / 1024 ** 2,
+        }
+
+    def format_stats(self) -> str:
+        s = self.stats()
+        return (f"[{self.name}] hits: {s['hits']} | misses: {s['misses']} | hit rate: {s['hit_rate']:.1%} | "
+                f"evictions: {s['evictions']} | entries: {s['entries']} | size: {s['size_mb']:.1f}/"
+                f"{self.max_bytes / 1024 ** 2:.0f} MB")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TensorCache:
+    """
+    Cache {tên: np.ndarray} + metadata JSON trên đĩa: <directory>/<key[:2]>/<key>/{<tên>.npy, meta.json}.
+    get() mở các mảng bằng np.load(mmap_mode="c"): chỉ trang nào được đọc mới vào RAM, ghi vào mảng
+    không ảnh hưởng file. Giới hạn dung lượng max_bytes, loại bỏ theo LRU (mtime của meta.json).
+    Entry được ghi vào folder tạm rồi rename nên process khác không bao giờ đọc phải entry ghi dở.
+    """
+
+    META_FILE = "meta.json"
+
+    def __init__(self, directory: str, max_bytes: int = 8 * 1024 ** 3, name: str = "tensor cache"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        """(lần dùng cuối, folder, dung lượng) của mọi entry"""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    last_access = os.path.getmtime(os.path.join(entry_dir, self.META_FILE))
+                    size = sum(os.path.getsize(os.path.join(entry_dir, fn)) for fn in os.listdir(entry_dir))
+                except OSError:
+                    continue  # Process khác vừa xoá entry này
+                entries.append((last_access, entry_dir, size))
+        return entries
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, self.META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = {name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="c")
+                      for name in meta["arrays"]}
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays, meta["meta"]
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]):
+        size = sum(a.nbytes for a in arrays.values())
+        if size > self.max_bytes:
+            return
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entry_dir))
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+            with open(os.path.join(tmp_dir, self.META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"arrays": list(arrays), "meta": meta}, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Entry đã có (process / thread khác ghi trước) hoặc hết chỗ: bỏ qua, cache chỉ là tối ưu
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Xoá entry lâu chưa dùng nhất cho tới khi dưới giới hạn (tính lại dung lượng thật từ đĩa)
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, entry_dir, size in entries:
+            if self._size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self._size -= size
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size_mb": self._size / 1024 ** 2,
+        }
+
+    def format_stats(self) -> str:
+        s = self.stats()
+        return (f"[{self.name}] hits: {s['hits']} | misses: {s['misses']} | hit rate: {s['hit_rate']:.1%} | "
+                f"evictions: {s['evictions']} | entries: {s['entries']} | size: {s['size_mb']:.1f}/"
+                f"{self.max_bytes / 1024 ** 2:.0f} MB")
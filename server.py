@@ -0,0 +1,306 @@
+"""
+HTTP service trích xuất hoá đơn: POST 1 ảnh, nhận lại JSON theo schema trong README.
+
+    python server.py --port 8000 --batch_window_ms 50 --max_batch_size 16 --max_queue 64
+    curl --data-binary @inputs/Coopmart/1.jpg -H "Content-Type: image/jpeg" "http://localhost:8000/extract?name=1"
+    curl http://localhost:8000/health
+
+- Server asyncio (chỉ dùng thư viện chuẩn), model OCR + LLM load 1 lần lúc khởi động.
+- Dynamic batching: request đầu tiên mở 1 cửa sổ batch_window_ms, các request tới trong cửa sổ
+  (tối đa max_batch_size) được gửi chung 1 lần vào llm.generate của vLLM OCR rồi 1 lần model.generate
+  của model trích xuất (ExtractionStage.run_batch).
+- JSON lưu ở <output_dir>/<name>-<upload id>.json: 2 request cùng ?name= không ghi đè file của nhau.
+- Admission control: khi đã có max_queue request chờ thì trả 429 (kèm Retry-After) thay vì để
+  độ trễ tăng vô hạn.
+- Server mở cổng trước rồi mới load model: trong lúc load, GET /health trả 503 "loading" và
+  POST /extract trả 503 (kèm Retry-After).
+- GET /health: trạng thái, độ sâu hàng đợi, số request đã xử lý / bị từ chối.
+- GET /metrics: metric Prometheus (metrics.py) của OCR / trích xuất / hàng đợi.
+
+benchmarks/load_test.py chạy server này với backend giả (không cần GPU) để đo độ trễ / throughput.
+"""
+import os
+import json
+import uuid
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, parse_qs
+
+from pipeline import InvoiceResult, OCRStage, ExtractionStage
+from metrics import registry, QUEUE_DEPTH
+
+CONTENT_TYPE_EXTENSIONS = {"image/jpeg": ".jpg", "image/jpg": ".jpg", "image/png": ".png"}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 414: "URI Too Long", 422: "Unprocessable Entity", 429: "Too Many Requests",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+MAX_LINE_BYTES = 8192   # request line / 1 dòng header
+MAX_HEADERS = 100
+
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+class ExtractionService:
+    """
+    ocr / extraction: stage có load() và run(List[InvoiceResult]) như OCRStage / ExtractionStage,
+    extraction có thêm run_batch() (benchmarks/load_test.py truyền stage giả vào đây).
+    """
+
+    def __init__(self, ocr, extraction, upload_dir: str = ".cache/uploads", batch_window: float = 0.05,
+                 max_batch_size: int = 16, max_queue: int = 64, max_body_bytes: int = 20 * 1024 * 1024,
+                 keep_uploads: bool = False):
+        self.ocr = ocr
+        self.extraction = extraction
+        self.upload_dir = upload_dir
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_queue = max_queue
+        self.max_body_bytes = max_body_bytes
+        self.keep_uploads = keep_uploads
+        self.queue: Optional[asyncio.Queue] = None
+        # GPU chỉ chạy 1 batch tại 1 thời điểm -> 1 thread cho model
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        # Ghi / xoá file upload: pool riêng, không chờ batch đang chạy trên GPU và không chặn event loop
+        self.io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload")
+        self.loaded = False
+        self.port = None
+        self.in_flight = 0
+        self.stats = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0, "batches": 0}
+
+    def load(self):
+        self.ocr.load()
+        self.extraction.load()
+        self.loaded = True
+
+    # ------------------------------------------------------------------ batching
+
+    def _run_batch(self, results: List[InvoiceResult]):
+        self.ocr.run(results)
+        self.extraction.run_batch(results)
+
+    async def _next_batch(self) -> List[Tuple[InvoiceResult, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        QUEUE_DEPTH.set(self.queue.qsize(), queue="http")
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        QUEUE_DEPTH.set(self.queue.qsize(), queue="http")
+        return batch
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            results = [r for r, _ in batch]
+            self.in_flight = len(batch)
+            error = None
+            try:
+                await loop.run_in_executor(self.executor, self._run_batch, results)
+            except Exception as e:
+                error = e
+            finally:
+                self.in_flight = 0
+                self.stats["batches"] += 1
+            if not self.keep_uploads:
+                await loop.run_in_executor(self.io_executor, remove_files, [r.image_path for r in results])
+            for r, future in batch:
+                if future.done():
+                    continue  # Client đã ngắt kết nối
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(r)
+
+    async def submit(self, image_bytes: bytes, name: str, extension: str) -> Optional[InvoiceResult]:
+        """
+        Đưa 1 ảnh vào hàng đợi và chờ kết quả; None nếu hàng đợi đầy (-> 429).
+        Kết quả được lưu theo id của upload (<name>-<id>), không theo mỗi name của client.
+        """
+        if self.queue.full():
+            self.stats["rejected"] += 1
+            return None
+        loop = asyncio.get_running_loop()
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.upload_dir, f"{upload_id}{extension}")
+        await loop.run_in_executor(self.io_executor, write_file, path, image_bytes)
+        if self.queue.full():
+            # Hàng đợi đầy trong lúc đang ghi file
+            await loop.run_in_executor(self.io_executor, remove_files, [path])
+            self.stats["rejected"] += 1
+            return None
+        future = loop.create_future()
+        result_name = f"{name}-{upload_id}" if name else upload_id
+        self.queue.put_nowait((InvoiceResult(name=result_name, image_path=path), future))
+        QUEUE_DEPTH.set(self.queue.qsize(), queue="http")
+        self.stats["accepted"] += 1
+        r = await future
+        self.stats["processed" if r.data is not None else "failed"] += 1
+        return r
+
+    def health(self) -> Dict:
+        return {
+            "status": "ok" if self.loaded else "loading",
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            **self.stats,
+        }
+
+    # ------------------------------------------------------------------ HTTP
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, body, headers = await self._dispatch(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            status, body, headers = 500, {"error": str(e)}, {}
+        if isinstance(body, str):
+            payload, content_type = body.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            payload, content_type = json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(payload)}", "Connection: close"]
+        head += [f"{k}: {v}" for k, v in headers.items()]
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_line(reader: asyncio.StreamReader) -> Optional[str]:
+        """1 dòng của phần header, None nếu dài hơn MAX_LINE_BYTES."""
+        try:
+            line = await reader.readline()
+        except ValueError:
+            return None  # Vượt limit của StreamReader (64 KiB) mà chưa gặp '\n'
+        return line.decode("latin-1").strip() if len(line) <= MAX_LINE_BYTES else None
+
+    async def _dispatch(self, reader: asyncio.StreamReader) -> Tuple[int, Union[Dict, str], Dict]:
+        request_line = await self._read_line(reader)
+        if request_line is None:
+            return 414, {"error": f"request line longer than {MAX_LINE_BYTES} bytes"}, {}
+        if not request_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        parts = request_line.split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            return 400, {"error": "malformed request line"}, {}
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await self._read_line(reader)
+            if line is None:
+                return 431, {"error": f"header line longer than {MAX_LINE_BYTES} bytes"}, {}
+            if not line:
+                break
+            if len(headers) >= MAX_HEADERS:
+                return 431, {"error": f"more than {MAX_HEADERS} headers"}, {}
+            key, sep, value = line.partition(":")
+            if not sep:
+                return 400, {"error": "malformed header line"}, {}
+            headers[key.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        if url.path == "/health":
+            return (200 if self.loaded else 503), self.health(), {}
+        if url.path == "/metrics":
+            return 200, registry.render(), {}
+        if url.path != "/extract":
+            return 404, {"error": f"unknown path {url.path}"}, {}
+        if method != "POST":
+            return 405, {"error": "use POST with the image as request body"}, {"Allow": "POST"}
+        if not self.loaded:
+            return 503, {"error": "model is loading, retry later"}, {"Retry-After": "5"}
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return 400, {"error": "invalid Content-Length"}, {}
+        if length <= 0:
+            return 400, {"error": "empty request body, expected image bytes"}, {}
+        if length > self.max_body_bytes:
+            return 413, {"error": f"image larger than {self.max_body_bytes} bytes"}, {}
+        if self.queue.full():
+            # Từ chối trước khi đọc body để không tốn băng thông / bộ nhớ khi quá tải
+            self.stats["rejected"] += 1
+            return 429, {"error": "server busy, retry later"}, {"Retry-After": "1"}
+        image_bytes = await reader.readexactly(length)
+
+        content_type = headers.get("content-type", "image/jpeg").split(";")[0].strip().lower()
+        name = os.path.basename(parse_qs(url.query).get("name", [""])[0])
+        r = await self.submit(image_bytes, name, CONTENT_TYPE_EXTENSIONS.get(content_type, ".jpg"))
+        if r is None:
+            return 429, {"error": "server busy, retry later"}, {"Retry-After": "1"}
+        if r.data is None:
+            return 422, {"name": r.name, "error": r.error or "extraction failed"}, {}
+        return 200, r.data, {}
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, ready: Optional[asyncio.Event] = None):
+        """ready được set khi model đã load xong (cổng đã mở từ trước, /health trả "loading" trong lúc load)."""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        server = await asyncio.start_server(self.handle, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f"Serving on http://{host}:{self.port} (window {self.batch_window * 1000:.0f}ms, "
+              f"batch ≤ {self.max_batch_size}, queue ≤ {self.max_queue})")
+        batcher = None
+        try:
+            async with server:
+                if not self.loaded:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+                    print("Models loaded")
+                batcher = asyncio.create_task(self.batch_loop())
+                if ready is not None:
+                    ready.set()
+                await server.serve_forever()
+        finally:
+            if batcher is not None:
+                batcher.cancel()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch_window_ms", type=float, default=50, help="Thời gian gom request thành 1 batch")
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    parser.add_argument("--max_queue", type=int, default=64, help="Số request chờ tối đa, vượt quá trả 429")
+    parser.add_argument("--max_body_mb", type=float, default=20)
+    parser.add_argument("--output_dir", default="outputs", help="Folder lưu JSON (như master_pipeline.py)")
+    parser.add_argument("--upload_dir", default=".cache/uploads", help="Folder tạm chứa ảnh upload")
+    parser.add_argument("--keep_uploads", action="store_true", help="Không xoá ảnh upload sau khi xử lý")
+    parser.add_argument("--deterministic", action="store_true", help="LLM dùng greedy decoding")
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.5)
+    args = parser.parse_args()
+
+    service = ExtractionService(
+        OCRStage(gpu_memory_utilization=args.gpu_memory_utilization),
+        ExtractionStage(args.output_dir, deterministic=args.deterministic),
+        upload_dir=args.upload_dir,
+        batch_window=args.batch_window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        max_queue=args.max_queue,
+        max_body_bytes=int(args.max_body_mb * 1024 * 1024),
+        keep_uploads=args.keep_uploads,
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
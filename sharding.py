@@ -0,0 +1,194 @@
+"""
+Quét ảnh đệ quy (inputs/<Retailer>/...) và chia việc cho nhiều worker chạy song song.
+
+Mỗi ảnh thuộc đúng 1 shard, tính bằng hash ổn định (SHA-1) của đường dẫn tương đối so với
+thư mục gốc, nên N worker trên 1 hoặc nhiều máy xử lý các phần rời nhau của cùng 1 kho ảnh
+mà không cần trao đổi gì với nhau:
+
+    CUDA_VISIBLE_DEVICES=0 python master_pipeline.py --num-shards 2 --shard-id 0
+    CUDA_VISIBLE_DEVICES=1 python master_pipeline.py --num-shards 2 --shard-id 1
+
+Sau khi mọi shard chạy xong, gộp output và báo cáo đánh giá:
+
+    python sharding.py merge --outputs host1/outputs host2/outputs --out_dir outputs \\
+        --reports final_evaluation_report.shard-*.json --report final_evaluation_report.json
+"""
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+from typing import Dict, Iterable, List, Optional, Sequence
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def discover_files(input_dir: str, extensions: Sequence[str]) -> List[str]:
+    """
+    Liệt kê đệ quy file có đuôi extensions trong input_dir (bỏ qua file/folder ẩn), sắp xếp theo đường dẫn tương đối.
+    Có đi theo symlink tới folder, nhưng mỗi folder (st_dev, st_ino) chỉ quét 1 lần nên vòng symlink không lặp vô hạn.
+    """
+    found = []
+    st = os.stat(input_dir)
+    visited = {(st.st_dev, st.st_ino)}
+    stack = [input_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            # thứ tự cố định: cùng 1 folder có 2 đường dẫn thì lần nào cũng giữ cùng 1 đường dẫn
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=True):
+                    st = entry.stat(follow_symlinks=True)
+                    if (st.st_dev, st.st_ino) not in visited:
+                        visited.add((st.st_dev, st.st_ino))
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=True) and entry.name.lower().endswith(tuple(extensions)):
+                    found.append(entry.path)
+    return sorted(found, key=lambda p: relative_key(p, input_dir))
+
+def discover_images(input_dir: str) -> List[str]:
+    """
+    Như discover_files cho ảnh, nhưng báo lỗi (ValueError) khi 2 ảnh có cùng image_id, vd A/1.jpg và A/1.png:
+    chúng sẽ dùng chung 1 dòng manifest / cache / ledger và 1 file output, ảnh sau ghi đè ảnh trước.
+    """
+    paths = discover_files(input_dir, IMAGE_EXTENSIONS)
+    duplicates = duplicate_ids(paths, input_dir)
+    if duplicates:
+        listed = "; ".join(", ".join(relative_key(p, input_dir) for p in group) for group in duplicates.values())
+        raise ValueError(f"{len(duplicates)} image IDs are shared by several files in {input_dir} "
+                         f"(same name, different extension), rename them: {listed}")
+    return paths
+
+def relative_key(path: str, root: str) -> str:
+    """Đường dẫn tương đối dùng '/' để hash giống nhau trên mọi máy / hệ điều hành."""
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+def image_id(path: str, root: Optional[str] = None) -> str:
+    """
+    ID của ảnh (manifest, hàng đợi, tên file output): đường dẫn tương đối so với root, bỏ đuôi,
+    vd "Coopmart/1" cho inputs/Coopmart/1.jpg, để inputs/A/1.jpg và inputs/B/1.jpg không trùng nhau.
+    Không có root (hoặc path nằm ngoài root) thì chỉ là tên file bỏ đuôi.
+    """
+    if root is not None:
+        key = relative_key(path, root)
+        if not key.startswith("../"):
+            return os.path.splitext(key)[0]
+    return os.path.splitext(os.path.basename(path))[0]
+
+def duplicate_ids(paths: Iterable[str], root: Optional[str] = None) -> Dict[str, List[str]]:
+    """{image_id: các path} cho những image_id có từ 2 path trở lên."""
+    by_id: Dict[str, List[str]] = {}
+    for path in paths:
+        by_id.setdefault(image_id(path, root), []).append(path)
+    return {key: group for key, group in by_id.items() if len(group) > 1}
+
+def shard_of(key: str, num_shards: int) -> int:
+    # Không dùng hash() của Python: giá trị đổi theo từng process (PYTHONHASHSEED)
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:16], 16) % num_shards
+
+def select_shard(paths: Iterable[str], root: str, num_shards: int = 1, shard_id: int = 0) -> List[str]:
+    """Giữ lại các path thuộc shard shard_id / num_shards."""
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"shard_id must be in [0, {num_shards}), got {shard_id}")
+    if num_shards == 1:
+        return list(paths)
+    return [p for p in paths if shard_of(relative_key(p, root), num_shards) == shard_id]
+
+def add_shard_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument("--num-shards", "--num_shards", dest="num_shards", type=int, default=1,
+                        help="Tổng số worker chia nhau input")
+    parser.add_argument("--shard-id", "--shard_id", dest="shard_id", type=int, default=0,
+                        help="Worker này xử lý shard thứ mấy (0..num_shards-1)")
+    return parser
+
+def shard_suffix(num_shards: int, shard_id: int) -> str:
+    """Hậu tố cho file riêng của từng shard (vd báo cáo), rỗng khi không chia shard."""
+    return f".shard-{shard_id}-of-{num_shards}" if num_shards > 1 else ""
+
+# =============================================================================
+# MERGE
+# =============================================================================
+
+def merge_outputs(shard_dirs: Sequence[str], out_dir: str) -> int:
+    """
+    Copy output của các shard (JSON, ERROR_*.md, markdown OCR, ...) vào out_dir, giữ cấu trúc folder con.
+    Bỏ qua file ẩn (manifest .sqlite) và các file đã có sẵn ở out_dir với cùng nội dung.
+    """
+    copied = 0
+    for shard_dir in shard_dirs:
+        if os.path.abspath(shard_dir) == os.path.abspath(out_dir):
+            continue
+        for root, dirs, files in os.walk(shard_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for fn in files:
+                if fn.startswith("."):
+                    continue
+                src = os.path.join(root, fn)
+                dst = os.path.join(out_dir, os.path.relpath(src, shard_dir))
+                if os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src):
+                    with open(src, "rb") as a, open(dst, "rb") as b:
+                        if a.read() == b.read():
+                            continue
+                    print(f"Warning: {dst} differs between shards, overwriting with {src}")
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(src, dst)
+                copied += 1
+    return copied
+
+def merge_reports(reports: Sequence[Dict]) -> Dict:
+    """Gộp báo cáo đánh giá của các shard: nối per_image_results rồi tính lại summary."""
+    from parse_level_evaluate import summarize_results
+
+    per_image = {}
+    for report in reports:
+        for item in report.get("per_image_results", []):
+            per_image[item["image_id"]] = item  # Ảnh bị chạy ở 2 shard: lấy kết quả sau
+    return summarize_results([per_image[k] for k in sorted(per_image)])
+
+def merge_report_files(report_files: Sequence[str], out_file: Optional[str] = None) -> Dict:
+    reports = []
+    for path in report_files:
+        with open(path, "r", encoding="utf-8") as f:
+            reports.append(json.load(f))
+    merged = merge_reports(reports)
+    if out_file and merged:
+        with open(out_file, "w", encoding="utf-8") as f:
+            json.dump(merged, f, indent=2, ensure_ascii=False)
+    return merged
+
+def expand_globs(patterns: Sequence[str]) -> List[str]:
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Liệt kê shard / gộp kết quả của các shard")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ls = sub.add_parser("list", help="In danh sách ảnh của 1 shard")
+    ls.add_argument("--input_dir", required=True)
+    add_shard_args(ls)
+
+    merge = sub.add_parser("merge", help="Gộp output và báo cáo đánh giá của các shard")
+    merge.add_argument("--outputs", nargs="*", default=[], help="Folder output của từng shard")
+    merge.add_argument("--out_dir", default="outputs", help="Folder output sau khi gộp")
+    merge.add_argument("--reports", nargs="*", default=[], help="Báo cáo đánh giá của từng shard (hỗ trợ glob)")
+    merge.add_argument("--report", default="final_evaluation_report.json", help="Báo cáo sau khi gộp")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for path in select_shard(discover_images(args.input_dir), args.input_dir, args.num_shards, args.shard_id):
+            print(path)
+        sys.exit(0)
+
+    if args.outputs:
+        n = merge_outputs(expand_globs(args.outputs), args.out_dir)
+        print(f"Merged {n} files into {args.out_dir}")
+    if args.reports:
+        report_files = expand_globs(args.reports)
+        merged = merge_report_files(report_files, args.report)
+        total = merged.get("summary", {}).get("total_images", 0)
+        print(f"Merged {len(report_files)} reports ({total} images) into {args.report}")
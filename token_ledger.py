@@ -0,0 +1,146 @@
+"""
+Sổ token cho từng ảnh, để lập kế hoạch chi phí / dung lượng GPU.
+
+Mỗi ảnh 1 dòng:
+- visual_tokens, crop_ratio: số token ảnh đưa vào DeepSeek-OCR (cùng công thức với
+  DeepseekOCRProcessingInfo.get_num_image_tokens) và lưới tile (ngang x dọc) của chế độ crop
+- ocr_output_tokens: số token OCR sinh ra
+- prompt_tokens, output_tokens: token vào / ra của LLM trích xuất (deepseek_llm_7b.py)
+- ocr_seconds, extraction_seconds, wall_seconds: thời gian OCR / trích xuất / tổng
+
+rồi cộng dồn theo folder retailer (inputs/<Retailer>/...) để xem loại hoá đơn nào tốn GPU nhất
+và chọn batch size / max_tokens theo số liệu thật. Ảnh lấy từ cache (OCR / trích xuất) không tốn
+token nên không có số liệu của bước đó.
+
+    python master_pipeline.py --token_ledger token_ledger.json
+    python token_ledger.py merge ocr_ledger.json extraction_ledger.json --out token_ledger.json
+"""
+import os
+import json
+import argparse
+import threading
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, List, Optional, Tuple
+
+from tracing import percentile
+
+@dataclass
+class LedgerEntry:
+    image_id: str
+    retailer: str = ""
+    width: int = 0
+    height: int = 0
+    crop_ratio: Optional[Tuple[int, int]] = None
+    visual_tokens: int = 0
+    ocr_output_tokens: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    ocr_seconds: float = 0.0
+    extraction_seconds: float = 0.0
+
+    @property
+    def wall_seconds(self) -> float:
+        return self.ocr_seconds + self.extraction_seconds
+
+    def as_dict(self) -> Dict:
+        data = asdict(self)
+        data["crop_ratio"] = list(self.crop_ratio) if self.crop_ratio else None
+        data["wall_seconds"] = round(self.wall_seconds, 4)
+        return data
+
+TOKEN_FIELDS = ("visual_tokens", "ocr_output_tokens", "prompt_tokens", "output_tokens")
+FIELD_NAMES = {f.name for f in fields(LedgerEntry)}
+
+def retailer_of(path: str) -> str:
+    """Tên folder chứa file (inputs/<Retailer>/x.jpg -> "<Retailer>")."""
+    return os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+class TokenLedger:
+    def __init__(self):
+        self.enabled = False
+        self.entries: Dict[str, LedgerEntry] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def record(self, image_id: str, **values):
+        """Ghi / cập nhật các trường của 1 ảnh (OCR và trích xuất ghi vào cùng 1 dòng)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.entries.setdefault(image_id, LedgerEntry(image_id))
+            for key, value in values.items():
+                if key not in FIELD_NAMES:
+                    raise KeyError(f"unknown ledger field {key}")
+                if value:  # Không ghi đè retailer đã biết bằng chuỗi rỗng
+                    setattr(entry, key, tuple(value) if key == "crop_ratio" else value)
+
+    def by_retailer(self) -> Dict[str, Dict]:
+        groups: Dict[str, List[LedgerEntry]] = {}
+        with self._lock:
+            for entry in self.entries.values():
+                groups.setdefault(entry.retailer or "(unknown)", []).append(entry)
+        total_wall = sum(e.wall_seconds for group in groups.values() for e in group) or 1.0
+        summary = {}
+        for retailer, entries in sorted(groups.items()):
+            row = {"images": len(entries)}
+            for name in TOKEN_FIELDS:
+                values = sorted(getattr(e, name) for e in entries)
+                row[name] = {"total": sum(values), "mean": round(sum(values) / len(values), 1),
+                             "p95": round(percentile(values, 95), 1), "max": values[-1]}
+            wall = sum(e.wall_seconds for e in entries)
+            row["wall_seconds"] = round(wall, 2)
+            row["wall_share"] = round(wall / total_wall, 4)  # Phần thời gian GPU của retailer này
+            summary[retailer] = row
+        return summary
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            per_image = [e.as_dict() for _, e in sorted(self.entries.items())]
+        return {"per_image": per_image, "by_retailer": self.by_retailer()}
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+        print(f"Token ledger saved to: {path}")
+
+    def load(self, path: str):
+        """Đọc lại file đã ghi và gộp vào ledger hiện tại."""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for item in data.get("per_image", []):
+            values = {k: v for k, v in item.items() if k in FIELD_NAMES and k != "image_id"}
+            self.record(item["image_id"], **values)
+
+    def format_table(self) -> str:
+        lines = [f"{'RETAILER':<16} {'IMAGES':>6} {'VISUAL':>10} {'OCR OUT':>10} {'PROMPT':>10} "
+                 f"{'LLM OUT':>9} {'OCR OUT p95':>12} {'WALL (s)':>9} {'SHARE':>6}"]
+        for retailer, row in self.by_retailer().items():
+            lines.append(f"{retailer[:16]:<16} {row['images']:>6} {row['visual_tokens']['total']:>10} "
+                         f"{row['ocr_output_tokens']['total']:>10} {row['prompt_tokens']['total']:>10} "
+                         f"{row['output_tokens']['total']:>9} {row['ocr_output_tokens']['p95']:>12.0f} "
+                         f"{row['wall_seconds']:>9.1f} {row['wall_share']:>6.1%}")
+        return "\n".join(lines)
+
+# Dùng chung cho cả process (như tracing.tracer)
+ledger = TokenLedger()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gộp / in sổ token của các lần chạy riêng (OCR runner, deepseek_llm_7b.py, shard)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    merge = sub.add_parser("merge")
+    merge.add_argument("files", nargs="+")
+    merge.add_argument("--out", default=None, help="File ledger sau khi gộp")
+    show = sub.add_parser("show")
+    show.add_argument("file")
+    args = parser.parse_args()
+
+    ledger.enable()
+    for path in (args.files if args.command == "merge" else [args.file]):
+        ledger.load(path)
+    print(ledger.format_table())
+    if args.command == "merge" and args.out:
+        ledger.write(args.out)
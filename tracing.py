@@ -0,0 +1,157 @@
+"""
+Đo thời gian từng bước cho từng ảnh (span), tắt mặc định nên gần như không tốn gì khi không dùng.
+
+    from tracing import tracer
+
+    with tracer.span("file_decode", image="AEON_image_1"):
+        image = Image.open(path)
+
+Bật bằng `--trace [file]` ở master_pipeline.py / run_dpsk_ocr_eval_batch.py / deepseek_llm_7b.py:
+- file trace JSON (định dạng Chrome trace event) mở bằng https://ui.perfetto.dev hoặc chrome://tracing,
+  mỗi ảnh 1 hàng riêng, các span theo batch (vd llm.generate của vLLM) nằm trên hàng của thread chạy nó;
+- bảng p50/p95/p99 theo từng loại span, master_pipeline.py ghi thêm vào báo cáo đánh giá (key "timing").
+
+Tên span đang dùng: file_decode, tokenize_with_images, ocr_generate, markdown_cleanup, prompt_build,
+llm_generate, json_parse, file_write, evaluation (mỗi ảnh) và ocr_stage, extraction_stage,
+evaluation_stage (mỗi lần gọi stage).
+"""
+import os
+import json
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("tracer", "name", "image", "args", "start")
+
+    def __init__(self, tracer, name, image, args):
+        self.tracer = tracer
+        self.name = name
+        self.image = image
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.image, **self.args)
+        return False
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._origin_ns = time.perf_counter_ns()
+        self._origin_wall = time.time()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def span(self, name: str, image: Optional[str] = None, **args):
+        """Context manager đo 1 span; image = tên ảnh (không có đuôi) nếu span thuộc về 1 ảnh."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, image, args)
+
+    def add(self, name: str, start_ns: int, end_ns: int, image: Optional[str] = None, **args):
+        """Ghi 1 span đã đo sẵn (thời điểm theo time.perf_counter_ns())."""
+        if not self.enabled:
+            return
+        event = {"name": name, "start_ns": start_ns, "dur_ns": end_ns - start_ns, "image": image,
+                 "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+        with self._lock:
+            self.events.append(event)
+
+    def add_wall(self, name: str, start: float, end: float, image: Optional[str] = None, **args):
+        """Như add() nhưng thời điểm theo time.time() (vd RequestMetrics của vLLM)."""
+        to_ns = lambda t: self._origin_ns + int((t - self._origin_wall) * 1e9)
+        self.add(name, to_ns(start), to_ns(end), image, **args)
+
+    # ------------------------------------------------------------------ export
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Trace theo định dạng Chrome trace event ("X" = complete event, đơn vị micro giây)."""
+        with self._lock:
+            events = list(self.events)
+        # Mỗi ảnh 1 hàng (tid giả), span không gắn ảnh giữ tid của thread
+        image_tids: Dict[str, int] = {}
+        trace_events = []
+        for e in events:
+            tid = e["tid"]
+            if e["image"] is not None:
+                tid = image_tids.setdefault(e["image"], len(image_tids) + 1)
+            trace_events.append({
+                "name": e["name"], "cat": "image" if e["image"] is not None else "stage", "ph": "X",
+                "ts": (e["start_ns"] - self._origin_ns) / 1000, "dur": e["dur_ns"] / 1000,
+                "pid": e["pid"], "tid": tid, "args": dict(e["args"], image=e["image"]) if e["image"] else e["args"],
+            })
+        for image, tid in image_tids.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                                 "args": {"name": f"image {image}"}})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        print(f"Trace saved to: {path} (open with https://ui.perfetto.dev)")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """{tên span: count, total_s, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}, theo thứ tự span xuất hiện."""
+        with self._lock:
+            events = list(self.events)
+        durations: Dict[str, List[float]] = {}
+        for e in events:
+            durations.setdefault(e["name"], []).append(e["dur_ns"] / 1e6)
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            summary[name] = {
+                "count": len(values),
+                "total_s": round(sum(values) / 1000, 4),
+                "mean_ms": round(sum(values) / len(values), 3),
+                "p50_ms": round(percentile(values, 50), 3),
+                "p95_ms": round(percentile(values, 95), 3),
+                "p99_ms": round(percentile(values, 99), 3),
+                "max_ms": round(values[-1], 3),
+            }
+        return summary
+
+    def format_summary(self) -> str:
+        lines = [f"{'SPAN':<22} {'COUNT':>6} {'TOTAL (s)':>10} {'P50 (ms)':>10} {'P95 (ms)':>10} {'P99 (ms)':>10}"]
+        for name, s in self.summary().items():
+            lines.append(f"{name:<22} {s['count']:>6} {s['total_s']:>10.2f} {s['p50_ms']:>10.1f} "
+                         f"{s['p95_ms']:>10.1f} {s['p99_ms']:>10.1f}")
+        return "\n".join(lines)
+
+    def append_to_report(self, report_file: str):
+        """Thêm bảng p50/p95/p99 vào báo cáo đánh giá (key "timing"), tạo file nếu chưa có."""
+        report = {}
+        if os.path.exists(report_file):
+            with open(report_file, "r", encoding="utf-8") as f:
+                report = json.load(f)
+        report["timing"] = self.summary()
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # Nội suy tuyến tính giữa 2 điểm gần nhất (giống numpy.percentile mặc định)
+    pos = (len(sorted_values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+# Dùng chung cho cả process: các module chỉ cần `from tracing import tracer`
+tracer = Tracer()